@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+"""
+Бенчмарк разбора хэдеров и генерации cpp файлов asp_db
+на синтетических схемах
+"""
+import cparser_lite as cpplite
+import asp_db_cpp as aspdb
+import asp_db_table_generate as asp_db_tg
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Версия формата результатов
+BENCHMARK_VERSION = 3
+
+# Этапы генерации, замеряемые по отдельности.
+#   `add_str2field_functions` не реализован и не замеряется
+GENERATOR_STAGES = [
+    'add_defines_h',
+    'add_flags_enums',
+    'add_data_structs_h',
+    'add_template_specification_h',
+    'add_str_tables',
+    'add_table_fields',
+    'add_get_field_collection',
+    'add_get_id_colname',
+    'add_create_setup',
+    'add_create_levels',
+    'add_get_table_name',
+    'add_get_table_code',
+    'add_field2str_functions',
+    'add_set_insert_values',
+    'add_set_insert_values_range',
+    'add_set_select_data',
+    'add_visit_select_data',
+    'add_field_lookup',
+]
+
+
+def make_synthetic_header(tables=100, fields=10, fk_density=0.2, comment_noise=0.0,
+                          nesting=0, seed=0):
+    """
+    Сгенерировать синтетический хэдер со структурами ASP_TABLE
+
+    :param tables: Число таблиц
+    :param fields: Число полей в таблице, включая внешние ключи
+    :param fk_density: Доля полей таблицы, являющихся внешними ключами
+        на предыдущие таблицы
+    :param comment_noise: Вероятность комментария перед каждой директивой
+    :param nesting: Глубина вложенности namespace вокруг структур
+    :param seed: Зерно генератора случайных чисел
+    :return: Текст хэдера
+    """
+    rnd = random.Random(seed)
+    lines = ['#ifndef SYNTHETIC_TABLES_H', '#define SYNTHETIC_TABLES_H', '']
+    for d in range(nesting):
+        lines.append('namespace ns' + str(d) + ' {')
+
+    def noise():
+        if comment_noise and rnd.random() < comment_noise:
+            if rnd.random() < 0.5:
+                lines.append('  // field(integer, commented_out); } {')
+            else:
+                lines.append('  /* struct ASP_TABLE fake {\n     primary_key(x) */')
+
+    for t in range(tables):
+        name = 'table' + str(t)
+        fk_count = int(round(fields * fk_density)) if t > 0 else 0
+        noise()
+        lines.append('struct ASP_TABLE ' + name + ' {')
+        lines.append('  field(integer, id, NOT_NULL);')
+        for f in range(1, fields - fk_count):
+            noise()
+            args = ', NOT_NULL' if rnd.random() < 0.5 else ''
+            lines.append('  field(' + rnd.choice(['integer', 'text', 'real']) +
+                         ', f' + str(f) + args + ');')
+        for k in range(fk_count):
+            noise()
+            lines.append('  field_fkey(integer, fk' + str(k) + ');')
+            lines.append('  reference(fk' + str(k) + ', table' + str(rnd.randrange(t)) +
+                         '(id), CASCADE, RESTRICT)')
+        if fields > 1 and fields - fk_count > 1:
+            lines.append('  str_functions(f1, to_str_f1, from_str_f1)')
+        lines.append('  primary_key(id)')
+        lines.append('};')
+        lines.append('')
+    for d in range(nesting):
+        lines.append('}  // namespace ns' + str(nesting - d - 1))
+    lines.append('#endif  // !SYNTHETIC_TABLES_H')
+    return '\n'.join(lines) + '\n'
+
+
+def run_stage(func, *args):
+    """
+    Выполнить этап генерации, дочитав результат до конца
+
+    :return: Число символов, выданных этапом
+    """
+    result = func(*args)
+    if result is None:
+        return 0
+    if isinstance(result, str):
+        return len(result)
+    return sum(len(chunk) for chunk in result)
+
+
+def measure(func, repeat):
+    """
+    Замерить время выполнения функции
+
+    :param func: Функция без аргументов
+    :param repeat: Число повторов
+    :return: Минимальное время выполнения в секундах
+    """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure_memory(func):
+    """
+    Замерить память, удерживаемую результатом функции
+
+    :param func: Функция без аргументов
+    :return: Размер памяти в байтах, выделенной за время выполнения
+        функции и не освобождённой, пока жив её результат
+    """
+    tracemalloc.start()
+    try:
+        result = func()
+        size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+class _PlainObject:
+    """
+    Объект с `__dict__` вместо `__slots__`, для замера `model_size`
+    """
+
+
+def model_size(value, plain=False, seen=None, strings=None):
+    """
+    Посчитать размер модели разобранных структур по `sys.getsizeof`.
+    Объекты, на которые ссылаются несколько раз, считаются один раз
+
+    :param value: Объект модели, например список AspDBCppStructs
+    :param plain: Посчитать размер той же модели без `__slots__`
+        и интернирования: у каждого объекта модели свой `__dict__`,
+        одинаковые строки разных структур - разные объекты.
+        Общий текст хэдера `text` по-прежнему считается один раз
+    :param seen: id уже посчитанных объектов
+    :param strings: id уже посчитанных строк
+    :return: Размер в байтах
+    """
+    if seen is None:
+        seen = set()
+    if strings is None:
+        strings = set()
+    if value is None or isinstance(value, (bool, int, float)):
+        return 0
+    if isinstance(value, str):
+        if id(value) in strings:
+            return 0
+        strings.add(id(value))
+        return sys.getsizeof(value)
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(model_size(item, plain, seen, strings)
+                                          for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(model_size(key, plain, seen, strings) +
+                                          model_size(item, plain, seen, strings)
+                                          for key, item in value.items())
+    names = [name for cls in type(value).__mro__ for name in cls.__dict__.get('__slots__', ())
+             if hasattr(value, name)]
+    if not names:
+        # Enum и прочие объекты вне классов модели
+        return sys.getsizeof(value)
+    size = 0
+    if plain:
+        copy = _PlainObject()
+        for name in names:
+            setattr(copy, name, None)
+        size += sys.getsizeof(copy) + sys.getsizeof(copy.__dict__)
+        if isinstance(value, cpplite.CppStructs):
+            # без интернирования строки общие только внутри структуры
+            strings = set()
+    else:
+        size += sys.getsizeof(value)
+    for name in names:
+        attr = getattr(value, name)
+        if name == 'text' and isinstance(attr, str):
+            # текст хэдера общий для всех структур
+            if id(attr) not in seen:
+                seen.add(id(attr))
+                size += sys.getsizeof(attr)
+            continue
+        size += model_size(attr, plain, seen, strings)
+    return size
+
+
+def run_benchmark(tables=100, fields=10, fk_density=0.2, comment_noise=0.0, nesting=0,
+                  repeat=3, seed=0):
+    """
+    Выполнить бенчмарк на синтетическом хэдере
+
+    :return: Словарь результатов: параметры схемы, время этапов в секундах
+        и память модели в байтах
+    """
+    params = dict(tables=tables, fields=fields, fk_density=fk_density,
+                  comment_noise=comment_noise, nesting=nesting, seed=seed)
+    text = make_synthetic_header(tables, fields, fk_density, comment_noise, nesting, seed)
+    phases = dict()
+    phases['cpp_comment_remover'] = measure(lambda: cpplite.cpp_comment_remover(text), repeat)
+
+    def init_structs():
+        aspdb.AspDBCppFile(text, lazy=False).init_structs()
+    phases['init_structs'] = measure(init_structs, repeat)
+
+    def list_structs():
+        # только имена таблиц, тела не разбираются
+        asp_file = aspdb.AspDBCppFile(text)
+        asp_file.init_structs()
+        return [struct.name for struct in asp_file.cpp_structs]
+    phases['list_structs'] = measure(list_structs, repeat)
+
+    def parsed_structs():
+        # память модели: структуры, поля и удерживаемый ими текст
+        asp_file = aspdb.AspDBCppFile(text, lazy=False)
+        asp_file.init_structs()
+        return asp_file.cpp_structs
+    # память модели целиком и размер её объектов рядом с размером тех же
+    #   объектов без __slots__ и интернирования строк
+    asp_file = aspdb.AspDBCppFile(text, lazy=False)
+    asp_file.init_structs()
+    model = model_size(asp_file.cpp_structs)
+    model_plain = model_size(asp_file.cpp_structs, plain=True)
+    memory = {'structs': measure_memory(parsed_structs), 'model': model}
+    memory_plain = {'model': model_plain, 'saved': model_plain - model,
+                    'saved_ratio': (model_plain - model) / model_plain if model_plain else 0.0}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        header_file = os.path.join(tmp, 'synthetic.h')
+        with open(header_file, 'w') as f:
+            f.write(text)
+        gen = asp_db_tg.AspDBTablesGenerator(header_file, 'synthetic')
+    gen.asp_tables.init_structs()
+    gen.set_class_name()
+    gen.tables = gen.init_tables()
+    structs = gen.asp_tables.cpp_structs
+    phases['ir_dump'] = measure(
+        lambda: ''.join(aspdb.AspDBSchemaFile.iter_dump(structs, 'synthetic.h', 'synthetic')), repeat)
+    with tempfile.TemporaryDirectory() as tmp:
+        ir_file = os.path.join(tmp, 'synthetic' + aspdb.SCHEMA_IR_EXT)
+        with open(ir_file, 'w', encoding='utf-8') as f:
+            f.writelines(aspdb.AspDBSchemaFile.iter_dump(structs, 'synthetic.h', 'synthetic'))
+        phases['ir_load'] = measure(lambda: aspdb.AspDBSchemaFile(ir_file).init_structs(), repeat)
+    phases['table_names'] = measure(
+        lambda: [asp_db_tg.AspDBTableNames(s) for s in structs], repeat)
+    for stage in GENERATOR_STAGES:
+        func = getattr(gen, stage)
+        if stage == 'add_table_fields':
+            phases[stage] = measure(
+                lambda: [run_stage(func, s) for s in structs], repeat)
+        else:
+            phases[stage] = measure(lambda: run_stage(func), repeat)
+    return dict(version=BENCHMARK_VERSION, params=params, header_size=len(text),
+                phases=phases, memory=memory, memory_plain=memory_plain)
+
+
+def compare_results(results, baseline, tolerance=0.1):
+    """
+    Сравнить результаты с сохранёнными базовыми
+
+    :param results: Текущие результаты `run_benchmark`
+    :param baseline: Базовые результаты
+    :param tolerance: Допустимое относительное замедление этапа
+    :return: Словарь этап -> отношение времени (памяти для `memory.*`)
+        к базовому и список этапов, ухудшившихся сверх `tolerance`
+    """
+    if baseline.get('params') != results.get('params'):
+        print('Warning: benchmark parameters differ from baseline')
+    ratios = dict()
+    regressions = list()
+    for phase, elapsed in results['phases'].items():
+        base = baseline.get('phases', dict()).get(phase)
+        if not base:
+            continue
+        ratios[phase] = elapsed / base
+        if ratios[phase] > 1.0 + tolerance:
+            regressions.append(phase)
+    for name, size in results.get('memory', dict()).items():
+        base = baseline.get('memory', dict()).get(name)
+        if not base:
+            continue
+        key = 'memory.' + name
+        ratios[key] = size / base
+        if ratios[key] > 1.0 + tolerance:
+            regressions.append(key)
+    return ratios, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк генератора таблиц asp_db')
+    parser.add_argument('--tables', type=int, default=100)
+    parser.add_argument('--fields', type=int, default=10)
+    parser.add_argument('--fk-density', type=float, default=0.2)
+    parser.add_argument('--comment-noise', type=float, default=0.0)
+    parser.add_argument('--nesting', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='записать результаты в JSON файл')
+    parser.add_argument('-b', '--baseline', help='JSON файл базовых результатов для сравнения')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='допустимое относительное замедление этапа')
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.tables, args.fields, args.fk_density, args.comment_noise,
+                            args.nesting, args.repeat, args.seed)
+    for phase, elapsed in results['phases'].items():
+        print('{:<32} {:10.6f} s'.format(phase, elapsed))
+    for name, size in results['memory'].items():
+        print('{:<32} {:10.0f} B'.format('memory.' + name, size))
+    plain = results['memory_plain']
+    print('{:<32} {:10.0f} B'.format('memory.model without slots', plain['model']))
+    print('{:<32} {:10.0f} B ({:.1%})'.format('memory.model saved', plain['saved'],
+                                              plain['saved_ratio']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        ratios, regressions = compare_results(results, baseline, args.tolerance)
+        for phase, ratio in ratios.items():
+            print('{:<32} x{:.3f}'.format(phase, ratio))
+        if regressions:
+            print('Regressions: ' + ', '.join(regressions), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
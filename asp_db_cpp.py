@@ -2,22 +2,53 @@
 Модуль обработки конфигурации cpp хэдера asp_db
 """
 import cparser_lite as cpplite
-import re
+import hashlib
+import json
+import os
+import sys
 from enum import Enum
 
+# Версия формата кэша разбора структур. Увеличивать при любом изменении
+#   парсера или модели данных AspDBCppStructs - старый кэш станет невалидным
+PARSE_CACHE_VERSION = 5
+
+# Версия формата промежуточного представления схемы, см. AspDBSchemaFile.
+#   Увеличивать при любом изменении `to_ir`/`from_ir`
+SCHEMA_IR_VERSION = 1
+# Расширение файлов промежуточного представления схемы
+SCHEMA_IR_EXT = '.ir.json'
+
 
 class AspDBCppFunctions(cpplite.ICppFunctions):
     """
     Класс инкапсулирующий функционал инициализации данных AspDB
     """
-    def init_cpp_structs(self, name, source):
-        return AspDBCppStructs(name, source)
+    def __init__(self, stats=None, lazy=False):
+        """
+        :param stats: Статистика этапов разбора структур, None - не собирать
+        :param lazy: Откладывать разбор тела структуры до первого
+            обращения к её данным
+        """
+        self.stats = stats
+        self.lazy = lazy
+
+    def __getstate__(self):
+        # в процессы пула статистика не передаётся
+        return {'stats': None, 'lazy': self.lazy}
+
+    def init_cpp_structs(self, name, source, span=None):
+        return AspDBCppStructs(name, source, self.stats, span, self.lazy)
 
 
 class AspDBField:
     """
-    Структура описывающая поля таблиц ASP_TABLE
+    Структура описывающая поля таблиц ASP_TABLE.
+    Типы, имена и аргументы полей интернируются: в больших схемах
+    они повторяются от таблицы к таблице
     """
+    __slots__ = ('asp_type', 'asp_name', 'asp_args', 'not_null', 'is_array', 'is_primary_key',
+                 'is_reference', 'to_str', 'from_str')
+
     def __init__(self, asp_type, asp_name, asp_args):
         """
         Инициализировать поле таблицы
@@ -26,9 +57,9 @@ class AspDBField:
         :param asp_name: Имя поля
         :param asp_args: Массив аргументов
         """
-        self.asp_type = asp_type
-        self.asp_name = asp_name
-        self.asp_args = [x.strip().upper() for x in asp_args.split(',')]
+        self.asp_type = sys.intern(asp_type)
+        self.asp_name = sys.intern(asp_name)
+        self.asp_args = [sys.intern(x.strip().upper()) for x in asp_args.split(',')]
         # флаги полей
         self.not_null = False
         self.is_array = False
@@ -50,6 +81,32 @@ class AspDBField:
     def get_name(self):
         return self.asp_name
 
+    # флаги поля в промежуточном представлении схемы
+    ir_flags = ('not_null', 'is_array', 'is_primary_key', 'is_reference')
+
+    def to_ir(self):
+        """
+        :return: Промежуточное представление поля: [тип, имя, аргументы,
+            установленные флаги, to_str, from_str]
+        """
+        return [self.asp_type, self.asp_name, self.asp_args,
+                [flag for flag in self.ir_flags if getattr(self, flag)],
+                self.to_str, self.from_str]
+
+    @classmethod
+    def from_ir(cls, data):
+        """
+        Восстановить поле из промежуточного представления `to_ir`
+        """
+        field = cls.__new__(cls)
+        asp_type, asp_name, asp_args, flags, field.to_str, field.from_str = data
+        field.asp_type = sys.intern(asp_type)
+        field.asp_name = sys.intern(asp_name)
+        field.asp_args = [sys.intern(arg) for arg in asp_args]
+        for flag in cls.ir_flags:
+            setattr(field, flag, flag in flags)
+        return field
+
     def get_flags_str(self):
         flags_str = ''
         if self.is_primary_key:
@@ -118,6 +175,8 @@ class AspDBReference:
     Структура внешнего ключа таблиц
 
     """
+    __slots__ = ('name', 'ftable', 'ftable_pk', 'on_update', 'on_delete')
+
     def __init__(self, name, ftable_ref, on_update, on_delete):
         """
         Инициализировать ссылку
@@ -127,14 +186,16 @@ class AspDBReference:
         :param on_update: Update метод
         :param on_delete: Delete метод
         """
-        self.name = name
-        self.ftable, self.ftable_pk = self.init_fkey_ref(ftable_ref)
+        self.name = sys.intern(name)
+        self.ftable, self.ftable_pk = map(sys.intern, self.init_fkey_ref(ftable_ref))
         self.on_update = set_ref_action(on_update)
         self.on_delete = set_ref_action(on_delete)
 
     def init_fkey_ref(self, ftable_ref):
-        return ftable_ref[: ftable_ref.find('(')].strip(),\
-               cpplite.get_brace_content(ftable_ref, '(', ')').strip()
+        begin, end = cpplite.get_brace_span(ftable_ref, 0, '(', ')')
+        if begin == -1:
+            return ftable_ref.strip(), ''
+        return ftable_ref[: begin - 1].strip(), ftable_ref[begin: end].strip()
 
     def get_ftable(self):
         return self.ftable
@@ -148,6 +209,25 @@ class AspDBReference:
     def get_delete_act(self):
         return self.on_delete
 
+    def to_ir(self):
+        """
+        :return: Промежуточное представление ссылки: [имя поля, внешняя
+            таблица, её ключ, update действие, delete действие]
+        """
+        return [self.name, self.ftable, self.ftable_pk, self.on_update.name, self.on_delete.name]
+
+    @classmethod
+    def from_ir(cls, data):
+        """
+        Восстановить ссылку из промежуточного представления `to_ir`
+        """
+        ref = cls.__new__(cls)
+        ref.name, ref.ftable, ref.ftable_pk = (sys.intern(x) for x in data[:3])
+        on_update, on_delete = data[3:]
+        ref.on_update = AspDBRefAction[on_update]
+        ref.on_delete = AspDBRefAction[on_delete]
+        return ref
+
 
 class AspDBCppForeignData:
     """
@@ -155,6 +235,8 @@ class AspDBCppForeignData:
 
     TODO: Может переименовать в AspDBReferenceData?
     """
+    __slots__ = ('field', 'ref')
+
     def __init__(self, field, ref):
         """
         Инициализировать объект данных ссылки на внешнюю таблицу
@@ -169,15 +251,82 @@ class AspDBCppForeignData:
 
 class AspDBCppStructs(cpplite.CppStructs):
     """
-    Cpp структура таблицы в формате метатаблицы asp_db
+    Cpp структура таблицы в формате метатаблицы asp_db.
+    При ленивом разборе до первого обращения к данным таблицы
+    (полям, ссылкам, ключам) хранятся только имя и границы тела
     """
-    def __init__(self, name, source):
-        super(AspDBCppStructs, self).__init__(name, source)
+    __slots__ = ('primary_key', 'foreign_refs', 'unique', 'directives', 'fields_index', 'stats')
+
+    # данные, получаемые разбором тела структуры
+    parsed_attrs = frozenset(('fields', 'primary_key', 'foreign_refs', 'unique', 'directives',
+                              'fields_index'))
+
+    def __init__(self, name, source, stats=None, span=None, lazy=False):
+        """
+        :param name: Имя структуры
+        :param source: Тело структуры без комментариев, либо текст,
+            содержащий его, см. `span`
+        :param stats: Статистика этапов разбора, None - не собирать
+        :param span: Границы тела в `source`, см. CppStructs
+        :param lazy: Разобрать тело при первом обращении к данным
+        """
+        super(AspDBCppStructs, self).__init__(name, source, span)
+        stats = stats if stats is not None else cpplite.NULL_STATS
+        if lazy:
+            # незаданные атрибуты разбираются в __getattr__, статистика
+            #   хранится до разбора
+            del self.fields
+            self.stats = stats
+        else:
+            self.parse_data(stats)
+
+    def __getattr__(self, name):
+        # вызывается только для незаданных атрибутов, т.е.
+        #   при первом обращении к данным ленивой структуры
+        if name not in self.parsed_attrs:
+            raise AttributeError(name)
+        try:
+            stats = object.__getattribute__(self, 'stats')
+            del self.stats
+        except AttributeError:
+            stats = cpplite.NULL_STATS
+        self.parse_data(stats)
+        return object.__getattribute__(self, name)
+
+    def __getstate__(self):
+        state = super(AspDBCppStructs, self).__getstate__()
+        # статистика не сериализуется
+        state.pop('stats', None)
+        return state
+
+    def is_parsed(self):
+        """
+        Разобрано ли тело структуры
+        """
+        try:
+            object.__getattribute__(self, 'fields_index')
+        except AttributeError:
+            return False
+        return True
+
+    def parse_data(self, stats=cpplite.NULL_STATS):
+        """
+        Разобрать тело структуры и проверить данные
+
+        :param stats: Статистика этапов разбора
+        """
+        self.fields = list()
         self.primary_key = list()
         self.foreign_refs = list()
+        # уникальные комплексы, список списков имён полей
         self.unique = list()
+        # директивы тела структуры в порядке объявления, объекты CppCall
+        #   с позициями в теле структуры
+        self.directives = list()
+        # индекс полей по имени, включая поля внешних ключей
+        self.fields_index = dict()
         # инициализировать данные
-        self.init_data()
+        self.init_data(stats)
         try:
             # проверить валидность данных
             # self.set_references_flags()
@@ -185,20 +334,120 @@ class AspDBCppStructs(cpplite.CppStructs):
         except BaseException as e:
             print(e)
 
-    def init_data(self):
+    # обработчики директив тела структуры: имя директивы -> метод
+    directive_handlers = {
+        'field': 'on_field',
+        'field_fkey': 'on_field_fkey',
+        'reference': 'on_reference',
+        'primary_key': 'on_primary_key',
+        'unique': 'on_unique',
+        'str_functions': 'on_str_functions',
+    }
+
+    def init_data(self, stats=cpplite.NULL_STATS):
         """
         Инициализировать данные
+
+        :param stats: Статистика этапов разбора
         :return:
         """
-        # инициализировать поля
-        self.fields = self.init_fields(r'field\s*\(')
-        # инициализировать первичный ключ
-        self.primary_key = self.init_primary_key()
-        # инициализировать ссылки на другие таблицы
-        self.foreign_refs = self.init_foreign_tables()
-        # инициализировать уникальные комплексы
-        self.unique = self.init_unique()
-        self.init_str_functions()
+        # разобрать директивы за один проход лексера
+        with stats.phase('init_data.directives'):
+            pending = self.init_directives()
+        # связать внешние ключи со ссылками и поля с конвертерами строк
+        with stats.phase('init_data.link'):
+            self.foreign_refs = self.init_foreign_tables(pending['field_fkey'],
+                                                         pending['reference'])
+            self.fields_index = self.init_fields_index()
+            self.init_str_functions(pending['str_functions'])
+
+    def init_directives(self):
+        """
+        Пройти тело структуры один раз, передав каждую директиву
+        `name(args)` её обработчику
+
+        :return: Словарь отложенных до связывания данных:
+            'field_fkey' - поля внешних ключей, 'reference' - ссылки,
+            'str_functions' - пары (директива, аргументы)
+        """
+        handlers = {name: getattr(self, method) for name, method in self.directive_handlers.items()}
+        pending = {'field_fkey': list(), 'reference': list(), 'str_functions': list()}
+        # тело структуры нужно только на время разбора
+        source = self.source
+        for call in cpplite.iter_calls(source):
+            self.directives.append(call)
+            handler = handlers.get(call.name)
+            if handler is not None:
+                handler(call, source[call.args_begin: call.args_end], pending)
+        return pending
+
+    def on_field(self, call, args, pending):
+        field = self.parse_field(args)
+        if field is not None:
+            self.fields.append(field)
+
+    def on_field_fkey(self, call, args, pending):
+        field = self.parse_field(args)
+        if field is not None:
+            pending['field_fkey'].append(field)
+
+    def on_reference(self, call, args, pending):
+        ref_fields = args.split(',')
+        if len(ref_fields) < 4:
+            print('Warning: AspDBCppStruct reference ' + args + ' ~~ cannot split ref')
+            return
+        pending['reference'].append(AspDBReference(ref_fields[0].strip(), ref_fields[1].strip(),
+                                                   ref_fields[2].strip(), ref_fields[3].strip()))
+
+    def on_primary_key(self, call, args, pending):
+        if self.primary_key:
+            print('Warning: AspDBCppStruct ' + self.name + ' has more than one primary_key, '
+                  'used first')
+            return
+        self.primary_key = [f.strip() for f in args.split(',')]
+
+    def on_unique(self, call, args, pending):
+        self.unique.append([f.strip() for f in args.split(',')])
+
+    def on_str_functions(self, call, args, pending):
+        pending['str_functions'].append((call, args))
+
+    def to_ir(self):
+        """
+        Получить промежуточное представление таблицы: только данные
+        модели, без исходника и директив
+
+        :return: Словарь, сериализуемый в JSON
+        """
+        return {'name': self.name,
+                'fields': [field.to_ir() for field in self.fields],
+                'foreign_refs': [[ref.field.to_ir(), ref.ref.to_ir()] for ref in self.foreign_refs],
+                'primary_key': self.primary_key,
+                'unique': self.unique}
+
+    @classmethod
+    def from_ir(cls, data):
+        """
+        Восстановить таблицу из промежуточного представления `to_ir`
+        без разбора исходника
+
+        :param data: Словарь `to_ir`
+        :return: AspDBCppStructs
+        """
+        struct = cls.__new__(cls)
+        cpplite.CppStructs.__init__(struct, data['name'], '')
+        struct.fields = [AspDBField.from_ir(field) for field in data['fields']]
+        struct.foreign_refs = list()
+        for field, ref in data['foreign_refs']:
+            foreign = AspDBCppForeignData.__new__(AspDBCppForeignData)
+            foreign.field = AspDBField.from_ir(field)
+            foreign.ref = AspDBReference.from_ir(ref)
+            struct.foreign_refs.append(foreign)
+        struct.primary_key = data['primary_key']
+        struct.unique = data['unique']
+        struct.directives = list()
+        struct.fields_index = struct.init_fields_index()
+        return struct
 
     def set_references_flags(self):
         """
@@ -219,180 +468,450 @@ class AspDBCppStructs(cpplite.CppStructs):
         :raise: BaseException с описание проблемы
         """
         for pk in self.primary_key:
-            found = False
-            for field in self.fields:
-                if field.get_name() == pk:
-                    found = True
-                    field.is_primary_key = True
-                    break
-            if not found:
-                for ref in self.foreign_refs:
-                    if ref.field.get_name() == pk:
-                        found = True
-                        ref.field.is_primary_key = True
-                        break
-            if not found:
+            field = self.fields_index.get(pk)
+            if field is None:
                 raise BaseException('Несоответствующее имя поля первичного ключа: "' +
                                     pk + '"!')
+            field.is_primary_key = True
 
-    def init_fields(self, fields_pattern):
+    def init_fields_index(self):
         """
-        Инициализировать поля таблицы
+        Построить индекс полей таблицы по имени: обычные поля и поля
+        внешних ключей. О повторяющихся именах выводится предупреждение,
+        в индекс попадает первое объявление
 
-        :param fields_pattern: Строковой паттерн поиска полей
-        :return: Лист проинциализированных полей
+        :return: Словарь имя поля -> AspDBField
         """
-        fields = re.findall(fields_pattern, self.source)
-        missed = []
-        result_list = list()
-        field_ind = -1
-        for field in fields:
-            field_ind = self.source.find(field, field_ind + 1)
-            if field_ind == -1:
-                missed.append(field + ' ~~ cannot find field in struct')
-                continue
-            content = cpplite.get_brace_content(self.source[field_ind:], '(', ')')
-            params = content.split(',')
-            # имя и тип
-            try:
-                result_list.append(AspDBField(params[0].strip(), params[1].strip(),
-                                              params[2] if len(params) > 2 else ''))
-            except IndexError as e:
-                print('Error for parsing field type|name for ' + params[0])
-        if len(missed) > 0:
-            print('Warning: AspDBCppStruct.init_fields finished with errors')
-            print(missed)
-        return result_list
+        index = dict()
+        duplicates = list()
+        for field in self.fields + [ref.field for ref in self.foreign_refs]:
+            if index.setdefault(field.get_name(), field) is not field:
+                duplicates.append(field.get_name())
+        if duplicates:
+            print('Warning: AspDBCppStruct ' + self.name + ' has duplicate fields: ' +
+                  ', '.join(duplicates))
+        return index
+
+    def get_field(self, name):
+        """
+        Найти поле таблицы по имени
+
+        :param name: Имя поля
+        :return: AspDBField, None если поля нет
+        """
+        return self.fields_index.get(name)
 
-    def init_primary_key(self):
+    @staticmethod
+    def parse_field(args):
         """
-        Инициализировать первичный ключ
+        Разобрать аргументы директивы поля `type, name[, flags]`
 
-        :TODO: может быть сложный первичный ключ с несколькими полями
-        :return: Лист полей, в составе первичного ключа
+        :param args: Содержимое скобок директивы
+        :return: AspDBField, None при ошибке разбора
         """
-        pk_id = self.source.find('primary_key')
-        pk = list()
-        if pk_id != -1:
-            pk_str = cpplite.get_brace_content(self.source[pk_id:], '(', ')').strip()
-            pk = [f.strip() for f in pk_str.split(',')]
-        return pk
+        params = args.split(',')
+        # имя и тип
+        try:
+            return AspDBField(params[0].strip(), params[1].strip(),
+                              params[2] if len(params) > 2 else '')
+        except IndexError as e:
+            print('Error for parsing field type|name for ' + params[0])
+        return None
 
-    def init_foreign_tables(self):
+    def init_foreign_tables(self, fkey_fields, references):
         """
         Инициализировать ссылки на другие таблицы
 
+        :param fkey_fields: Поля внешних ключей
+        :param references: Ссылки
         :return: Лист ссылок
         """
-        # fields
-        fkey_fields = self.init_fields(r'field_fkey\s*\(')
-        # references
-        references = self.init_references()
         # list of foreign_table_refs
         foreign_data = list()
+        # ссылки по имени поля, первое объявление
+        refs_index = dict()
+        for ref in references:
+            refs_index.setdefault(ref.name, ref)
         # check pairs fkey_field - reference
         for fkey_field in fkey_fields:
             # имя поля
             ffname = fkey_field.asp_name
-            # нашлась соответствующая ссылка
-            matched = False
-            for ref in references:
-                if ref.name == ffname:
-                    foreign_data.append(AspDBCppForeignData(fkey_field, ref))
-                    matched = True
-                    break
-            if not matched:
+            ref = refs_index.get(ffname)
+            if ref is not None:
+                foreign_data.append(AspDBCppForeignData(fkey_field, ref))
+            else:
                 print('Foreign data initialization error! No reference for ' + ffname)
         if len(fkey_fields) != len(references):
             print('Item count mismatch for `fkey_fields` and `references`')
         return foreign_data
 
-    def init_references(self):
+    def init_str_functions(self, str_functions):
         """
-        Инициализировать ссылки на другие таблицы
+        Инициализировать конвертеры строк(те что преобразуют поля к строкам SQL запросов)
 
-        :return: Список ссылок
+        :param str_functions: Пары (директива, аргументы) директив `str_functions`
+        :return:
         """
-        refs = re.findall(r'reference\s*\(', self.source)
-        ref_ind = -1
-        result_list = list()
         missed = []
-        for ref in refs:
-            ref_ind = self.source.find(ref, ref_ind + 1)
-            if ref_ind == -1:
-                missed.append(ref + ' ~~ cannot find ref')
-                continue
-            ref_fields = cpplite.get_brace_content(self.source[ref_ind:], '(', ')').split(',')
-            if len(ref_fields) < 3:
-                missed.append(ref + ' ~~ cannot split ref')
+        for call, func_pair in str_functions:
+            str_funcs_fields = func_pair.split(',')
+            if len(str_funcs_fields) < 3:
+                missed.append(func_pair + ' ~~ cannot split ref')
                 continue
-            result_list.append(AspDBReference(ref_fields[0].strip(), ref_fields[1].strip(),
-                                              ref_fields[2].strip(), ref_fields[3].strip()))
+            # Ищем соответствующее поле
+            field = self.fields_index.get(str_funcs_fields[0].strip())
+            if field is not None:
+                field.to_str = sys.intern(str_funcs_fields[1].strip())
+                field.from_str = sys.intern(str_funcs_fields[2].strip())
+            else:
+                missed.append(func_pair + ' ~~ cannot find field ' + str_funcs_fields[0])
         if len(missed) > 0:
-            print('Warning: AspDBCppStruct.init_references finished with errors')
+            print('Warning: AspDBCppStruct.init_str_functions finished with errors')
             print(missed)
-        return result_list
 
-    def init_unique(self):
-        """
-        Инициализировать уникальный комплекс
 
-        :return: Список уникальных полей
-        :TODO: Комплекс уникальных значений может быть не один
+class AspDBReferenceGraph:
+    """
+    Граф ссылок внешних ключей между таблицами схемы. Таблицы делятся
+    на уровни создания: таблица ссылается только на таблицы предыдущих
+    уровней, так что таблицы одного уровня можно создавать параллельно,
+    а удалять уровни - в обратном порядке.
+    Ссылки таблицы на себя и на таблицы вне схемы порядок не меняют
+    """
+    def __init__(self, cpp_structs):
+        """
+        :param cpp_structs: Список AspDBCppStructs
+        """
+        # имена таблиц в порядке объявления
+        self.names = list()
+        # имена таблиц схемы, на которые ссылается таблица
+        self.references = dict()
+        for struct in cpp_structs:
+            name = struct.get_name()
+            if name not in self.references:
+                self.names.append(name)
+                self.references[name] = list()
+        for struct in cpp_structs:
+            refs = self.references[struct.get_name()]
+            for foreign in struct.foreign_refs:
+                ftable = foreign.ref.get_ftable()
+                if ftable in self.references and ftable != struct.get_name() and ftable not in refs:
+                    refs.append(ftable)
+        # циклы ссылок, списки имён таблиц: первое имя повторено в конце
+        self.cycles = list()
+        self.levels = self.init_levels()
+
+    def init_levels(self):
         """
-        unique_id = self.source.find('unique')
-        unique = list()
-        if unique_id != -1:
-            unique_str = cpplite.get_brace_content(self.source[unique_id:], '(', ')')
-            unique = [f.strip() for f in unique_str.split(',')]
-        return unique
+        Разбить таблицы на уровни создания. Таблицы, ссылающиеся друг на
+        друга по циклу, объединяются в компоненту сильной связности,
+        компоненты упорядочиваются топологически: таблица создаётся после
+        всех компонент, на которые ссылается. Таблицы одной компоненты
+        создаются по одной, в порядке объявления
 
-    def init_str_functions(self):
+        :return: Список уровней, уровень - список имён таблиц в порядке объявления
         """
-        Инициализировать конвертеры строк(те что преобразуют поля к строкам SQL запросов)
+        order = {name: i for i, name in enumerate(self.names)}
+        components = self.find_components()
+        component_of = dict()
+        for i, component in enumerate(components):
+            for name in component:
+                component_of[name] = i
+        # компоненты найдены в обратном топологическом порядке: компоненты,
+        #   на которые ссылается таблица, найдены раньше её компоненты.
+        #   Компонента начинается после последнего уровня каждой из них
+        table_level = dict()
+        last_level = list()
+        for i, component in enumerate(components):
+            first = 0
+            for name in component:
+                for ref in self.references[name]:
+                    if component_of[ref] != i:
+                        first = max(first, last_level[component_of[ref]] + 1)
+            for offset, name in enumerate(component):
+                table_level[name] = first + offset
+            last_level.append(first + len(component) - 1)
+        levels = [list() for _ in range(max(last_level) + 1 if last_level else 0)]
+        for name in self.names:
+            levels[table_level[name]].append(name)
+        cyclic = sorted((component for component in components if len(component) > 1),
+                        key=lambda component: order[component[0]])
+        if cyclic:
+            self.cycles = [self.find_cycle(component) for component in cyclic]
+            print('Warning: AspDBReferenceGraph cyclic foreign keys: ' +
+                  '; '.join(' -> '.join(cycle) for cycle in self.cycles) +
+                  ', tables ' + ', '.join(name for component in cyclic for name in component) +
+                  ' are created one by one')
+        return levels
+
+    def find_components(self):
+        """
+        Найти компоненты сильной связности графа ссылок (алгоритм Тарьяна,
+        без рекурсии - цепочки ссылок могут быть длинными)
 
-        :return:
+        :return: Список компонент в обратном топологическом порядке,
+            компонента - список имён таблиц в порядке объявления
         """
-        str_funcs = re.findall(r'str_functions\s*\(', self.source)
-        str_funcs_ind = -1
-        missed = []
-        for func_pair in str_funcs:
-            str_funcs_ind = self.source.find(func_pair, str_funcs_ind + 1)
-            if str_funcs_ind == -1:
-                missed.append(func_pair + ' ~~ cannot find funcs pair')
+        order = {name: i for i, name in enumerate(self.names)}
+        index = dict()
+        low = dict()
+        stack = list()
+        on_stack = set()
+        components = list()
+        for root in self.names:
+            if root in index:
                 continue
-            str_funcs_fields = cpplite.get_brace_content(self.source[str_funcs_ind:], '(', ')').split(',')
-            if len(str_funcs_fields) < 3:
-                missed.append(func_pair + ' ~~ cannot split ref')
-                continue
-            found = False
-            for field in self.fields:
-                # Ищем соответствующее поле
-                if field.get_name() == str_funcs_fields[0]:
-                    field.to_str = str_funcs_fields[1].strip()
-                    field.from_str = str_funcs_fields[2].strip()
-                    found = True
-                    break
-            if not found:
-                for ref in self.foreign_refs:
-                    if ref.field.get_name() == str_funcs_fields[0]:
-                        ref.field.to_str = str_funcs_fields[1].strip()
-                        ref.field.from_str = str_funcs_fields[2].strip()
-                        found = True
-                        break
-            if not found:
-                missed.append(func_pair + ' ~~ cannot find field ' + str_funcs_fields[0])
-        if len(missed) > 0:
-            print('Warning: AspDBCppStruct.init_str_functions finished with errors')
-            print(missed)
+            # стек обхода: (таблица, номер следующей ссылки)
+            path = [(root, 0)]
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            while path:
+                name, i = path[-1]
+                refs = self.references[name]
+                if i < len(refs):
+                    path[-1] = (name, i + 1)
+                    ref = refs[i]
+                    if ref not in index:
+                        index[ref] = low[ref] = len(index)
+                        stack.append(ref)
+                        on_stack.add(ref)
+                        path.append((ref, 0))
+                    elif ref in on_stack:
+                        low[name] = min(low[name], index[ref])
+                    continue
+                path.pop()
+                if path:
+                    parent = path[-1][0]
+                    low[parent] = min(low[parent], low[name])
+                if low[name] == index[name]:
+                    component = list()
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == name:
+                            break
+                    components.append(sorted(component, key=order.get))
+        return components
+
+    def find_cycle(self, component):
+        """
+        Найти кратчайший цикл ссылок через первую объявленную таблицу компоненты
+
+        :param component: Компонента сильной связности из нескольких таблиц
+        :return: Список имён таблиц цикла, первое имя повторено в конце
+        """
+        start = component[0]
+        members = set(component)
+        previous = {start: None}
+        queue = [start]
+        for name in queue:
+            for ref in self.references[name]:
+                if ref not in members:
+                    continue
+                if ref == start:
+                    cycle = [start]
+                    while name is not None:
+                        cycle.append(name)
+                        name = previous[name]
+                    return cycle[::-1]
+                if ref not in previous:
+                    previous[ref] = name
+                    queue.append(ref)
+        return [start, start]
+
+
+class AspDBParseCache:
+    """
+    Дисковый кэш разобранных структур ASP_TABLE.
+    Ключ - хэш тела структуры, файлы лежат в поддиректории версии кэша.
+    Структуры хранятся в JSON промежуточного представления схемы
+    `AspDBCppStructs.to_ir`, так что чтение кэша не исполняет код
+    """
+    def __init__(self, cache_dir):
+        """
+        :param cache_dir: Директория кэша
+        """
+        self.cache_dir = os.path.join(cache_dir, 'v' + str(PARSE_CACHE_VERSION))
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(body):
+        """
+        Получить ключ кэша по телу структуры
+
+        :param body: Тело структуры, строка или bytes-like
+        :return: Строка ключа
+        """
+        if isinstance(body, str):
+            body = body.encode()
+        h = hashlib.sha1(str(PARSE_CACHE_VERSION).encode())
+        h.update(body)
+        return h.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def load(self, key):
+        """
+        Загрузить структуру из кэша
+
+        :param key: Ключ кэша
+        :return: Объект AspDBCppStructs, None если в кэше его нет
+            или запись повреждена
+        """
+        try:
+            with open(self.get_path(key), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data['version'] != PARSE_CACHE_VERSION:
+                return None
+            struct = AspDBCppStructs.from_ir(data['struct'])
+            struct.text = data['source']
+            # позиции директив - в теле структуры, оно и сохранено
+            struct.directives = [cpplite.CppCall(sys.intern(name), pos, begin, end)
+                                 for name, pos, begin, end in data['directives']]
+        except (OSError, ValueError, KeyError, TypeError, IndexError):
+            return None
+        return struct
+
+    def store(self, key, struct):
+        """
+        Записать структуру в кэш. Запись атомарна - через временный файл
+
+        :param key: Ключ кэша
+        :param struct: Объект AspDBCppStructs
+        """
+        path = self.get_path(key)
+        tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+        data = {'version': PARSE_CACHE_VERSION, 'struct': struct.to_ir(),
+                'source': struct.source,
+                'directives': [[call.name, call.pos, call.args_begin, call.args_end]
+                               for call in struct.directives]}
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print('Warning: cannot write parse cache ' + path + ': ' + str(e))
 
 
 class AspDBCppFile(cpplite.CppFile):
     """
     Python инициализатор для модуля ASP_DB
     """
-    def __init__(self, text):
-        super(AspDBCppFile, self).__init__(text, AspDBCppFunctions())
+    def __init__(self, text, encoding='utf-8', cache_dir=None, stats=None, lazy=True):
+        """
+        :param text: Исходник хэдера, строка или bytes-like
+        :param encoding: Кодировка bytes-like исходника
+        :param cache_dir: Директория кэша разобранных структур,
+            None - не использовать кэш
+        :param stats: Статистика этапов PhaseStats, None - не собирать
+        :param lazy: Разбирать тела структур при первом обращении к их
+            данным, так что `init_structs` только находит имена и границы
+            структур. Структуры, сохраняемые в кэш, разбираются сразу
+        """
+        super(AspDBCppFile, self).__init__(text, AspDBCppFunctions(stats, lazy), encoding, stats)
+        self.cache = AspDBParseCache(cache_dir) if cache_dir else None
+        # число структур, загруженных из кэша
+        self.cache_hits = 0
+
+    def init_struct(self, name, begin, end):
+        """
+        Инициализировать структуру, по возможности загрузив её из кэша.
+        Для bytes-like исходника хэшируется сырое тело структуры, так что
+        при попадании в кэш оно даже не декодируется
+        """
+        if self.cache is None:
+            return super(AspDBCppFile, self).init_struct(name, begin, end)
+        key = self.cache.get_key(self.source[begin: end])
+        struct = self.cache.load(key)
+        if struct is not None:
+            # тела структур с разными именами могут совпадать
+            struct.name = name
+            self.cache_hits += 1
+            self.stats.add('parse_cache_hits')
+            return struct
+        struct = super(AspDBCppFile, self).init_struct(name, begin, end)
+        self.cache.store(key, struct)
+        return struct
+
+    def init_structs_parallel(self, spans, jobs):
+        """
+        Инициализировать структуры в пуле процессов. Найденные в кэше
+        структуры в пул не отправляются
+        """
+        if self.cache is None:
+            return super(AspDBCppFile, self).init_structs_parallel(spans, jobs)
+        keys = [self.cache.get_key(self.source[begin: end]) for name, begin, end in spans]
+        result = [self.cache.load(key) for key in keys]
+        missed = [i for i, struct in enumerate(result) if struct is None]
+        self.cache_hits += len(spans) - len(missed)
+        self.stats.add('parse_cache_hits', calls=len(spans) - len(missed))
+        parsed = super(AspDBCppFile, self).init_structs_parallel(
+            [spans[i] for i in missed], jobs)
+        for i, struct in zip(missed, parsed):
+            self.cache.store(keys[i], struct)
+            result[i] = struct
+        for (name, begin, end), struct in zip(spans, result):
+            struct.name = name
+        return result
 
     def get_class_marker(self):
         return 'ASP_TABLE'
+
+
+class AspDBSchemaFile:
+    """
+    Схема таблиц, загруженная из промежуточного представления (IR) -
+    JSON файла с моделью разобранных структур. Позволяет разобрать
+    хэдер один раз и генерировать по нему код без повторного разбора.
+    Интерфейс совпадает с используемой генератором частью AspDBCppFile
+    """
+    def __init__(self, path, stats=None):
+        """
+        :param path: Путь файла промежуточного представления
+        :param stats: Статистика этапов PhaseStats, None - не собирать
+        :raise BaseException: если версия формата не поддерживается
+        """
+        self.stats = stats if stats is not None else cpplite.NULL_STATS
+        with self.stats.phase('read'):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        if data.get('version') != SCHEMA_IR_VERSION:
+            raise BaseException('Unsupported schema IR version ' + str(data.get('version')) +
+                                ' in ' + path + ', expected ' + str(SCHEMA_IR_VERSION))
+        # исходный хэдер и модуль, для которых сохранено представление
+        self.header = data['header']
+        self.module = data['module']
+        self.tables = data['tables']
+        self.cpp_structs = list()
+
+    def init_structs(self, jobs=1):
+        """
+        Восстановить структуры таблиц
+
+        :param jobs: Не используется, для совместимости с AspDBCppFile
+        """
+        self.cpp_structs = [AspDBCppStructs.from_ir(table) for table in self.tables]
+
+    @staticmethod
+    def iter_dump(cpp_structs, header, module):
+        """
+        Сериализовать схему в промежуточное представление
+
+        :param cpp_structs: Список AspDBCppStructs
+        :param header: Исходный хэдер схемы
+        :param module: Имя модуля набора таблиц
+        :return: Генератор кусков JSON текста
+        """
+        data = {'version': SCHEMA_IR_VERSION, 'header': header, 'module': module,
+                'tables': [struct.to_ir() for struct in cpp_structs]}
+        return json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).iterencode(data)
+
+
+def is_schema_ir(path):
+    """
+    Является ли файл промежуточным представлением схемы, по расширению
+    """
+    return path.endswith(SCHEMA_IR_EXT)
@@ -4,6 +4,15 @@
 """
 import cparser_lite as cpplite
 import asp_db_cpp as aspdb
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import shlex
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 
 def get_table_define(table_name):
@@ -112,18 +121,542 @@ class AspDBTableText:
         return et
 
 
+# Шаблоны cpp кода генератора, компилируются один раз при загрузке модуля
+T_DEFINE = cpplite.CppTemplate('#define ${define} ${value}\n')
+T_TABLE_COMMENT = cpplite.CppTemplate('\n/* table: ${upper} */\n')
+T_FIELD_NAME_DEFINE = cpplite.CppTemplate('#define ${define}_NAME "${lower}"\n')
+T_TABLE_ENUM = cpplite.CppTemplate(',\n  ${enum} = ${define} >> 16')
+T_SPEC_GET_TABLE_NAME = cpplite.CppTemplate(
+    'template<>\n'
+    'std::string ${interface}::GetTableName<${name}>() const;\n')
+T_SPEC_GET_TABLE_CODE = cpplite.CppTemplate(
+    'template<>\n'
+    'db_table ${interface}::GetTableCode<${name}>() const;\n')
+T_SPEC_SET_INSERT_VALUES = cpplite.CppTemplate(
+    'template<>\n'
+    'void ${interface}::setInsertValues<${name}>(\n'
+    '    db_query_insert_setup *src, const ${name} &select_data) const;\n')
+T_SPEC_SET_SELECT_DATA = cpplite.CppTemplate(
+    'template<>\n'
+    'void ${interface}::SetSelectData<${name}>(\n'
+    '    db_query_select_result *src, std::vector<${name}> *out_vec) const;\n')
+T_GET_TABLE_NAME = cpplite.CppTemplate(
+    'template <>\n'
+    'std::string IDBTables::GetTableName<${name}>() const {\n'
+    '  return std::string(table_names[${enum}]);\n'
+    '}\n')
+T_GET_TABLE_CODE = cpplite.CppTemplate(
+    'template <>\n'
+    'db_table IDBTables::GetTableCode<${name}>() const {\n'
+    '  return ${enum};\n'
+    '}\n')
+T_FIELD2STR_HEAD = cpplite.CppTemplate(
+    'std::string field2str_${name}(${flags} flag, const ${name} &select_data) const {\n'
+    '  std::string result;\n'
+    '  switch (flag) {\n')
+T_FIELD2STR_CASE = cpplite.CppTemplate(
+    '    case ${flag}:\n'
+    '      result = ${to_str}(select_data);\n'
+    '      break;\n')
+T_FIELD2STR_DEFAULT_CASE = cpplite.CppTemplate('    case ${flag}:\n')
+T_FIELD2STR_TAIL = cpplite.CppTemplate(
+    '    default:\n'
+    '      result = field2str(select_data);\n'
+    '  }\n'
+    'return result;\n'
+    '}\n')
+T_INSERT_VALUES_HEAD = cpplite.CppTemplate(
+    'template <>\n'
+    'void IDBTables::setInsertValues<${enum}>(db_query_insert_setup *src,\n'
+    '    const ${name} &select_data) const {\n'
+    '  if (select_data.initialized == 0x00)\n'
+    '    return;\n'
+    '  db_query_basesetup::row_values values;\n'
+    '  db_query_basesetup::field_index i;\n')
+T_INSERT_VALUES_FIELD = cpplite.CppTemplate(
+    '  insert_macro(${flag}, ${define}, field2str_${table}(${flag}, select_data));\n')
+T_INSERT_VALUES_TAIL = cpplite.CppTemplate(
+    '  src->values_vec.emplace_back(values);\n'
+    '}\n')
+T_SPEC_SET_INSERT_VALUES_RANGE = cpplite.CppTemplate(
+    'template<>\n'
+    'void ${class}::setInsertValues<${name}>(\n'
+    '    db_query_insert_setup *src, const ${name} *begin, const ${name} *end) const;\n')
+T_INSERT_VALUES_RANGE_HEAD = cpplite.CppTemplate(
+    'template <>\n'
+    'void ${class}::setInsertValues<${name}>(db_query_insert_setup *src,\n'
+    '    const ${name} *begin, const ${name} *end) const {\n'
+    '  src->values_vec.reserve(src->values_vec.size() + (end - begin));\n'
+    '  db_query_basesetup::row_values values;\n'
+    '  db_query_basesetup::field_index i;\n'
+    '  for (const ${name} *row = begin; row != end; ++row) {\n'
+    '    const ${name} &select_data = *row;\n'
+    '    if (select_data.initialized == 0x00)\n'
+    '      continue;\n'
+    '    values.clear();\n')
+T_INSERT_VALUES_RANGE_FIELD = cpplite.CppTemplate(
+    '    insert_macro(${flag}, ${define}, field2str_${table}(${flag}, select_data));\n')
+T_INSERT_VALUES_RANGE_TAIL = cpplite.CppTemplate(
+    '    src->values_vec.emplace_back(std::move(values));\n'
+    '  }\n'
+    '}\n')
+# номера полей столбцов набора результатов `columns`
+SELECT_COLUMNS_TEXT = (
+    '  // номера полей столбцов результата, считаются один раз на набор:\n'
+    '  //   все строки набора содержат одни и те же столбцы, 0 - не поле таблицы\n'
+    '  std::vector<int> columns;\n'
+    '  if (!src->values.empty()) {\n'
+    '    columns.reserve(src->values.front().size());\n'
+    '    for (auto &col: src->values.front())\n'
+    '      columns.push_back(StrToFieldDefine_${name}(src->fields[col.first].fname) & 0xffff);\n'
+    '  }\n')
+# разбор столбцов строки в `tmp`
+SELECT_ROW_TEXT = (
+    '    auto column = columns.begin();\n'
+    '    for (auto &col: row) {\n'
+    '      switch (*column++) {\n')
+T_SELECT_DATA_HEAD = cpplite.CppTemplate(
+    'template<>\n'
+    'void IDBTables::SetSelectData<${name}>(db_query_select_result *src,\n'
+    '    std::vector<${name}> *out_vec) const {\n' +
+    SELECT_COLUMNS_TEXT +
+    '  out_vec->reserve(out_vec->size() + src->values.size());\n'
+    '  for (auto &row: src->values) {\n'
+    '    ${name} tmp;\n' +
+    SELECT_ROW_TEXT)
+T_SELECT_DATA_FIELD = cpplite.CppTemplate(
+    '        case ${index}:\n'
+    '          select_macro(${flag}, ${define}, str2field_${table}(${flag}, col.second));\n'
+    '          break;\n')
+T_SELECT_DATA_TAIL = cpplite.CppTemplate(
+    '        default:\n'
+    '          break;\n'
+    '      }\n'
+    '    }\n'
+    '    if (tmp.initialized != ${flags}::f_empty)\n'
+    '      out_vec->push_back(std::move(tmp));\n'
+    '  }\n'
+    '}\n')
+T_SPEC_VISIT_SELECT_DATA = cpplite.CppTemplate(
+    'template<>\n'
+    'void ${class}::VisitSelectData<${name}>(\n'
+    '    db_query_select_result *src, const std::function<void(const ${name} &)> &visitor) const;\n')
+T_VISIT_SELECT_DATA_HEAD = cpplite.CppTemplate(
+    'template <>\n'
+    'void ${class}::VisitSelectData<${name}>(db_query_select_result *src,\n'
+    '    const std::function<void(const ${name} &)> &visitor) const {\n' +
+    SELECT_COLUMNS_TEXT +
+    '  ${name} tmp;\n'
+    '  for (auto &row: src->values) {\n'
+    '    tmp = ${name}();\n' +
+    SELECT_ROW_TEXT)
+T_VISIT_SELECT_DATA_TAIL = cpplite.CppTemplate(
+    '        default:\n'
+    '          break;\n'
+    '      }\n'
+    '    }\n'
+    '    if (tmp.initialized != ${flags}::f_empty)\n'
+    '      visitor(tmp);\n'
+    '  }\n'
+    '}\n')
+# массивы, индексируемые enum таблицы: 0 - table_undefined,
+#   далее таблицы в порядке объявления, см. `add_defines_h`
+T_TABLE_NAMES_ENTRY = cpplite.CppTemplate('  "${name}",\n')
+T_FIELDS_COLLECTIONS_ENTRY = cpplite.CppTemplate('    &${fields},\n')
+T_ID_COLUMNS_ENTRY = cpplite.CppTemplate('    TABLE_FIELD_NAME(${id_define}),\n')
+T_CREATE_SETUPS_ENTRY = cpplite.CppTemplate('    &${create_setup},\n')
+T_FIELDS_COLLECTION_HEAD = cpplite.CppTemplate('\nconst db_fields_collection ${fields} = {\n')
+T_FIELD_VARIABLE = cpplite.CppTemplate(
+    '  db_variable(TABLE_FIELD_PAIR(${define}), ${type},\n'
+    '  {${flags_str}}\n')
+T_UNIQUES_HEAD = cpplite.CppTemplate(
+    '\nstatic const db_table_create_setup::uniques_container ${uniques} = {')
+T_EXTERN_TABLE_OBJECTS = cpplite.CppTemplate(
+    'extern const db_fields_collection ${fields};\n'
+    'extern const db_table_create_setup ${create_setup};\n')
+T_TABLE_OBJECT_GETTERS = cpplite.CppTemplate(
+    'const db_fields_collection &${fields}();\n'
+    'const db_table_create_setup &${create_setup}();\n')
+T_UNIQUES_FIELD = cpplite.CppTemplate(' TABLE_FIELD_NAME(${define}),\n')
+T_REFERENCES_HEAD = cpplite.CppTemplate(
+    'static const std::shared_ptr<db_ref_collection> ${references}(\n'
+    '    new db_ref_collection {')
+T_REFERENCE = cpplite.CppTemplate(
+    '\n    db_reference(TABLE_FIELD_NAME(${field}), ${ftable},\n'
+    '        ${ftable_pk}, true, ${on_update},\n'
+    '        ${on_delete}),')
+T_CREATE_SETUP = cpplite.CppTemplate(
+    '${storage}const db_table_create_setup ${create_setup}(\n'
+    '    ${enum}, ${fields},\n'
+    '    ${uniques}, ${references_arg});\n')
+# режим `lazy_init`: объекты таблицы - статические переменные функций,
+#   создаются при первом обращении, а не до `main`
+T_LAZY_FIELDS_COLLECTION_HEAD = cpplite.CppTemplate(
+    '\n${storage}const db_fields_collection &${fields}() {\n'
+    '  static const db_fields_collection fields = {\n')
+T_LAZY_FIELDS_COLLECTION_TAIL = cpplite.CppTemplate(
+    '};\n'
+    '  return fields;\n'
+    '}\n')
+T_LAZY_CREATE_SETUP_HEAD = cpplite.CppTemplate(
+    '\n${storage}const db_table_create_setup &${create_setup}() {\n'
+    '  static const db_table_create_setup::uniques_container uniques = {')
+T_LAZY_REFERENCES_HEAD = cpplite.CppTemplate(
+    '  static const std::shared_ptr<db_ref_collection> references(\n'
+    '    new db_ref_collection {')
+T_LAZY_CREATE_SETUP_TAIL = cpplite.CppTemplate(
+    '  static const db_table_create_setup setup(\n'
+    '    ${enum}, ${fields}(),\n'
+    '    uniques, ${references_arg});\n'
+    '  return setup;\n'
+    '}\n')
+
+
+T_NAME_HASH_FUNCTIONS = cpplite.CppTemplate(
+    '/* FNV-1a хэш имени, см. AspDBPerfectHash */\n'
+    'static uint32_t name_hash(const std::string &s, uint32_t seed) {\n'
+    '  uint32_t h = ${offset_basis}u ^ seed;\n'
+    '  for (unsigned char c: s) {\n'
+    '    h ^= c;\n'
+    '    h *= ${prime}u;\n'
+    '  }\n'
+    '  return h ^ (h >> 16);\n'
+    '}\n'
+    '\n'
+    'static size_t name_slot(const std::string &s, const int32_t *seeds, size_t size) {\n'
+    '  int32_t d = seeds[name_hash(s, 0) % size];\n'
+    '  return (d < 0) ? -d - 1 : name_hash(s, d) % size;\n'
+    '}\n\n')
+T_STR_TO_TABLE_CODE = cpplite.CppTemplate(
+    'db_table ${class}::StrToTableCode(const std::string &tname) const {\n'
+    '  static const int32_t seeds[${size}] = {${seeds}};\n'
+    '  static const char *const names[${size}] = {${names}};\n'
+    '  static const db_table codes[${size}] = {${codes}};\n'
+    '  size_t i = name_slot(tname, seeds, ${size});\n'
+    '  return (tname == names[i]) ? codes[i] : table_undefined;\n'
+    '}\n')
+T_STR_TO_FIELD_DEFINE_H = cpplite.CppTemplate(
+    'int StrToFieldDefine_${name}(const std::string &fname);\n')
+T_STR_TO_FIELD_DEFINE = cpplite.CppTemplate(
+    'int StrToFieldDefine_${name}(const std::string &fname) {\n'
+    '  static const int32_t seeds[${size}] = {${seeds}};\n'
+    '  static const char *const names[${size}] = {${names}};\n'
+    '  static const int defines[${size}] = {${defines}};\n'
+    '  size_t i = name_slot(fname, seeds, ${size});\n'
+    '  return (fname == names[i]) ? defines[i] : 0;\n'
+    '}\n')
+
+
+def name_hash(name, seed=0):
+    """
+    FNV-1a хэш имени, 32 бита, со свёрткой старших бит в младшие:
+    младшие биты FNV-1a зависят от байтов имени линейно, и по малому
+    модулю зерно их не разделяет. Совпадает с `name_hash` генерируемого кода
+
+    :param name: Имя
+    :param seed: Зерно, смешивается с начальным значением хэша
+    :return: Хэш
+    """
+    h = AspDBPerfectHash.offset_basis ^ seed
+    for c in name.encode():
+        h = ((h ^ c) * AspDBPerfectHash.prime) & 0xffffffff
+    return h ^ (h >> 16)
+
+
+class AspDBPerfectHash:
+    """
+    Совершенная хэш-функция набора имён, считается при генерации.
+    Двухуровневая схема hash-and-displace: имена раскладываются по
+    корзинам хэшем с нулевым зерном, для каждой корзины подбирается
+    зерно, размещающее все её имена в свободные слоты без коллизий.
+    Корзины из одного имени занимают оставшиеся слоты напрямую,
+    отрицательным значением `-slot - 1`. Поиск имени - два хэша и
+    одно сравнение строк
+    """
+    offset_basis = 2166136261
+    prime = 16777619
+    # предел подбора зерна корзины
+    max_seed = 1 << 20
+
+    def __init__(self, names):
+        """
+        :param names: Список уникальных имён
+        :raise BaseException: если имена повторяются или зерно не подобрано
+        """
+        if len(set(names)) != len(names):
+            raise BaseException('Perfect hash: duplicate names')
+        self.size = len(names)
+        # зерно или `-slot - 1` на каждую корзину
+        self.seeds = [0] * self.size
+        # индекс имени в `names` на каждый слот, None - слот свободен
+        self.slots = [None] * self.size
+        buckets = [list() for i in range(self.size)]
+        for i, name in enumerate(names):
+            buckets[name_hash(name) % self.size].append(i)
+        order = sorted(range(self.size), key=lambda b: len(buckets[b]), reverse=True)
+        for b in order:
+            bucket = buckets[b]
+            if len(bucket) <= 1:
+                break
+            for seed in range(1, self.max_seed):
+                slots = [name_hash(names[i], seed) % self.size for i in bucket]
+                if len(set(slots)) == len(slots) and \
+                        all(self.slots[slot] is None for slot in slots):
+                    break
+            else:
+                raise BaseException('Perfect hash: no seed for bucket of ' + str(len(bucket)))
+            self.seeds[b] = seed
+            for i, slot in zip(bucket, slots):
+                self.slots[slot] = i
+        free = [slot for slot in range(self.size) if self.slots[slot] is None]
+        for b in order:
+            if len(buckets[b]) == 1:
+                slot = free.pop()
+                self.seeds[b] = -slot - 1
+                self.slots[slot] = buckets[b][0]
+
+    def get_slot(self, name):
+        """
+        Слот имени, как его считает генерируемый код
+
+        :return: Номер слота, для неизвестного имени - слот другого имени
+        """
+        d = self.seeds[name_hash(name) % self.size]
+        return -d - 1 if d < 0 else name_hash(name, d) % self.size
+
+    def get_array(self, values):
+        """
+        Разложить значения по слотам
+
+        :param values: Значения в порядке имён
+        :return: Строка инициализатора cpp массива
+        """
+        return ', '.join(values[i] for i in self.slots)
+
+
+class AspDBFieldNames:
+    """
+    Имена cpp кода одного поля таблицы: дефайн, флаг, имя
+    """
+    def __init__(self, table_name, index, field):
+        """
+        :param table_name: Имя таблицы
+        :param index: Номер поля в таблице, от 0: сначала обычные поля,
+            затем поля внешних ключей
+        :param field: AspDBField
+        """
+        self.field = field
+        self.define = get_field_define(table_name, field.get_name())
+        self.flag = get_field_flag(table_name, field.get_name())
+        # подстановки шаблонов
+        self.values = {
+            'table': table_name,
+            'field': field.get_name(),
+            'lower': field.get_name().lower(),
+            'define': self.define,
+            'value': '(' + get_table_define(table_name) + ' | ' + format(index + 1, '#06x') + ')',
+            'flag': self.flag,
+            'index': str(index + 1),
+            'type': field.asp_type,
+            'flags_str': field.get_flags_str(),
+            'to_str': field.to_str or '',
+        }
+
+
+class AspDBTableNames:
+    """
+    Имена cpp кода таблицы: дефайны, enum, флаги, имена статических
+    объектов, а также имена всех её полей. Считаются один раз на таблицу
+    и используются всеми методами генерации
+    """
+    def __init__(self, struct):
+        """
+        :param struct: AspDBCppStructs
+        """
+        self.struct = struct
+        name = struct.get_name()
+        self.name = name
+        # поля в порядке флагов и дефайнов: обычные, затем внешние ключи
+        self.fields = [AspDBFieldNames(name, i, field) for i, field in
+                       enumerate(struct.fields + [ref.field for ref in struct.foreign_refs])]
+        # дефайны полей по имени, повторное имя не заменяет первое
+        self.defines = dict()
+        for field in self.fields:
+            self.defines.setdefault(field.field.get_name(), field.define)
+        self.has_id = any(field.get_name() == 'id' for field in struct.fields)
+        # подстановки шаблонов
+        self.values = {
+            'name': name,
+            'upper': name.upper(),
+            'define': get_table_define(name),
+            'enum': get_table_enum(name),
+            'flags': get_table_flags(name),
+            'fields': get_table_fields(name),
+            'uniques': name + '_uniques',
+            'references': get_table_references(name),
+            'references_arg': get_table_references(name) if struct.foreign_refs else 'nullptr',
+            'create_setup': get_create_setup(name),
+            'id_define': get_field_define(name, 'id'),
+        }
+        # сгенерированные куски cpp кода таблицы по ключу этапа,
+        #   None - не запоминать, см. AspDBTablesGenerator.get_section
+        self.sections = None
+
+    def get_field_define(self, field_name):
+        """
+        Дефайн поля по имени, в том числе для необъявленных полей
+        """
+        define = self.defines.get(field_name)
+        return define if define is not None else get_field_define(self.name, field_name)
+
+
+class AspDBOutputWriter:
+    """
+    Буферизованная потоковая запись сгенерированного файла.
+    Куски кода пишутся по мере выработки во временный файл рядом с
+    целевым, так что в памяти держится не больше одного куска.
+    При закрытии хэш нового содержимого сравнивается с файлом на диске:
+    если содержимое не изменилось, файл не перезаписывается и его время
+    модификации не меняется, иначе временный файл атомарно заменяет
+    целевой. Если запись прервана исключением, временный файл удаляется,
+    а целевой остаётся прежним. Имя временного файла содержит pid, чтобы
+    генераторы в разных процессах не затирали записи друг друга
+    """
+    # размер буфера файла
+    buffer_size = 1 << 16
+    # суффикс временного файла
+    tmp_suffix = '.tmp'
+
+    def __init__(self, path, stats=cpplite.NULL_STATS, encoding='utf-8'):
+        """
+        :param path: Путь файла
+        :param stats: Статистика этапов
+        :param encoding: Кодировка файла
+        """
+        self.path = path
+        self.tmp_path = path + '.' + str(os.getpid()) + self.tmp_suffix
+        self.stats = stats
+        self.encoding = encoding
+        self.file = None
+        self.hash = None
+        # записано байт
+        self.nbytes = 0
+        self.elapsed = 0.0
+        # True - файл обновлён, False - содержимое не изменилось,
+        #   None - запись не завершена
+        self.updated = None
+
+    def __enter__(self):
+        self.file = open(self.tmp_path, 'wb', buffering=self.buffer_size)
+        self.hash = hashlib.sha1()
+        self.nbytes = 0
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        start = time.perf_counter()
+        try:
+            self.file.close()
+            if exc_type is not None:
+                os.remove(self.tmp_path)
+            elif self.is_same_content():
+                os.remove(self.tmp_path)
+                self.updated = False
+            else:
+                os.replace(self.tmp_path, self.path)
+                self.updated = True
+        finally:
+            self.elapsed += time.perf_counter() - start
+            self.stats.add('write', self.elapsed, 1, self.nbytes)
+        return False
+
+    def is_same_content(self):
+        """
+        Проверить, совпадает ли записанное содержимое с файлом на диске
+
+        :return: True если файл существует и его содержимое то же
+        """
+        try:
+            if os.path.getsize(self.path) != self.nbytes:
+                return False
+            file_hash = hashlib.sha1()
+            with open(self.path, 'rb') as f:
+                for block in iter(lambda: f.read(self.buffer_size), b''):
+                    file_hash.update(block)
+        except OSError:
+            return False
+        return file_hash.digest() == self.hash.digest()
+
+    def write(self, chunk):
+        """
+        Записать кусок кода
+        """
+        if self.stats.enabled:
+            start = time.perf_counter()
+            self.write_bytes(chunk.encode(self.encoding))
+            self.elapsed += time.perf_counter() - start
+        else:
+            self.write_bytes(chunk.encode(self.encoding))
+
+    def write_bytes(self, data):
+        self.file.write(data)
+        self.hash.update(data)
+        self.nbytes += len(data)
+
+    def write_all(self, chunks):
+        """
+        Записать все куски кода из итерируемого объекта
+        """
+        for chunk in chunks:
+            self.write(chunk)
+
+
 class AspDBTablesGenerator:
     """
     Инкапсулированный функционал генерации .cpp файлов
     """
 
-    def __init__(self, header_file, module_name=''):
+    def __init__(self, header_file, module_name='', use_mmap=False, cache_dir=None, jobs=1,
+                 output_dir='', profile=False, split=False, lazy_init=False, emit_ir=False,
+                 watch=False):
         """
         Инициализировать данные таблиц
 
-        :param header_file: CPP хэдер со структурами данных
+        :param header_file: CPP хэдер со структурами данных либо файл
+            промежуточного представления схемы `*.ir.json`, см. `emit_ir`
+        :param module_name: Имя модуля набора таблиц. Для промежуточного
+            представления по умолчанию - сохранённое в нём имя
+        :param use_mmap: Не читать хэдер целиком, а отобразить его в память.
+            Комментарии удаляются и текст декодируется только для
+            структур ASP_TABLE, что важно для больших хэдеров
+        :param cache_dir: Директория кэша разобранных структур,
+            None - разбирать все структуры заново
+        :param jobs: Число процессов для разбора структур
+        :param output_dir: Директория сгенерированных файлов
+        :param profile: Собирать статистику этапов, см. `get_report`
+        :param split: Генерировать отдельный .cpp файл на каждую таблицу,
+            см. `init_tables_source_split`
+        :param lazy_init: Не создавать объекты таблиц до `main`: коллекции
+            полей и сетапы создания строятся при первом обращении,
+            имена таблиц - constexpr массив std::string_view (C++17)
+        :param emit_ir: Записать также промежуточное представление схемы
+            `<module>_auto.ir.json`, по которому генерация может быть
+            выполнена повторно без разбора хэдера
+        :param watch: Генератор живёт между изменениями хэдера, см.
+            `regenerate`: сгенерированные куски кода таблиц запоминаются
+            и повторно используются для не изменившихся таблиц.
+            `use_mmap` и `cache_dir` при повторной генерации не используются
         """
         self.header_file = header_file
+        # хэдер со структурами, подключаемый сгенерированным кодом
+        self.include_header = header_file
+        self.emit_ir = emit_ir
+        self.split = split
+        self.lazy_init = lazy_init
+        self.watch = watch
+        # статистика этапов разбора и генерации
+        self.stats = cpplite.PhaseStats() if profile else cpplite.NULL_STATS
+        self.jobs = jobs
+        self.output_dir = output_dir
         self.files_suffix = '_auto'
         self.asp_db_interface = 'IDBTables'
         # собственные имена структур/таблиц
@@ -134,25 +667,235 @@ class AspDBTablesGenerator:
         self.db_tables_enum = ''
         # имя реализующего интерфейс IDBTables класса таблиц
         self.db_tables_class = ''
+        # имена cpp кода таблиц, AspDBTableNames по id структуры
+        self.table_names = dict()
+        # открытые на запись файлы, AspDBOutputWriter
+        self.outputs = list()
+        # предупреждение о не генерируемых str2field_* уже выведено
+        self.str2field_warned = False
         if not module_name:
             self.module_name = header_file[: header_file.find('.')]
         else:
             self.module_name = module_name
         self.asp_tables = None
-        with open(self.header_file, 'r') as f:
-            self.asp_tables = aspdb.AspDBCppFile(f.read())
+        # отображение хэдера в память, закрывается после разбора структур
+        self.source_map = None
+        if aspdb.is_schema_ir(self.header_file):
+            self.asp_tables = aspdb.AspDBSchemaFile(self.header_file, stats=self.stats)
+            self.include_header = self.asp_tables.header
+            if not module_name:
+                self.module_name = self.asp_tables.module
+        elif use_mmap:
+            with open(self.header_file, 'rb') as f:
+                # пустой файл отобразить нельзя
+                if os.fstat(f.fileno()).st_size:
+                    self.source_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            source = self.source_map if self.source_map is not None else b''
+            self.asp_tables = aspdb.AspDBCppFile(source, cache_dir=cache_dir, stats=self.stats,
+                                                 lazy=False)
+        else:
+            with open(self.header_file, 'r') as f:
+                with self.stats.phase('read'):
+                    text = f.read()
+            # генератору нужны данные всех таблиц: разбирать структуры сразу,
+            #   внутри замеряемых этапов разбора
+            self.asp_tables = aspdb.AspDBCppFile(text, cache_dir=cache_dir, stats=self.stats,
+                                                 lazy=False)
 
     def get_file_module_name(self):
         return self.module_name + self.files_suffix
 
+    def get_output_path(self, ext):
+        """
+        Получить путь сгенерированного файла
+
+        :param ext: Расширение файла, например '.h'
+        :return: Путь файла в директории `output_dir`
+        """
+        return os.path.join(self.output_dir, self.get_file_module_name() + ext)
+
+    def get_report(self):
+        """
+        Получить отчёт о работе генератора
+
+        :return: Словарь: хэдер, модуль, статистика этапов
+            {этап: {'time': секунды, 'calls': вызовы, 'bytes': байты}},
+            списки обновлённых ('updated') и не изменившихся ('unchanged')
+            файлов. Если статистика не собиралась, словарь этапов пуст
+        """
+        return {'header': self.header_file, 'module': self.module_name,
+                'phases': self.stats.as_dict(),
+                'updated': [out.path for out in self.outputs if out.updated],
+                'unchanged': [out.path for out in self.outputs if out.updated is False]}
+
+    def emit(self, stage, *args):
+        """
+        Выполнить метод генерации cpp кода, учтя его в статистике.
+        Учитывается только время выработки кусков кода, время их записи
+        относится к этапу 'write'
+
+        :param stage: Имя метода, например 'add_defines_h'
+        :param args: Аргументы метода
+        :return: Генератор кусков cpp кода
+        """
+        chunks = getattr(self, stage)(*args)
+        if not self.stats.enabled:
+            return chunks
+        return self.profile_chunks(stage, chunks)
+
+    def profile_chunks(self, stage, chunks):
+        elapsed = 0.0
+        nbytes = 0
+        chunks = iter(chunks)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    chunk = next(chunks)
+                finally:
+                    elapsed += time.perf_counter() - start
+                nbytes += len(chunk.encode())
+                yield chunk
+        except StopIteration:
+            pass
+        finally:
+            self.stats.add(stage, elapsed, 1, nbytes)
+
+    def open_output(self, path):
+        """
+        Открыть сгенерированный файл на запись
+
+        :param path: Путь файла
+        :return: AspDBOutputWriter
+        """
+        out = AspDBOutputWriter(path, self.stats)
+        self.outputs.append(out)
+        return out
+
+    def close_source(self):
+        """
+        Закрыть отображение хэдера в память. Тела структур к этому
+        моменту уже скопированы, повторный разбор исходника невозможен
+
+        :return: Nothing
+        """
+        if self.source_map is not None:
+            self.source_map.close()
+            self.source_map = None
+
     def generate_files(self):
         if self.asp_tables:
-            self.asp_tables.init_structs()
+            try:
+                with self.stats.phase('init_structs'):
+                    self.asp_tables.init_structs(self.jobs)
+            finally:
+                self.close_source()
             self.set_class_name()
             self.tables = self.init_tables()
             # self.update_original_header()
+            self.check_names()
+            if self.emit_ir:
+                self.write_schema_ir()
             self.init_tables_header()
+            if self.split:
+                self.init_tables_source_split()
+                self.remove_table_outputs(self.get_stale_table_outputs())
+            else:
+                self.init_tables_source()
+
+    def update_structs(self, text):
+        """
+        Обновить структуры по изменённому тексту хэдера. Заново ищутся
+        только структуры изменившейся части текста, разбираются лишь те,
+        тела которых изменились, остальные берутся из предыдущего разбора
+        вместе с их именами и сгенерированными кусками кода
+
+        :param text: Новый текст хэдера
+        :return: Пара списков имён изменившихся (в том числе новых)
+            и удалённых таблиц
+        """
+        # как и при первой генерации, тела разбираются сразу: предупреждения
+        #   разбора выводятся до генерации, а не при первом обращении
+        asp_tables = aspdb.AspDBCppFile(text, stats=self.stats, lazy=False)
+        kept = set(id(struct) for struct in self.asp_tables.cpp_structs)
+        with self.stats.phase('init_structs'):
+            asp_tables.init_structs_from(self.asp_tables)
+        kept.intersection_update(id(struct) for struct in asp_tables.cpp_structs)
+        previous = dict()
+        for struct in self.asp_tables.cpp_structs:
+            if id(struct) not in kept:
+                previous.setdefault(struct.get_name(), list()).append(struct)
+        changed = list()
+        for i, struct in enumerate(asp_tables.cpp_structs):
+            if id(struct) in kept:
+                continue
+            source = struct.source
+            same = [old for old in previous.get(struct.get_name(), ()) if old.source == source]
+            if not same:
+                changed.append(struct.get_name())
+                continue
+            old = same[0]
+            previous[old.get_name()].remove(old)
+            # позиции директив отсчитываются от начала тела, так что
+            #   старую структуру можно перенести в новый текст
+            old.text, old.span = struct.text, struct.span
+            asp_tables.cpp_structs[i] = old
+        names = set(struct.get_name() for struct in asp_tables.cpp_structs)
+        removed = [name for name, structs in previous.items() if structs and name not in names]
+        self.asp_tables = asp_tables
+        self.table_names = {id(struct): self.table_names[id(struct)]
+                            for struct in asp_tables.cpp_structs if id(struct) in self.table_names}
+        return changed, removed
+
+    def regenerate(self):
+        """
+        Повторно сгенерировать файлы после изменения хэдера. Заново
+        разбираются и генерируются только изменившиеся таблицы, файлы
+        переписываются, только если их содержимое изменилось. В режиме
+        `split` файлы не изменившихся таблиц не генерируются, файлы
+        удалённых таблиц удаляются.
+        `use_mmap` и `cache_dir` действуют только на первую генерацию:
+        изменённый хэдер читается целиком - новые структуры являются
+        срезами его текста, по которым находится изменившаяся часть
+        при следующем изменении, структуры из кэша и bytes-like
+        исходника таких срезов не имеют
+
+        :return: Пара списков имён изменившихся и удалённых таблиц,
+            оба пусты, если структуры таблиц не изменились
+        :raise BaseException: если генерация идёт по промежуточному
+            представлению схемы, а не по хэдеру
+        """
+        if aspdb.is_schema_ir(self.header_file):
+            raise BaseException('Cannot watch schema IR ' + self.header_file +
+                                ', regenerate from the C++ header')
+        with open(self.header_file, 'r') as f:
+            with self.stats.phase('read'):
+                text = f.read()
+        changed, removed = self.update_structs(text)
+        order_changed = self.init_tables() != self.tables
+        if not changed and not removed and not order_changed:
+            return changed, removed
+        self.check_names()
+        self.outputs = list()
+        self.tables = self.init_tables()
+        if self.emit_ir:
+            self.write_schema_ir()
+        self.init_tables_header()
+        if not self.split:
             self.init_tables_source()
+            return changed, removed
+        self.init_tables_source_split([struct for struct in self.asp_tables.cpp_structs
+                                       if struct.get_name() in changed])
+        self.remove_table_outputs(removed)
+        return changed, removed
+
+    def write_schema_ir(self):
+        """
+        Записать промежуточное представление схемы `<module>_auto.ir.json`
+        """
+        with self.open_output(self.get_output_path(aspdb.SCHEMA_IR_EXT)) as out:
+            out.write_all(aspdb.AspDBSchemaFile.iter_dump(
+                self.asp_tables.cpp_structs, self.include_header, self.module_name))
 
     def update_original_header(self):
         """
@@ -174,6 +917,72 @@ class AspDBTablesGenerator:
                 tables.append(struct.name)
         return tables
 
+    def get_table_names(self, struct):
+        """
+        Получить имена cpp кода таблицы, посчитав их при первом обращении
+
+        :param struct: AspDBCppStructs
+        :return: AspDBTableNames
+        """
+        names = self.table_names.get(id(struct))
+        if names is None or names.struct is not struct:
+            names = AspDBTableNames(struct)
+            if self.watch:
+                names.sections = dict()
+            self.table_names[id(struct)] = names
+        return names
+
+    def get_section(self, names, key, make):
+        """
+        Получить кусок cpp кода таблицы. В режиме `watch` куски
+        запоминаются, так что при повторной генерации заново строятся
+        только куски изменившихся таблиц
+
+        :param names: AspDBTableNames таблицы
+        :param key: Ключ куска, уникальный для таблицы, обычно имя этапа
+        :param make: Функция без аргументов, строящая текст куска
+        :return: Текст куска
+        """
+        if names.sections is None:
+            return make()
+        text = names.sections.get(key)
+        if text is None:
+            text = names.sections[key] = make()
+        return text
+
+    def iter_table_names(self, structs=None):
+        """
+        :param structs: Список AspDBCppStructs, None - все таблицы
+        :return: Генератор AspDBTableNames таблиц в порядке объявления
+        """
+        for struct in self.asp_tables.cpp_structs if structs is None else structs:
+            yield self.get_table_names(struct)
+
+    def check_names(self):
+        """
+        Проверить, что имена таблиц и полей каждой таблицы не повторяются
+        без учёта регистра: из них строятся дефайны и совершенный хэш
+        поиска по имени. Проверка идёт до записи файлов, так что хэдер
+        без парного .cpp не остаётся
+
+        :return: Nothing
+        :raise ValueError: если имена повторяются
+        """
+        tables = dict()
+        for struct in self.asp_tables.cpp_structs:
+            name = struct.get_name()
+            if name.lower() in tables:
+                raise ValueError('Duplicate table ' + name + ' (first declared as ' +
+                                 tables[name.lower()] + ')')
+            tables[name.lower()] = name
+            fields = dict()
+            for field in self.get_table_names(struct).fields:
+                field_name = field.values['field']
+                if field_name.lower() in fields:
+                    raise ValueError('Table ' + name + ' has duplicate field ' + field_name +
+                                     ' (first declared as ' + fields[field_name.lower()] + ')')
+                fields[field_name.lower()] = field_name
+
     def set_class_name(self):
         """
         Установить имя класса, наследующего от IDBTables
@@ -193,107 +1002,194 @@ class AspDBTablesGenerator:
 
         :return: Nothing
         """
-        # добавить дефайны
-        text = '#ifndef ' + self.module_name.upper() + '_GUARD_H\n'
-        text += '#define ' + self.module_name.upper() + '_GUARD_H\n\n'
-        text += self.add_defines_h()
-        text += self.add_flags_enums()
-        text += self.add_data_structs_h()
-        text += self.add_template_specification_h()
-        text += '#endif  // !' + self.module_name.upper() + '_GUARD_H\n'
-        with open(self.get_file_module_name() + '.h', 'w') as f:
-            f.write(text)
+        with self.open_output(self.get_output_path('.h')) as out:
+            # добавить дефайны
+            out.write('#ifndef ' + self.module_name.upper() + '_GUARD_H\n')
+            out.write('#define ' + self.module_name.upper() + '_GUARD_H\n\n')
+            out.write_all(self.emit('add_defines_h'))
+            out.write_all(self.emit('add_flags_enums'))
+            out.write_all(self.emit('add_data_structs_h'))
+            out.write_all(self.emit('add_template_specification_h'))
+            out.write_all(self.emit('add_field_lookup_h'))
+            if self.split:
+                out.write_all(self.emit('add_extern_objects_h'))
+            out.write('#endif  // !' + self.module_name.upper() + '_GUARD_H\n')
+
+    def add_extern_objects_h(self):
+        """
+        Добавить объявления объектов таблиц, определённых в .cpp файлах
+        таблиц и используемых общим .cpp файлом
+
+        :return: Генератор кусков cpp кода
+        """
+        yield '\n/* table objects */\n'
+        template = T_TABLE_OBJECT_GETTERS if self.lazy_init else T_EXTERN_TABLE_OBJECTS
+        for names in self.iter_table_names():
+            yield template.fill(names.values)
+        yield '\n'
 
     def add_defines_h(self):
         """
         Добавить дефайны таблиц и полей таблиц
 
-        :return: cpp код
+        :return: Генератор кусков cpp кода
         """
-        # общая текстовая строка
-        text = ''
-        # строка имён полей
-        field_names = ''
-        if self.asp_tables:
-            for i, struct in enumerate(self.asp_tables.cpp_structs):
-                table = struct.name.upper()
-                text += '\n/* table: ' + table + ' */\n'
-                for j, field in enumerate(struct.fields):
-                    # добавим дефайн на поле таблицы
-                    text += '#define ' + get_field_define(table, field.get_name()) +\
-                            ' (' + get_table_define(table) + ' | ' + format(j + 1, '#06x') + ')\n'
-                    field_names += '#define ' + get_field_define(table, field.get_name()) +\
-                                   '_NAME' + ' ' + '"' + field.get_name().lower() + '"\n'
-                fields_count = len(struct.fields)
-                for k, ref in enumerate(struct.foreign_refs):
-                    text += '#define ' + get_field_define(table, ref.field.get_name()) + \
-                            ' (' + get_table_define(table) + ' | ' + format(k + 1 + fields_count, '#06x') + ')\n'
-                    field_names += '#define ' + get_field_define(table, ref.field.get_name()) + \
-                                   '_NAME' + ' ' + '"' + ref.field.get_name().lower() + '"\n'
-            tables_defs = ''
-            for i, table in enumerate(self.tables):
-                tables_defs += '#define ' + get_table_define(table) + ' ' +\
-                               format((i + 1) * pow(2, 16), '#010x') + '\n'
-            text = tables_defs + '\n' + text
-            text += '\n' + field_names + '\n'
-        return text
+        if not self.asp_tables:
+            return
+        for i, table in enumerate(self.tables):
+            yield T_DEFINE.fill(define=get_table_define(table),
+                                value=format((i + 1) * pow(2, 16), '#010x'))
+        yield '\n'
+        for names in self.iter_table_names():
+            yield self.get_section(names, 'add_defines_h', lambda: (
+                T_TABLE_COMMENT.fill(names.values) +
+                ''.join(T_DEFINE.fill(field.values) for field in names.fields)))
+        yield '\n'
+        # строки имён полей
+        for names in self.iter_table_names():
+            yield self.get_section(names, 'add_defines_h.names', lambda: ''.join(
+                T_FIELD_NAME_DEFINE.fill(field.values) for field in names.fields))
+        yield '\n'
 
     def add_flags_enums(self):
         """
         Добавить enum с флагами
         :return:
         """
-        text = '\n'
-        for struct in self.asp_tables.cpp_structs:
-            text += AspDBTableText(struct).enum_as_text()
-        return text
+        yield '\n'
+        for names in self.iter_table_names():
+            yield self.get_section(names, 'add_flags_enums',
+                                   lambda: AspDBTableText(names.struct).enum_as_text())
 
     def add_data_structs_h(self):
         """
         Добавить enum и класс-наследник IDBTables
 
-        :return: cpp код
+        :return: Генератор кусков cpp кода
         """
-        text = '\n'
+        yield '\n'
         # enum таблиц
-        text += 'enum ' + self.db_tables_enum + ' {\n'
-        text += '  table_undefined = UNDEFINED_TABLE'
-        for i, table in enumerate(self.tables):
-            text += ',\n' + '  ' + get_table_enum(table) + ' = ' + get_table_define(table) + ' >> 16'
-        text += '\n};\n\n'
-        text += 'class ' + self.db_tables_class + ' final: public ' + self.asp_db_interface + ' {\n'
+        yield 'enum ' + self.db_tables_enum + ' {\n'
+        yield '  table_undefined = UNDEFINED_TABLE'
+        for names in self.iter_table_names():
+            yield T_TABLE_ENUM.fill(names.values)
+        yield '\n};\n\n'
+        text = 'class ' + self.db_tables_class + ' final: public ' + self.asp_db_interface + ' {\n'
         text += '  std::string GetTableName(db_table t) const override;\n'
         text += '  const db_fields_collection *GetFieldsCollection(db_table t) const override;\n'
         text += '  db_table StrToTableCode(const std::string &tname) const override;\n'
         text += '  std::string GetIdColumnName(db_table dt) const override;\n'
         text += '  const db_table_create_setup &CreateSetupByCode(db_table dt) const override;\n'
+        text += '\n'
+        text += ' public:\n'
+        text += '  /* уровни создания таблиц по внешним ключам: таблицы уровня ссылаются\n'
+        text += '   *   только на таблицы предыдущих уровней и могут создаваться\n'
+        text += '   *   параллельно, удаляться - в обратном порядке уровней */\n'
+        text += '  size_t GetCreateLevelsCount() const;\n'
+        text += '  std::vector<db_table> GetCreateLevel(size_t level) const;\n'
+        text += '  using ' + self.asp_db_interface + '::setInsertValues;\n'
+        text += '  /* добавить строки диапазона в один сетап добавления */\n'
+        text += '  template <class T>\n'
+        text += '  void setInsertValues(db_query_insert_setup *src, const T *begin, const T *end) const;\n'
+        text += '  template <class T>\n'
+        text += '  void setInsertValues(db_query_insert_setup *src, const std::vector<T> &rows) const {\n'
+        text += '    setInsertValues(src, rows.data(), rows.data() + rows.size());\n'
+        text += '  }\n'
+        text += '  /* разобрать строки результата по одной, не накапливая их */\n'
+        text += '  template <class T>\n'
+        text += '  void VisitSelectData(db_query_select_result *src,\n'
+        text += '      const std::function<void(const T &)> &visitor) const;\n'
         text += '};\n'
-        return text
+        yield text
 
     def add_template_specification_h(self):
         """
         Добавить специализацию шаблонов
         :return:
         """
-        text = '\n/* GetTableName */\n'
-        for table in self.tables:
-            text += 'template<>\n' \
-                    'std::string ' + self.asp_db_interface + '::GetTableName<' + table + '>() const;\n'
-        text += '\n/* GetTableCode */\n'
-        for table in self.tables:
-            text += 'template<>\n' \
-                    'db_table ' + self.asp_db_interface + '::GetTableCode<' + table + '>() const;\n'
-        text += '\n/* setInsertValues */\n'
+        for title, template in (('GetTableName', T_SPEC_GET_TABLE_NAME),
+                                ('GetTableCode', T_SPEC_GET_TABLE_CODE),
+                                ('setInsertValues', T_SPEC_SET_INSERT_VALUES),
+                                ('SetSelectData', T_SPEC_SET_SELECT_DATA)):
+            yield '\n/* ' + title + ' */\n'
+            for table in self.tables:
+                yield template.fill(interface=self.asp_db_interface, name=table)
+        yield '\n/* setInsertValues range */\n'
         for table in self.tables:
-            text += 'template<>\n' \
-                    'void ' + self.asp_db_interface + '::setInsertValues<' + table + '>(\n' \
-                    '    db_query_insert_setup *src, const ' + table + ' &select_data) const;\n'
-        text += '\n/* SetSelectData */\n'
+            yield T_SPEC_SET_INSERT_VALUES_RANGE.fill({'class': self.db_tables_class}, name=table)
+        yield '\n/* VisitSelectData */\n'
         for table in self.tables:
-            text += 'template<>\n' \
-                    'void ' + self.asp_db_interface + '::SetSelectData<' + table + '>(\n' \
-                    '    db_query_select_result *src, std::vector<' + table + '> *out_vec) const;\n'
-        return text + '\n'
+            yield T_SPEC_VISIT_SELECT_DATA.fill({'class': self.db_tables_class}, name=table)
+        yield '\n'
+
+    def get_table_output_path(self, table):
+        """
+        Получить путь .cpp файла таблицы в режиме `split`
+
+        :param table: Имя таблицы
+        :return: Путь файла в директории `output_dir`
+        """
+        return os.path.join(self.output_dir, self.get_file_module_name() + '_' + table + '.cpp')
+
+    def get_stale_table_outputs(self):
+        """
+        Найти в `output_dir` .cpp файлы таблиц модуля, которых больше нет
+        в хэдере. Файлом таблицы модуля считается только файл, подключающий
+        хэдер модуля: файлы другого модуля с похожим именем не затрагиваются
+
+        :return: Список имён таблиц
+        """
+        prefix = self.get_file_module_name() + '_'
+        include = '#include "' + os.path.basename(self.get_output_path('.h')) + '"\n'
+        tables = set(struct.get_name() for struct in self.asp_tables.cpp_structs)
+        stale = list()
+        try:
+            files = sorted(os.listdir(self.output_dir or '.'))
+        except OSError:
+            return stale
+        for name in files:
+            if not name.startswith(prefix) or not name.endswith('.cpp'):
+                continue
+            table = name[len(prefix): -len('.cpp')]
+            if table in tables:
+                continue
+            try:
+                with open(os.path.join(self.output_dir, name), 'r') as f:
+                    if f.readline() == include:
+                        stale.append(table)
+            except (OSError, UnicodeDecodeError):
+                continue
+        return stale
+
+    def remove_table_outputs(self, tables):
+        """
+        Удалить .cpp файлы таблиц режима `split`
+
+        :param tables: Имена таблиц
+        :return: Nothing
+        """
+        for table in tables:
+            path = self.get_table_output_path(table)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def get_source_includes(self):
+        """
+        :return: Подключаемые в .cpp файлы хэдеры
+        """
+        # .cpp и .h генерируются в одну директорию
+        text = '#include "' + os.path.basename(self.get_output_path('.h')) + '"\n\n'
+        text += '#include "' + self.include_header + '"\n'
+        text += '#include "db_connection_manager.h"\n\n'
+        text += '#include <cstdint>\n'
+        text += '#include <functional>\n'
+        text += '#include <map>\n'
+        text += '#include <memory>\n'
+        text += '#include <vector>\n'
+        if self.lazy_init:
+            text += '#include <string_view>\n'
+        text += '\n\n'
+        return text
 
     def init_tables_source(self):
         """
@@ -301,64 +1197,112 @@ class AspDBTablesGenerator:
 
         :return:
         """
-        text = '#include ' + self.module_name + '.h\n\n'
-        text += '#include ' + self.header_file + '\n'
-        text += '#include "db_connection_manager.h"\n\n'
-        text += '#include <map>\n'
-        text += '#include <memory>\n\n\n'
-        text += self.add_str_tables()
-        for struct in self.asp_tables.cpp_structs:
-            text += self.add_table_fields(struct)
-        text += self.add_get_field_collection()
-        text += self.add_get_id_colname()
-        text += self.add_create_setup()
-        text += self.add_get_table_name()
-        text += self.add_get_table_code()
-        text += self.add_field2str_functions()
-        text += self.add_str2field_functions()
-        text += self.add_set_insert_values()
-        text += self.add_set_select_data()
-        with open(self.get_file_module_name() + '.cpp', 'w') as f:
-            f.write(text)
+        with self.open_output(self.get_output_path('.cpp')) as out:
+            out.write(self.get_source_includes())
+            out.write_all(self.emit('add_name_hash_functions'))
+            out.write_all(self.emit('add_str_tables'))
+            for struct in self.asp_tables.cpp_structs:
+                out.write_all(self.emit('add_table_fields', struct))
+            out.write_all(self.emit('add_get_field_collection'))
+            out.write_all(self.emit('add_get_id_colname'))
+            out.write_all(self.emit('add_create_setup'))
+            out.write_all(self.emit('add_create_levels'))
+            out.write_all(self.emit('add_get_table_name'))
+            out.write_all(self.emit('add_get_table_code'))
+            out.write_all(self.emit('add_field2str_functions'))
+            out.write_all(self.emit('add_str2field_functions'))
+            out.write_all(self.emit('add_set_insert_values'))
+            out.write_all(self.emit('add_set_insert_values_range'))
+            out.write_all(self.emit('add_set_select_data'))
+            out.write_all(self.emit('add_visit_select_data'))
+            out.write_all(self.emit('add_field_lookup'))
+
+    def init_tables_source_split(self, structs=None):
+        """
+        Инициализировать cpp файлы таблиц по файлу на таблицу.
+        Общий .cpp файл содержит диспетчеризацию по коду таблицы,
+        файл таблицы - её поля, сетап создания и функции преобразования
+        данных. Изменение одной таблицы меняет только её файл и хэдер
+
+        :param structs: Список AspDBCppStructs, файлы которых нужно
+            сгенерировать, None - все таблицы
+        :return:
+        """
+        with self.open_output(self.get_output_path('.cpp')) as out:
+            out.write(self.get_source_includes())
+            out.write_all(self.emit('add_name_hash_functions'))
+            out.write_all(self.emit('add_str_tables'))
+            out.write_all(self.emit('add_get_field_collection'))
+            out.write_all(self.emit('add_get_id_colname'))
+            out.write_all(self.emit('add_create_setup'))
+            out.write_all(self.emit('add_create_levels'))
+            out.write_all(self.emit('add_get_table_name'))
+            out.write_all(self.emit('add_get_table_code'))
+        for struct in self.asp_tables.cpp_structs if structs is None else structs:
+            table_structs = [struct]
+            with self.open_output(self.get_table_output_path(struct.get_name())) as out:
+                out.write(self.get_source_includes())
+                out.write_all(self.emit('add_name_hash_functions'))
+                # объекты таблицы объявлены в хэдере и видны общему файлу
+                out.write_all(self.emit('add_table_fields', struct, ''))
+                out.write_all(self.emit('add_field2str_functions', table_structs))
+                out.write_all(self.emit('add_str2field_functions', table_structs))
+                out.write_all(self.emit('add_set_insert_values', table_structs))
+                out.write_all(self.emit('add_set_insert_values_range', table_structs))
+                out.write_all(self.emit('add_set_select_data', table_structs))
+                out.write_all(self.emit('add_visit_select_data', table_structs))
+                out.write_all(self.emit('add_field_lookup', table_structs))
+
+    def get_tables_array_size(self):
+        """
+        :return: Размер массивов, индексируемых enum таблицы
+        """
+        return len(self.asp_tables.cpp_structs) + 1
 
     def add_get_field_collection(self):
-        text = '\nconst db_fields_collection *' + self.db_tables_class + '::GetFieldsCollection(db_table dt) const {\n'
-        text += '  const db_fields_collection *result = nullptr;\n'
-        text += '  switch(dt) {\n'
-        for struct in self.asp_tables.cpp_structs:
-            text += '    case ' + get_table_enum(struct.get_name()) + ':\n'
-            text += '      result = &' + get_table_fields(struct.get_name()) + ';\n'
-            text += '      break;\n'
-        text += '    case table_undefined:\n'
-        text += '    default:\n'
-        text += '      throw DBException(ERROR_DB_TABLE_EXISTS, "Неизвестный код таблицы");\n'
-        text += '  }\n'
-        text += '  return result;\n'
+        """
+        Прописать функцию возвращающую коллекцию полей таблицы
+        `GetFieldsCollection`: загрузка из массива по коду таблицы
+
+        :return: Генератор кусков cpp кода
+        """
+        yield '\nconst db_fields_collection *' + self.db_tables_class + '::GetFieldsCollection(db_table dt) const {\n'
+        if self.lazy_init:
+            yield '  static constexpr const db_fields_collection &(*fields_collections[' + \
+                  str(self.get_tables_array_size()) + '])() = {\n'
+        else:
+            yield '  static constexpr const db_fields_collection *fields_collections[' + \
+                  str(self.get_tables_array_size()) + '] = {\n'
+        yield '    nullptr,\n'
+        for names in self.iter_table_names():
+            yield T_FIELDS_COLLECTIONS_ENTRY.fill(names.values)
+        text = '  };\n'
+        text += '  size_t i = static_cast<size_t>(dt);\n'
+        text += '  if (i == 0 || i >= ' + str(self.get_tables_array_size()) + ')\n'
+        text += '    throw DBException(ERROR_DB_TABLE_EXISTS, "Неизвестный код таблицы");\n'
+        text += '  return &fields_collections[i]();\n' if self.lazy_init else \
+            '  return fields_collections[i];\n'
         text += '}\n'
-        return text
+        yield text
 
     def add_get_id_colname(self):
         """
-        Прописать функцию возвращающую имя столбца хранящего id таблицы
+        Прописать функцию возвращающую имя столбца хранящего id таблицы.
+        Для таблиц без столбца id и неизвестных кодов - пустая строка
 
         :return: cpp код метода GetIdColumnName
         """
-        text = '\n'
-        text += 'std::string ' + self.db_tables_class + '::GetIdColumnName(db_table dt) const {\n'
-        text += '  std::string name = "";\n'
-        text += '  switch (dt) {\n'
-        for struct in self.asp_tables.cpp_structs:
-            fields = [f.get_name() for f in struct.fields]
-            if 'id' in fields:
-                text += '    case ' + get_table_enum(struct.get_name()) + ':\n'
-                text += '      name = TABLE_FIELD_NAME(' + get_field_define(struct.get_name(), 'id') + ');\n'
-                text += '      break;\n'
-
-        text += '    case default: break;\n'
-        text += '  }\n'
-        text += '  return name;\n'
+        yield '\n'
+        yield 'std::string ' + self.db_tables_class + '::GetIdColumnName(db_table dt) const {\n'
+        yield '  static constexpr const char *id_columns[' + str(self.get_tables_array_size()) + '] = {\n'
+        yield '    "",\n'
+        for names in self.iter_table_names():
+            yield T_ID_COLUMNS_ENTRY.fill(names.values) if names.has_id else '    "",\n'
+        text = '  };\n'
+        text += '  size_t i = static_cast<size_t>(dt);\n'
+        text += '  return (i < ' + str(self.get_tables_array_size()) + ') ? id_columns[i] : "";\n'
         text += '}\n'
-        return text
+        yield text
 
     def add_create_setup(self):
         """
@@ -366,17 +1310,55 @@ class AspDBTablesGenerator:
 
         :return: cpp код метода CreateSetupByCode
         """
-        text = 'const db_table_create_setup &' + self.db_tables_class + '::CreateSetupByCode(db_table dt) const {\n'
-        text += '  switch (dt) {\n'
-        for struct in self.asp_tables.cpp_structs:
-            text += '    case ' + get_table_enum(struct.get_name()) + ':\n'
-            text += '      return ' + get_create_setup(struct.get_name()) + ';\n'
-        text += '    case table_undefined:\n'
-        text += '    default:\n'
-        text += '      throw DBException(ERROR_DB_TABLE_EXISTS, "Undefined table");\n'
-        text += '  }\n'
+        yield 'const db_table_create_setup &' + self.db_tables_class + '::CreateSetupByCode(db_table dt) const {\n'
+        if self.lazy_init:
+            yield '  static constexpr const db_table_create_setup &(*create_setups[' + \
+                  str(self.get_tables_array_size()) + '])() = {\n'
+        else:
+            yield '  static constexpr const db_table_create_setup *create_setups[' + \
+                  str(self.get_tables_array_size()) + '] = {\n'
+        yield '    nullptr,\n'
+        for names in self.iter_table_names():
+            yield T_CREATE_SETUPS_ENTRY.fill(names.values)
+        text = '  };\n'
+        text += '  size_t i = static_cast<size_t>(dt);\n'
+        text += '  if (i == 0 || i >= ' + str(self.get_tables_array_size()) + ')\n'
+        text += '    throw DBException(ERROR_DB_TABLE_EXISTS, "Undefined table");\n'
+        text += '  return create_setups[i]();\n' if self.lazy_init else \
+            '  return *create_setups[i];\n'
         text += '}\n'
-        return text
+        yield text
+
+    def add_create_levels(self):
+        """
+        Прописать уровни создания таблиц по графу внешних ключей,
+        см. AspDBReferenceGraph, и методы доступа к ним
+        `GetCreateLevelsCount`, `GetCreateLevel`
+
+        :return: Генератор кусков cpp кода
+        """
+        graph = aspdb.AspDBReferenceGraph(self.asp_tables.cpp_structs)
+        tables = [name for level in graph.levels for name in level]
+        bounds = [0]
+        for level in graph.levels:
+            bounds.append(bounds[-1] + len(level))
+        yield '\n/* уровни создания таблиц */\n'
+        # по строке на уровень
+        yield 'static constexpr db_table create_level_tables[' + str(max(1, len(tables))) + '] = {\n' + \
+              (',\n'.join('  ' + ', '.join(get_table_enum(name) for name in level)
+                          for level in graph.levels) or '  table_undefined') + '\n};\n'
+        yield 'static constexpr size_t create_level_bounds[' + str(len(bounds)) + '] = {' + \
+              ', '.join(str(bound) for bound in bounds) + '};\n\n'
+        text = 'size_t ' + self.db_tables_class + '::GetCreateLevelsCount() const {\n'
+        text += '  return ' + str(len(graph.levels)) + ';\n'
+        text += '}\n\n'
+        text += 'std::vector<db_table> ' + self.db_tables_class + '::GetCreateLevel(size_t level) const {\n'
+        text += '  if (level >= ' + str(len(graph.levels)) + ')\n'
+        text += '    return std::vector<db_table>();\n'
+        text += '  return std::vector<db_table>(create_level_tables + create_level_bounds[level],\n'
+        text += '                               create_level_tables + create_level_bounds[level + 1]);\n'
+        text += '}\n'
+        yield text
 
     def add_get_table_name(self):
         """
@@ -384,14 +1366,9 @@ class AspDBTablesGenerator:
 
         :return: cpp код методов template<> IDBTables::GetTableName
         """
-        text = '\n'
-        for struct in self.asp_tables.cpp_structs:
-            text += 'template <>\n'
-            text += 'std::string IDBTables::GetTableName<' + struct.get_name() + '>() const {\n'
-            text += '  auto x = str_tables.find(' + get_table_enum(struct.get_name()) + ');\n'
-            text += '  return (x != str_tables.end()) ? x->second : "";\n'
-            text += '}\n'
-        return text
+        yield '\n'
+        for names in self.iter_table_names():
+            yield T_GET_TABLE_NAME.fill(names.values)
 
     def add_get_table_code(self):
         """
@@ -399,15 +1376,11 @@ class AspDBTablesGenerator:
 
         :return: cpp код методов template<> IDBTables::GetTableCode
         """
-        text = '\n'
-        for struct in self.asp_tables.cpp_structs:
-            text += 'template <>\n'
-            text += 'db_table IDBTables::GetTableCode<' + struct.get_name() + '>() const {\n'
-            text += '  return ' + get_table_enum(struct.get_name()) + ';\n'
-            text += '}\n'
-        return text
+        yield '\n'
+        for names in self.iter_table_names():
+            yield T_GET_TABLE_CODE.fill(names.values)
 
-    def add_field2str_functions(self):
+    def add_field2str_functions(self, structs=None):
         """
         Собрать функции преобразования полей таблиц к их строковым
         представлениям.
@@ -415,186 +1388,501 @@ class AspDBTablesGenerator:
         Для особых полей особые обработчики, зарегистрированные в хэддере
         конфигурации таблицы.
 
-        :return: cpp код
+        :param structs: Список AspDBCppStructs, None - все таблицы
+        :return: Генератор кусков cpp кода
         """
-        text = '\n'
-        for struct in self.asp_tables.cpp_structs:
-            default_case = ''
-            cp_case = ''
-            text += 'std::string field2str_' + struct.get_name() + '(' + get_table_flags(struct.get_name()) + \
-                    ' flag, const ' + struct.get_name() + ' &select_data) const {\n'
-            text += '  std::string result;\n'
-            text += '  switch (flag) {\n'
-            for field in struct.fields:
-                case = self.get_field2str_text(struct.get_name(), field)
-                cp_case += case[0]
-                default_case += case[1]
-            for ref in struct.foreign_refs:
-                case = self.get_field2str_text(struct.get_name(), ref.field)
-                cp_case += case[0]
-                default_case += case[1]
-            text += cp_case
-            text += default_case
-            text += '    default:\n'
-            text += '      result = field2str(select_data);\n'
-            text += '  }\n'
-            text += 'return result;\n'
-            text += '}\n'
-        return text
+        yield '\n'
+        for names in self.iter_table_names(structs):
+            yield self.get_section(names, 'add_field2str_functions',
+                                   lambda: self.get_table_field2str_text(names))
 
-    def get_field2str_text(self, table_name, field):
+    def get_table_field2str_text(self, names):
         """
-        Получить текстовое представление функции конвертации поля к строке
+        Получить функцию преобразования полей таблицы к строкам
 
-        :return:
+        :param names: AspDBTableNames
+        :return: cpp код функции
         """
-        cp_case = ''
         default_case = ''
-        if field.to_str:
-            # особая обработка
-            cp_case = '    case ' + get_field_flag(table_name, field.get_name()) + ':\n'
-            cp_case += '      result = ' + field.to_str + '(select_data);\n'
-            cp_case += '      break;\n'
-        else:
-            # прокинуть на дефолтную обработку
-            default_case = '    case ' + get_field_flag(table_name, field.get_name()) + ':\n'
-        return [cp_case, default_case]
+        cp_case = ''
+        for field in names.fields:
+            case = self.get_field2str_text(field)
+            cp_case += case[0]
+            default_case += case[1]
+        return T_FIELD2STR_HEAD.fill(names.values) + cp_case + default_case + \
+            T_FIELD2STR_TAIL.text
+
+    def get_field2str_text(self, field):
+        """
+        Получить текстовое представление функции конвертации поля к строке
 
-    def add_str2field_functions(self):
+        :param field: AspDBFieldNames
+        :return: [особая обработка, дефолтная обработка]
         """
-        Функция обратная `add_field2str_functions` - строки конвертирует в поля
+        if field.field.to_str:
+            # особая обработка
+            return [T_FIELD2STR_CASE.fill(field.values), '']
+        # прокинуть на дефолтную обработку
+        return ['', T_FIELD2STR_DEFAULT_CASE.fill(field.values)]
+
+    def add_str2field_functions(self, structs=None):
         """
-        raise Exception
+        Функция обратная `add_field2str_functions` - строки конвертирует в поля.
+        Пока не генерируется: `str2field_<table>` должны быть объявлены
+        в хэдере со структурами, генерация не прерывается
 
-    def add_set_insert_values(self):
+        :param structs: Список AspDBCppStructs, None - все таблицы
+        :return: Генератор кусков cpp кода
+        """
+        if not self.str2field_warned:
+            self.str2field_warned = True
+            print('Warning: str2field_* functions are not generated, '
+                  'declare them in ' + self.include_header)
+        for struct in self.asp_tables.cpp_structs if structs is None else structs:
+            yield '// str2field_' + struct.get_name() + ' is not generated\n'
+
+    def add_set_insert_values(self, structs=None):
         """
         Прописать перегруженные шаблоны методы заполняющие сетап добавления
 
-        :return:
+        :param structs: Список AspDBCppStructs, None - все таблицы
+        :return: Генератор кусков cpp кода
         """
-        text = '\n'
-        for struct in self.asp_tables.cpp_structs:
-            text += 'template <>\n'
-            text += 'void IDBTables::setInsertValues<' + get_table_enum(struct.get_name()) +\
-                    '>(db_query_insert_setup *src,\n'
-            text += '    const ' + struct.get_name() + ' &select_data) const {\n'
-            text += '  if (select_data.initialized == 0x00)\n'
-            text += '    return;\n'
-            text += '  db_query_basesetup::row_values values;\n'
-            text += '  db_query_basesetup::field_index i;\n'
-            for field in struct.fields:
-                text += '  insert_macro(' + get_field_flag(struct.get_name(), field.get_name()) + ', ' +\
-                        get_field_define(struct.get_name(), field.get_name()) + ', field2str_' + struct.get_name() +\
-                        '(' + get_field_flag(struct.get_name(), field.get_name()) + ', select_data));\n'
-            for ref in struct.foreign_refs:
-                text += '  insert_macro(' + get_field_flag(struct.get_name(), ref.field.get_name()) + ', ' + \
-                        get_field_define(struct.get_name(), ref.field.get_name()) + ', field2str_' + struct.get_name() + \
-                        '(' + get_field_flag(struct.get_name(), ref.field.get_name()) + ', select_data));\n'
-            text += '  src->values_vec.emplace_back(values);\n'
-            text += '}\n'
-        return text
+        yield '\n'
+        for names in self.iter_table_names(structs):
+            yield self.get_section(names, 'add_set_insert_values', lambda: (
+                T_INSERT_VALUES_HEAD.fill(names.values) +
+                ''.join(T_INSERT_VALUES_FIELD.fill(field.values) for field in names.fields) +
+                T_INSERT_VALUES_TAIL.text))
+
+    def add_set_insert_values_range(self, structs=None):
+        """
+        Прописать методы заполняющие сетап добавления строками диапазона:
+        место под строки резервируется заранее, буферы строки
+        переиспользуются, все строки попадают в один запрос
 
-    def add_set_select_data(self):
+        :param structs: Список AspDBCppStructs, None - все таблицы
+        :return: Генератор кусков cpp кода
         """
-        Добавить спецификации шаблонных методов `SetSelectData`
+        yield '\n'
+        for names in self.iter_table_names(structs):
+            yield self.get_section(names, 'add_set_insert_values_range', lambda: (
+                T_INSERT_VALUES_RANGE_HEAD.fill(names.values, **{'class': self.db_tables_class}) +
+                ''.join(T_INSERT_VALUES_RANGE_FIELD.fill(field.values) for field in names.fields) +
+                T_INSERT_VALUES_RANGE_TAIL.text))
+
+    def add_set_select_data(self, structs=None):
+        """
+        Добавить спецификации шаблонных методов `SetSelectData`.
+        Имена столбцов набора результатов переводятся в номера полей
+        таблицы один раз, через `StrToFieldDefine_<table>`, строки
+        разбираются переходом по номеру поля
 
-        :return: cpp код
+        :param structs: Список AspDBCppStructs, None - все таблицы
+        :return: Генератор кусков cpp кода
         """
-        text = '\n'
-        for struct in self.asp_tables.cpp_structs:
-            text += 'template<>\n'
-            # TODO: ??? да почему опять вектор-то, а не итераторы??
-            #   хотя здесь терпимо
-            text += 'void IDBTables::SetSelectData<' + struct.get_name() + '>(db_query_select_result *src,\n' +\
-                    '    std::vector<' + struct.get_name() + '> *out_vec) const {\n'
-            text += '  for (auto &row: src->values) {\n'
-            # TODO: тут дефолтный конструктор ттаблицы БД - не гибко
-            text += '    ' + struct.get_name() + ' tmp;\n'
-            text += '    for (auto &col: row) {\n'
-            text += '      if (0) {/*(sorry)*/\n'
-            for field in struct.fields:
-                text += '      } else if {\n'
-                text += '        select_macro(' + get_field_flag(struct.get_name(), field.get_name()) + ', ' + \
-                        get_field_define(struct.get_name(), field.get_name()) + ', str2field_' + struct.get_name() + \
-                        '(' + get_field_flag(struct.get_name(), field.get_name()) + ', col.second));\n'
-            for ref in struct.foreign_refs:
-                text += '      } else if {\n'
-                text += '        select_macro(' + get_field_flag(struct.get_name(), ref.field.get_name()) + ', ' + \
-                        get_field_define(struct.get_name(), ref.field.get_name()) + ', str2field_' + \
-                        struct.get_name() + '(' + get_field_flag(struct.get_name(), ref.field.get_name()) + \
-                        ', col.second));\n'
-            # закрывающая скобка на последний `else if`
-            text += '      }\n'
-            text += '    }\n'
-            text += '    if (tmp.initialized != ' + get_table_flags(struct.get_name()) + '::f_empty)\n'
-            text += '      out_vec->push_back(std::move(tmp));\n'
-            text += '  }\n'
-            text += '}\n'
+        yield '\n'
+        # результат накапливается в векторе, потоковый вариант без
+        #   накопления - `add_visit_select_data`
+        # TODO: тут дефолтный конструктор ттаблицы БД - не гибко
+        for names in self.iter_table_names(structs):
+            yield self.get_section(names, 'add_set_select_data', lambda: (
+                T_SELECT_DATA_HEAD.fill(names.values) +
+                ''.join(T_SELECT_DATA_FIELD.fill(field.values) for field in names.fields) +
+                T_SELECT_DATA_TAIL.fill(names.values)))
+
+    def add_visit_select_data(self, structs=None):
+        """
+        Добавить методы `VisitSelectData`: строки результата разбираются
+        по одной в одну и ту же структуру, которая передаётся обработчику.
+        В отличие от `SetSelectData` результат не накапливается
+
+        :param structs: Список AspDBCppStructs, None - все таблицы
+        :return: Генератор кусков cpp кода
+        """
+        yield '\n'
+        for names in self.iter_table_names(structs):
+            yield self.get_section(names, 'add_visit_select_data', lambda: (
+                T_VISIT_SELECT_DATA_HEAD.fill(names.values, **{'class': self.db_tables_class}) +
+                ''.join(T_SELECT_DATA_FIELD.fill(field.values) for field in names.fields) +
+                T_VISIT_SELECT_DATA_TAIL.fill(names.values)))
 
     def add_str_tables(self):
-        text = 'static std::map<db_table, std::string> str_tables = {\n'
-        for table in self.tables:
-            text += '  {' + get_table_enum(table) + ', "' + table + '"},\n'
-        text += '};\n\n'
+        """
+        Добавить массив имён таблиц, индексируемый enum таблицы, и методы
+        `GetTableName`, `StrToTableCode`
+
+        :return: Генератор кусков cpp кода
+        """
+        yield 'static constexpr ' + ('std::string_view ' if self.lazy_init else 'const char *') + \
+              'table_names[' + str(self.get_tables_array_size()) + '] = {\n'
+        yield '  "",\n'
+        for names in self.iter_table_names():
+            yield T_TABLE_NAMES_ENTRY.fill(names.values)
+        text = '};\n\n'
         # GetTableName
         text += 'std::string ' + self.db_tables_class + '::GetTableName(db_table t) const {\n'
-        text += '  auto x = str_tables.find(t);\n'
-        text += '  return (x != str_tables.end()) ? x->second: "";\n'
+        text += '  size_t i = static_cast<size_t>(t);\n'
+        text += '  return (i < ' + str(self.get_tables_array_size()) + ') ? std::string(table_names[i]) : "";\n'
         text += '}\n\n'
-        # StrToTableCode
-        text += 'db_table ' + self.db_tables_class + '::StrToTableCode(const std::string &tname) const {\n'
-        text += '  for (const auto &x: str_tables)\n'
-        text += '    if (x.second == tname)\n'
-        text += '      return x.first;\n'
-        text += '  return table_undefined;\n'
-        text += '}\n'
-        return text
+        yield text
+        # StrToTableCode: совершенный хэш по именам таблиц
+        names = [names.values for names in self.iter_table_names()] or \
+            [{'name': '', 'enum': 'table_undefined'}]
+        perfect_hash = AspDBPerfectHash([values['name'] for values in names])
+        yield T_STR_TO_TABLE_CODE.fill(
+            {'class': self.db_tables_class}, size=perfect_hash.size,
+            seeds=', '.join(str(seed) for seed in perfect_hash.seeds),
+            names=perfect_hash.get_array(['"' + values['name'] + '"' for values in names]),
+            codes=perfect_hash.get_array([values['enum'] for values in names]))
+
+    def add_name_hash_functions(self):
+        """
+        Добавить хэш-функцию имён для поиска таблиц и полей по имени
+
+        :return: Генератор кусков cpp кода
+        """
+        yield T_NAME_HASH_FUNCTIONS.fill(offset_basis=AspDBPerfectHash.offset_basis,
+                                         prime=AspDBPerfectHash.prime)
+
+    def add_field_lookup_h(self):
+        """
+        Добавить объявления функций поиска дефайна поля по имени столбца
+
+        :return: Генератор кусков cpp кода
+        """
+        yield '\n/* StrToFieldDefine */\n'
+        for names in self.iter_table_names():
+            yield T_STR_TO_FIELD_DEFINE_H.fill(names.values)
+
+    def add_field_lookup(self, structs=None):
+        """
+        Добавить функции поиска дефайна поля по имени столбца
+        `StrToFieldDefine_<table>`, 0 - столбца в таблице нет
+
+        :param structs: Список AspDBCppStructs, None - все таблицы
+        :return: Генератор кусков cpp кода
+        """
+        yield '\n'
+        for names in self.iter_table_names(structs):
+            yield self.get_section(names, 'add_field_lookup', lambda: self.get_field_lookup_text(names))
+
+    def get_field_lookup_text(self, names):
+        """
+        Получить функцию поиска дефайна поля таблицы по имени столбца
+
+        :param names: AspDBTableNames
+        :return: cpp код функции
+        """
+        fields = [field.values for field in names.fields] or [{'lower': '', 'define': ''}]
+        perfect_hash = AspDBPerfectHash([values['lower'] for values in fields])
+        return T_STR_TO_FIELD_DEFINE.fill(
+            names.values, size=perfect_hash.size,
+            seeds=', '.join(str(seed) for seed in perfect_hash.seeds),
+            names=perfect_hash.get_array(
+                [values['define'] + '_NAME' if values['define'] else '""' for values in fields]),
+            defines=perfect_hash.get_array(
+                [values['define'] if values['define'] else '0' for values in fields]))
+
+    def add_table_fields(self, struct, storage='static '):
+        """
+        Добавить поля таблицы, её уникальные группы, ссылки и сетап создания
+
+        :param struct: AspDBCppStructs
+        :param storage: Класс хранения сетапа создания: 'static ' или ''
+            для объекта, объявленного в хэдере
+        :return: Генератор кусков cpp кода
+        """
+        names = self.get_table_names(struct)
+        yield self.get_section(names, 'add_table_fields.' + storage,
+                               lambda: ''.join(self.iter_table_fields(struct, storage)))
+
+    def iter_table_fields(self, struct, storage):
+        """
+        Собрать поля таблицы, см. `add_table_fields`
+
+        :return: Генератор кусков cpp кода
+        """
+        names = self.get_table_names(struct)
+        if self.lazy_init:
+            yield T_LAZY_FIELDS_COLLECTION_HEAD.fill(names.values, storage=storage) + \
+                ''.join(T_FIELD_VARIABLE.fill(field.values) for field in names.fields) + \
+                T_LAZY_FIELDS_COLLECTION_TAIL.text
+            text = T_LAZY_CREATE_SETUP_HEAD.fill(names.values, storage=storage) + \
+                self.get_uniques_text(struct) + '};\n'
+            if struct.foreign_refs:
+                text += T_LAZY_REFERENCES_HEAD.text + self.get_references_text(struct) + '});\n'
+            yield text + T_LAZY_CREATE_SETUP_TAIL.fill(
+                names.values, references_arg='references' if struct.foreign_refs else 'nullptr')
+            return
 
-    def add_table_fields(self, struct):
         # fields collection
-        fields_name = struct.get_name() + '_fields'
-        text = '\nconst db_fields_collection ' + fields_name + ' = {\n'
-        for field in struct.fields:
-            text += self.add_field_string(struct.get_name(), field)
-        for ref in struct.foreign_refs:
-            text += self.add_field_string(struct.get_name(), ref.field)
-        text += '};\n'
+        yield T_FIELDS_COLLECTION_HEAD.fill(names.values) + \
+            ''.join(T_FIELD_VARIABLE.fill(field.values) for field in names.fields) + '};\n'
 
         # unique
-        unique_name = struct.get_name() + '_uniques'
-        unique_str = 'static const db_table_create_setup::uniques_container ' + \
-                     unique_name + ' = {'
-        if struct.unique:
-            unique_str += '\n  {{ '
-            for field in struct.fields:
-                unique_str += ' TABLE_FIELD_NAME(' + get_field_define(struct.get_name(), field.get_name()) + '),\n'
-            unique_str += '}}\n'
-        text += '\n' + unique_str + '};\n'
+        yield T_UNIQUES_HEAD.fill(names.values) + self.get_uniques_text(struct) + '};\n'
 
         # references
-        ref_name = struct.name + '_references'
         if struct.foreign_refs:
-            ref_str = 'static const std::shared_ptr<db_ref_collection> ' + ref_name + '(\n    new db_ref_collection {'
-            for ref in struct.foreign_refs:
-                ref_str += '\n    db_reference(TABLE_FIELD_NAME(' + ref.field.get_name() + '), ' + ref.ref.get_ftable() +\
-                           ',\n        ' + ref.ref.get_ftable_pk() + ', true, ' + aspdb.ref_act_type(ref.ref.get_update_act()) +\
-                           ',\n        ' + aspdb.ref_act_type(ref.ref.get_delete_act()) + '),'
-            ref_str += '});\n'
-            text += ref_str
+            yield T_REFERENCES_HEAD.fill(names.values) + self.get_references_text(struct) + '});\n'
 
-        text += '\n'
+        yield '\n'
         # create_setup
-        create_setup = 'static const db_table_create_setup ' + get_create_setup(struct.get_name()) + '(\n'
-        create_setup += '    ' + get_table_enum(struct.name) + ', ' + fields_name + ',\n    ' + unique_name + ', '
-        create_setup += ref_name if struct.foreign_refs else 'nullptr'
-        create_setup += ');\n'
-
-        return text + create_setup
-
-    def add_field_string(self, table_name, field):
-        text = '  db_variable(TABLE_FIELD_PAIR(' + get_field_define(table_name, field.get_name()) \
-               + '), ' + field.asp_type + ',\n'
-        flags = '  {' + field.get_flags_str()
-        flags += '}'
-        text += flags + '\n'
+        yield T_CREATE_SETUP.fill(names.values, storage=storage)
+
+    def get_uniques_text(self, struct):
+        """
+        :return: Инициализаторы групп уникальных полей таблицы
+        """
+        names = self.get_table_names(struct)
+        text = ''
+        for i, group in enumerate(struct.unique):
+            text += '\n  {{ '
+            for field_name in group:
+                text += T_UNIQUES_FIELD.fill(define=names.get_field_define(field_name))
+            text += '}},' if i + 1 < len(struct.unique) else '}}\n'
         return text
+
+    def get_references_text(self, struct):
+        """
+        :return: Инициализаторы ссылок таблицы на внешние таблицы
+        """
+        return ''.join(T_REFERENCE.fill(
+            field=ref.field.get_name(), ftable=ref.ref.get_ftable(),
+            ftable_pk=ref.ref.get_ftable_pk(),
+            on_update=aspdb.ref_act_type(ref.ref.get_update_act()),
+            on_delete=aspdb.ref_act_type(ref.ref.get_delete_act())) for ref in struct.foreign_refs)
+
+
+def generate_header(task):
+    """
+    Сгенерировать файлы одного хэдера. Выполняется в процессе пула
+
+    :param task: Кортеж (хэдер, имя модуля, директория вывода, mmap, директория кэша,
+        собирать статистику, файл на таблицу, ленивая инициализация объектов таблиц,
+        записать промежуточное представление схемы)
+    :return: Кортеж (хэдер, текст ошибки или None, отчёт `get_report`
+        или None, если генератор не создан)
+    """
+    header_file, module_name, output_dir, use_mmap, cache_dir, profile, split, lazy_init, \
+        emit_ir = task
+    gen = None
+    try:
+        gen = AspDBTablesGenerator(header_file, module_name, use_mmap=use_mmap, cache_dir=cache_dir,
+                                   output_dir=output_dir, profile=profile, split=split,
+                                   lazy_init=lazy_init, emit_ir=emit_ir)
+        gen.generate_files()
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except BaseException as e:
+        return header_file, get_error_text(e), gen.get_report() if gen is not None else None
+    return header_file, None, gen.get_report()
+
+
+def get_error_text(e):
+    """
+    :return: Текст ошибки генерации для вывода пользователю
+    """
+    return type(e).__name__ + (': ' + str(e) if str(e) else '')
+
+
+def watch_headers(tasks, interval=0.5, rounds=None):
+    """
+    Сгенерировать файлы хэдеров и перегенерировать их после каждого
+    изменения хэдера. Генераторы с разобранными структурами живут всё
+    время наблюдения, так что изменение хэдера обходится разбором
+    и генерацией только изменившихся таблиц, см. `regenerate`.
+    После ошибки генерации хэдер при следующем изменении
+    генерируется с нуля
+
+    :param tasks: Список кортежей задач, см. `generate_header`
+    :param interval: Период опроса времени изменения хэдеров, секунды
+    :param rounds: Число опросов, None - до прерывания с клавиатуры
+    :return: Код возврата, 0 если последняя генерация каждого
+        хэдера прошла без ошибок
+    """
+    def update(entry):
+        # entry: [задача, генератор или None после ошибки, время изменения хэдера]
+        task, gen = entry[0], entry[1]
+        header_file, module_name, output_dir, use_mmap, cache_dir, profile, split, lazy_init, \
+            emit_ir = task
+        start = time.perf_counter()
+        try:
+            if gen is None:
+                gen = AspDBTablesGenerator(header_file, module_name, use_mmap=use_mmap,
+                                           cache_dir=cache_dir, output_dir=output_dir,
+                                           split=split, lazy_init=lazy_init, emit_ir=emit_ir,
+                                           watch=True)
+                gen.generate_files()
+                changed, removed = gen.tables, list()
+            else:
+                changed, removed = gen.regenerate()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except BaseException as e:
+            print('  ' + header_file + ': ' + get_error_text(e), file=sys.stderr)
+            entry[1] = None
+            return
+        entry[1] = gen
+        updated = gen.get_report()['updated'] if changed or removed else list()
+        print(header_file + ': ' + str(len(changed)) + ' tables changed, ' +
+              str(len(removed)) + ' removed; ' + str(len(updated)) + ' files updated in ' +
+              format(time.perf_counter() - start, '.3f') + ' s')
+        for path in updated:
+            print('  updated: ' + path)
+
+    watched = list()
+    for task in tasks:
+        try:
+            mtime = os.stat(task[0]).st_mtime_ns
+        except OSError:
+            mtime = None
+        entry = [task, None, mtime]
+        update(entry)
+        watched.append(entry)
+    print('watching ' + str(len(watched)) + ' headers, Ctrl+C to stop')
+    try:
+        while rounds is None or rounds > 0:
+            if rounds is not None:
+                rounds -= 1
+            time.sleep(interval)
+            for entry in watched:
+                try:
+                    current = os.stat(entry[0][0]).st_mtime_ns
+                except OSError:
+                    # редактор может сохранять файл через удаление и переименование
+                    continue
+                if current == entry[2]:
+                    continue
+                entry[2] = current
+                update(entry)
+    except KeyboardInterrupt:
+        pass
+    return 0 if all(entry[1] is not None for entry in watched) else 1
+
+
+def read_manifest(manifest_file):
+    """
+    Прочитать манифест хэдеров. Строка манифеста: `хэдер [имя_модуля]`,
+    пути с пробелами берутся в кавычки, как в shell. Пустые строки
+    и комментарии '#' пропускаются. Относительные пути считаются
+    от директории манифеста
+
+    :param manifest_file: Путь манифеста
+    :return: Список пар (хэдер, имя модуля)
+    """
+    result = list()
+    base_dir = os.path.dirname(manifest_file)
+    with open(manifest_file, 'r') as f:
+        for number, line in enumerate(f, 1):
+            try:
+                parts = shlex.split(line, comments=True)
+            except ValueError as e:
+                raise BaseException('%s:%d: %s' % (manifest_file, number, e))
+            if not parts:
+                continue
+            if len(parts) > 2:
+                raise BaseException('%s:%d: expected `HEADER [MODULE]`, quote paths with spaces'
+                                    % (manifest_file, number))
+            result.append((os.path.join(base_dir, parts[0]), parts[1] if len(parts) > 1 else ''))
+    return result
+
+
+def parse_header_arg(arg):
+    """
+    Разобрать аргумент командной строки вида `хэдер[=имя_модуля]`.
+    Имя модуля - идентификатор после последнего '=', существующий
+    файл и путь без такого окончания целиком считаются хэдером
+
+    :return: Пара (хэдер, имя модуля)
+    """
+    header_file, sep, module_name = arg.rpartition('=')
+    if not sep or not header_file or not module_name.isidentifier() or os.path.isfile(arg):
+        return arg, ''
+    return header_file, module_name
+
+
+def main(argv=None):
+    """
+    Точка входа генератора: сгенерировать файлы таблиц для набора хэдеров
+
+    :param argv: Аргументы командной строки
+    :return: Код возврата, 0 если все хэдеры обработаны
+    """
+    parser = argparse.ArgumentParser(description='Генератор cpp файлов таблиц asp_db')
+    parser.add_argument('headers', nargs='*', metavar='HEADER[=MODULE]',
+                        help='хэдер со структурами ASP_TABLE либо файл ' + aspdb.SCHEMA_IR_EXT +
+                             ' и, опционально, имя модуля')
+    parser.add_argument('-m', '--manifest', action='append', default=list(),
+                        help='файл со списком хэдеров, строка: `HEADER [MODULE]`, '
+                             'пути с пробелами - в кавычках')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='число процессов, 0 - по числу процессоров')
+    parser.add_argument('-o', '--output-dir', default='',
+                        help='директория сгенерированных файлов')
+    parser.add_argument('--mmap', action='store_true',
+                        help='отображать хэдеры в память вместо чтения')
+    parser.add_argument('--cache-dir', default=None,
+                        help='директория кэша разобранных структур, записи - JSON')
+    parser.add_argument('--split', action='store_true',
+                        help='генерировать отдельный .cpp файл на каждую таблицу')
+    parser.add_argument('--lazy-init', action='store_true',
+                        help='создавать объекты таблиц при первом обращении, а не до main (C++17)')
+    parser.add_argument('--emit-ir', action='store_true',
+                        help='записать промежуточное представление схемы <module>_auto' +
+                             aspdb.SCHEMA_IR_EXT + ', его можно передать вместо хэдера')
+    parser.add_argument('--watch', action='store_true',
+                        help='после генерации следить за хэдерами и перегенерировать '
+                             'изменившиеся таблицы')
+    parser.add_argument('--interval', type=float, default=0.5,
+                        help='период опроса хэдеров в режиме --watch, секунды')
+    parser.add_argument('--report', default=None,
+                        help='записать JSON отчёт о времени этапов и обновлённых файлах')
+    args = parser.parse_args(argv)
+
+    headers = [parse_header_arg(h) for h in args.headers]
+    for manifest in args.manifest:
+        headers += read_manifest(manifest)
+    if not headers:
+        parser.error('no headers given')
+    if args.watch and any(aspdb.is_schema_ir(header_file) for header_file, module_name in headers):
+        parser.error('--watch needs C++ headers, not ' + aspdb.SCHEMA_IR_EXT + ' files')
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    tasks = list()
+    for header_file, module_name in headers:
+        if not module_name and not aspdb.is_schema_ir(header_file):
+            module_name = os.path.splitext(os.path.basename(header_file))[0]
+        tasks.append((header_file, module_name, args.output_dir, args.mmap, args.cache_dir,
+                      bool(args.report), args.split, args.lazy_init, args.emit_ir))
+    if args.watch:
+        return watch_headers(tasks, args.interval)
+
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count() or 1
+    if jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(min(jobs, len(tasks))) as pool:
+            results = list(pool.map(generate_header, tasks))
+    else:
+        results = [generate_header(task) for task in tasks]
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({header_file: report for header_file, error, report in results if report},
+                      f, indent=2, sort_keys=True)
+    failed = [(header_file, error) for header_file, error, report in results if error is not None]
+    updated = [path for header_file, error, report in results if report
+               for path in report['updated']]
+    unchanged = sum(len(report['unchanged']) for header_file, error, report in results if report)
+    print(str(len(results)) + ' headers: ' + str(len(results) - len(failed)) +
+          ' generated, ' + str(len(failed)) + ' failed; ' + str(len(updated)) +
+          ' files updated, ' + str(unchanged) + ' unchanged')
+    for path in updated:
+        print('  updated: ' + path)
+    for header_file, error in failed:
+        print('  ' + header_file + ': ' + error, file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
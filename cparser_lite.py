@@ -1,7 +1,117 @@
 """
 Модуль парсинга и генерации С файлов
 """
+import mmap
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+class PhaseTimer:
+    """
+    Замер одного вызова этапа, контекстный менеджер `PhaseStats.phase`
+    """
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.nbytes = 0
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stats.add(self.name, time.perf_counter() - self.start, 1, self.nbytes)
+        return False
+
+    def add_output(self, text):
+        """
+        Учесть выданный этапом текст
+
+        :param text: Строка или bytes
+        """
+        self.nbytes += len(text.encode()) if isinstance(text, str) else len(text)
+
+
+class PhaseStats:
+    """
+    Статистика этапов разбора и генерации: время, число вызовов,
+    объём выданных данных
+    """
+    enabled = True
+
+    def __init__(self):
+        # имя этапа -> [время в секундах, число вызовов, байты]
+        self.phases = dict()
+
+    def phase(self, name):
+        """
+        Замерить этап:
+            with stats.phase('name') as phase:
+                phase.add_output(text)
+
+        :param name: Имя этапа
+        :return: Контекстный менеджер PhaseTimer
+        """
+        return PhaseTimer(self, name)
+
+    def add(self, name, elapsed=0.0, calls=1, nbytes=0):
+        """
+        Добавить к этапу время, вызовы и байты
+        """
+        phase = self.phases.get(name)
+        if phase is None:
+            self.phases[name] = [elapsed, calls, nbytes]
+        else:
+            phase[0] += elapsed
+            phase[1] += calls
+            phase[2] += nbytes
+
+    def as_dict(self):
+        """
+        :return: Словарь имя этапа -> {'time': секунды, 'calls': вызовы, 'bytes': байты}
+        """
+        return {name: {'time': p[0], 'calls': p[1], 'bytes': p[2]}
+                for name, p in self.phases.items()}
+
+
+class _NullPhaseTimer:
+    """
+    Замер-заглушка: ничего не делает
+    """
+    nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def add_output(self, text):
+        pass
+
+
+class NullStats:
+    """
+    Выключенная статистика: методы ничего не делают
+    и возвращают общий объект-заглушку
+    """
+    enabled = False
+    _timer = _NullPhaseTimer()
+
+    def phase(self, name):
+        return self._timer
+
+    def add(self, name, elapsed=0.0, calls=1, nbytes=0):
+        pass
+
+    def as_dict(self):
+        return dict()
+
+
+# общая выключенная статистика
+NULL_STATS = NullStats()
 
 
 def cpp_comment_remover(text):
@@ -38,47 +148,311 @@ def get_brace_content(text, open_brace, close_brace):
     :raise BaseException
     :TODO Replace to separated file
     """
-    type_check = (type(text) == type(open_brace)) and (type(close_brace) == str)
+    begin, end = get_brace_span(text, 0, open_brace, close_brace)
+    return text[begin: end] if begin != -1 else ''
+
+
+def get_brace_span(text, start, open_brace, close_brace, end=None):
+    """
+    Найти в тексте `text`, начиная с позиции `start`, границы куска
+    текста заключённого между первым элементом `open_brace` и парным
+    ему `close_brace`. Текст не копируется.
+    Для одиночных скобок `(`, `{`, `[` поиск идёт по потоку лексем,
+    т.е. скобки в комментариях и строковых литералах не учитываются
+
+    :param text: Текс
+    :param start: Позиция начала поиска
+    :param open_brace: Открывающая последовательность
+    :param close_brace: Закрывающая последовательность
+    :param end: Позиция окончания поиска
+    :return: Пара (начало, конец) содержимого скобок:
+        `text[begin: end]` - содержимое без самих скобок,
+        (-1, -1) если парная скобка не найдена
+    :raise BaseException
+    """
+    type_check = (type(open_brace) == str) and (type(close_brace) == str) and \
+        isinstance(text, (str, bytes, bytearray, mmap.mmap))
     if not type_check:
-        raise BaseException('Function `get_brace_content` input data type mismatch '
-                            'all arguments must be a strings')
+        raise BaseException('Function `get_brace_span` input data type mismatch '
+                            'braces must be a strings, text - string or bytes')
     if not open_brace or not close_brace:
-        raise BaseException('Function `get_brace_content` get empty patterns for '
+        raise BaseException('Function `get_brace_span` get empty patterns for '
                             'open or close brackets')
     if open_brace == close_brace:
-        raise BaseException('Function `get_brace_content` get same pattern for '
+        raise BaseException('Function `get_brace_span` get same pattern for '
                             'open and close pattern' + open_brace)
-    i_ob = text.find(open_brace)
-    result = ''
+    if end is None:
+        end = len(text)
+    begin = -1
+    if open_brace in _open_braces and close_brace in _close_braces:
+        count = 0
+        for token in tokenize(text, start, end):
+            if token.value == open_brace and token.kind == CppToken.PUNCT:
+                if count == 0:
+                    begin = token.end
+                count += 1
+            elif token.value == close_brace and count > 0:
+                count -= 1
+                if count == 0:
+                    return begin, token.begin
+        return -1, -1
+    if not isinstance(text, str):
+        open_brace = open_brace.encode()
+        close_brace = close_brace.encode()
+    i_ob = text.find(open_brace, start, end)
     if i_ob != -1:
-        start = i_ob
+        begin = i_ob + len(open_brace)
         # одна скобка открыта, фиксирурем
         count = 1
-        i_cb = text.find(close_brace, i_ob + len(open_brace))
-        i_ob = text.find(open_brace, i_ob + len(open_brace))
+        i_cb = text.find(close_brace, begin, end)
+        i_ob = text.find(open_brace, begin, end)
         while i_cb != -1:
             if (i_cb > i_ob) and (i_ob != -1):
                 # ещё одна открывающая скобка
                 count += 1
-                i_ob = text.find(open_brace, i_ob + len(open_brace))
+                i_ob = text.find(open_brace, i_ob + len(open_brace), end)
                 continue
             else:
                 # сначала закрывающая скобка
                 count -= 1
             if count == 0:
                 # если всё открытое закрыто - закончили
-                result = text[start + len(open_brace): i_cb]
-                break
+                return begin, i_cb
             # прежде была закрывающая скобка, обновим её позицию
-            i_cb = text.find(close_brace, i_cb + len(close_brace))
-    return result
+            i_cb = text.find(close_brace, i_cb + len(close_brace), end)
+    return -1, -1
+
+
+class CppToken:
+    """
+    Лексема C/C++ исходника
+    """
+    __slots__ = ('kind', 'value', 'begin', 'end', 'depth')
+
+    # типы лексем
+    IDENT = 'ident'
+    NUMBER = 'number'
+    STRING = 'string'
+    CHAR = 'char'
+    PUNCT = 'punct'
+
+    def __init__(self, kind, value, begin, end, depth):
+        """
+        Инициализировать лексему
+
+        :param kind: Тип лексемы
+        :param value: Текст лексемы
+        :param begin: Позиция начала лексемы в тексте
+        :param end: Позиция конца лексемы в тексте
+        :param depth: Уровень вложенности скобок, на котором лексема находится.
+            Для открывающих и закрывающих скобок - внешний уровень
+        """
+        self.kind = kind
+        self.value = value
+        self.begin = begin
+        self.end = end
+        self.depth = depth
+
+    def __repr__(self):
+        return 'CppToken(' + self.kind + ', ' + repr(self.value) + ', ' + str(self.begin) + ')'
+
+
+class CppCall:
+    """
+    Вызов вида `name(args)` в C/C++ исходнике
+    """
+    __slots__ = ('name', 'pos', 'args_begin', 'args_end')
+
+    def __init__(self, name, pos, args_begin, args_end):
+        """
+        :param name: Имя вызываемой функции/макроса
+        :param pos: Позиция имени в тексте
+        :param args_begin: Позиция первого символа после `(`
+        :param args_end: Позиция парной `)`
+        """
+        self.name = name
+        self.pos = pos
+        self.args_begin = args_begin
+        self.args_end = args_end
+
+
+# Регулярное выражение одного прохода лексера. Пробельные символы
+#   пропускаются самим `finditer`, комментарии отбрасываются при разборе
+_token_regex = re.compile(
+    r'(?P<comment>//[^\n]*|/\*.*?(?:\*/|\Z))'
+    r'|(?P<string>"(?:\\.|[^\\"\n])*")'
+    r'|(?P<char>\'(?:\\.|[^\\\'\n])*\')'
+    r'|(?P<ident>[A-Za-z_]\w*)'
+    r'|(?P<number>\.?\d(?:[eEpP][+-]|[\w.])*)'
+    r'|(?P<punct>\S)',
+    re.DOTALL
+)
+_token_regex_bytes = re.compile(_token_regex.pattern.encode(), re.DOTALL)
+_open_braces = '({['
+_close_braces = ')}]'
+
+
+def tokenize(text, start=0, end=None):
+    """
+    Разбить C/C++ исходник на лексемы за один проход.
+    Комментарии пропускаются, строковые и символьные литералы
+    выделяются целиком, для каждой лексемы отслеживается уровень
+    вложенности скобок `(`, `{`, `[`
+
+    :param text: С/С++ исходники, строка или bytes-like объект (bytes, mmap).
+        Для bytes-like значения лексем декодируются как latin-1, позиции
+        остаются байтовыми
+    :param start: Позиция начала разбора
+    :param end: Позиция окончания разбора
+    :return: Генератор лексем CppToken
+    """
+    if end is None:
+        end = len(text)
+    is_str = isinstance(text, str)
+    regex = _token_regex if is_str else _token_regex_bytes
+    depth = 0
+    for match in regex.finditer(text, start, end):
+        kind = match.lastgroup
+        if kind == 'comment':
+            continue
+        value = match.group() if is_str else match.group().decode('latin-1')
+        if kind == CppToken.PUNCT:
+            if value in _open_braces:
+                yield CppToken(kind, value, match.start(), match.end(), depth)
+                depth += 1
+                continue
+            if value in _close_braces:
+                depth -= 1
+        yield CppToken(kind, value, match.start(), match.end(), depth)
+
+
+def iter_calls(text, start=0, end=None):
+    """
+    Найти вызовы вида `name(args)` на верхнем уровне вложенности
+    участка текста за один проход лексера
+
+    :param text: С/С++ исходники
+    :param start: Позиция начала разбора
+    :param end: Позиция окончания разбора
+    :return: Генератор объектов CppCall
+    """
+    prev = None
+    call = None
+    for token in tokenize(text, start, end):
+        if call is not None:
+            # ищем парную закрывающую скобку
+            if token.value == ')' and token.depth == 0:
+                call.args_end = token.begin
+                yield call
+                call = None
+        elif token.value == '(' and token.depth == 0 and \
+                prev is not None and prev.kind == CppToken.IDENT:
+            call = CppCall(prev.value, prev.begin, token.end, -1)
+        prev = token
+
+
+# закрытые литералы и комментарии, см. CppFile.is_closed_text
+_closed_text_regex = re.compile(r'//[^\n]*\n|/\*.*?\*/|"(?:\\.|[^\\"\n])*"|\'(?:\\.|[^\\\'\n])*\'',
+                                re.DOTALL)
+
+
+def common_prefix_length(a, b):
+    """
+    Длина общего начала двух строк. Строки сравниваются кусками,
+    размер которых уменьшается вдвое, так что сравнение линейное
+    и выполняется на стороне C
+
+    :param a: Строка
+    :param b: Строка
+    :return: Число совпадающих символов в начале строк
+    """
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo: mid] == b[lo: mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def common_suffix_length(a, b, limit=None):
+    """
+    Длина общего конца двух строк, см. `common_prefix_length`
+
+    :param a: Строка
+    :param b: Строка
+    :param limit: Наибольшая длина, например, чтобы общие начало
+        и конец не перекрывались
+    :return: Число совпадающих символов в конце строк
+    """
+    lo, hi = 0, min(len(a), len(b))
+    if limit is not None:
+        hi = min(hi, limit)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid: len(a) - lo] == b[len(b) - mid: len(b) - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _init_structs_batch(cpp_functions, batch):
+    """
+    Инициализировать пачку структур. Выполняется в процессе пула
+
+    :param cpp_functions: Функции инициализаци cpp данных
+    :param batch: Список пар (имя, тело структуры)
+    :return: Список объектов структур
+    """
+    return [cpp_functions.init_cpp_structs(name, source) for name, source in batch]
+
+
+class CppTemplate:
+    """
+    Шаблон C/C++ кода с подстановками вида `${name}`.
+    Шаблон компилируется один раз, при создании, в строку формата
+    `str.format`: фигурные скобки C++ кода экранируются, так что
+    заполнение шаблона - один вызов `format_map`
+    """
+    _field_regex = re.compile(r'\$\{(\w+)\}')
+
+    def __init__(self, text):
+        """
+        :param text: Текст шаблона
+        """
+        self.text = text
+        # чётные элементы - текст, нечётные - имена подстановок
+        parts = self._field_regex.split(text)
+        self.fields = tuple(parts[1::2])
+        self.format = ''.join(part.replace('{', '{{').replace('}', '}}') if i % 2 == 0
+                              else '{' + part + '}' for i, part in enumerate(parts))
+
+    def fill(self, values=None, **kwargs):
+        """
+        Заполнить шаблон
+
+        :param values: Словарь подстановок
+        :param kwargs: Подстановки именованными аргументами, заменяют
+            одноимённые подстановки `values`
+        :return: Текст с подстановками
+        :raise KeyError: если значение подстановки не передано
+        """
+        if kwargs:
+            if values:
+                values = dict(values)
+                values.update(kwargs)
+            else:
+                values = kwargs
+        return self.format.format_map(values)
 
 
 class ICppFunctions:
     """
     Класс предоставляющий интерфейс инициализации cpp данных
     """
-    def init_cpp_structs(self, name, source):
+    def init_cpp_structs(self, name, source, span=None):
         pass
 
 
@@ -86,6 +460,8 @@ class CppEnum:
     """
     Cpp представление class enum'а
     """
+    __slots__ = ('name', 'fields', 'nums')
+
     def __init__(self, name):
         self.name = name
         self.fields = list()
@@ -111,19 +487,48 @@ class CppEnum:
 
 class CppStructs:
     """
-    Cpp структура данных
+    Cpp структура данных.
+    Тело структуры не копируется: хранится ссылка на общий для всех
+    структур файла текст и границы тела в нём
     """
-    def __init__(self, name, source):
+    __slots__ = ('name', 'text', 'span', 'fields')
+
+    def __init__(self, name, source, span=None):
         """
         Инициализировать структуру
         :param name: Имя её
-        :param source: Контент, без комментариев, от скобки до скобки
+        :param source: Контент, без комментариев, от скобки до скобки,
+            либо, если задан `span`, текст, содержащий тело структуры
+        :param span: Границы тела (начало, конец) в `source`,
+            None - `source` и есть тело
         """
         self.name = name
-        self.source = source
+        self.text = source
+        self.span = span
         # поля структуры
         self.fields = list()
 
+    @property
+    def source(self):
+        """
+        Тело структуры без комментариев
+        """
+        if self.span is None:
+            return self.text
+        return self.text[self.span[0]: self.span[1]]
+
+    def __getstate__(self):
+        # в процессы пула передаётся только тело структуры, а не весь текст
+        state = {name: getattr(self, name) for cls in type(self).__mro__
+                 for name in getattr(cls, '__slots__', ()) if hasattr(self, name)}
+        state['text'] = self.source
+        state['span'] = None
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def get_name(self):
         return self.name
 
@@ -137,20 +542,35 @@ class CppFile:
     TODO: не работать с оригинальным, свободным форматом - удалить все
         комментарии, лишние пробелы, переводы строк
     """
-    def __init__(self, text, cpp_functions):
+    def __init__(self, text, cpp_functions, encoding='utf-8', stats=None):
         """
         Инициализировать
         C + + структуру
+
+        :param text: Исходник строкой, либо bytes-like объектом (bytes, mmap).
+            bytes-like исходник не копируется: комментарии удаляются
+            и текст декодируется только для найденных структур
+        :param cpp_functions: Функции инициализаци cpp данных
+        :param encoding: Кодировка bytes-like исходника
+        :param stats: Статистика этапов PhaseStats, None - не собирать
         """
         # Функции инициализаци cpp данных
         self.cpp_functions = cpp_functions
-        # Сразу отбросить комментарии из текста
-        self.source = cpp_comment_remover(text)
+        self.encoding = encoding
+        self.stats = stats if stats is not None else NULL_STATS
+        if isinstance(text, str):
+            # Сразу отбросить комментарии из текста
+            with self.stats.phase('cpp_comment_remover'):
+                self.source = cpp_comment_remover(text)
+        else:
+            self.source = text
         # Регулярное выражение на инициализацию структур
         self.regex_struct_st = r'struct\s' + self.get_class_marker() + r'\s[a-zA-Z]{1}\w*[\s]*{'
 
         # контейнеры
         self.cpp_structs = list()
+        # минимальное число структур, для которого имеет смысл пул процессов
+        self.parallel_min_structs = 64
 
     def get_class_marker(self):
         """
@@ -166,34 +586,205 @@ class CppFile:
         #   когда я его из init вызывал
         return ''
 
-    def init_structs(self):
+    def init_structs(self, jobs=1):
         """
         Инициализировать cpp структуры, записать объекты
         в лист self.cpp_structs
 
+        :param jobs: Число процессов для разбора структур. При jobs > 1
+            границы структур находятся один раз, а тела разбираются
+            пачками в пуле процессов
         :return: Nothing
         """
-        structs = re.findall(self.regex_struct_st, self.source)
         missed = list()
-        for struct in structs:
-            # по результату применения регулярных выражений
-            #   найдём позицию объявлений структур
-            struct_pos = self.source.find(struct)
-            if struct_pos == -1:
-                missed.append(struct + ' ~~ cannot find position this string position '
-                                       'in cpp source file.')
+        spans = list()
+        with self.stats.phase('find_structs'):
+            for name, begin, end in self.find_structs():
+                if end == -1:
+                    missed.append(name + ' ~~ cannot get brace content of struct')
+                    continue
+                spans.append((name, begin, end))
+        if jobs > 1:
+            with self.stats.phase('init_structs_parallel'):
+                self.cpp_structs.extend(self.init_structs_parallel(spans, jobs))
+        else:
+            for name, begin, end in spans:
+                with self.stats.phase('init_struct'):
+                    self.cpp_structs.append(self.init_struct(name, begin, end))
+        if len(missed) > 0:
+            print('Warning: Some algorithm CppFile finished with errors')
+            print(missed)
+
+    def init_structs_from(self, previous):
+        """
+        Инициализировать структуры изменённого исходника по найденным
+        структурам его прежней версии. Структуры из совпадающих начала
+        и конца исходников переносятся из `previous` без поиска и разбора,
+        заново ищутся только структуры изменившейся середины. Если
+        изменения задевают границы структур, исходник просматривается
+        целиком, как в `init_structs`
+
+        :param previous: CppFile прежней версии исходника с найденными
+            структурами. Перенесённые структуры переходят на новый исходник
+        :return: Nothing
+        """
+        old, new = previous.source, self.source
+        structs = previous.cpp_structs
+        if not isinstance(old, str) or not isinstance(new, str) or \
+                any(struct.text is not old for struct in structs):
+            # структуры, тела которых скопированы из исходника
+            return self.init_structs()
+        prefix = common_prefix_length(old, new)
+        suffix = common_suffix_length(old, new, min(len(old), len(new)) - prefix)
+        delta = len(new) - len(old)
+        # начала промежутков с заголовками структур: за концом предыдущей
+        gaps = [0] + [struct.span[1] + 1 for struct in structs]
+        head = 0
+        while head < len(structs) and structs[head].span[1] + 1 <= prefix and \
+                self.is_closed_text(gaps[head], structs[head].span[0]):
+            head += 1
+        # у структур конца не изменились ни тело, ни промежуток перед ним
+        tail = len(structs)
+        while tail > head and gaps[tail - 1] >= len(old) - suffix:
+            tail -= 1
+        pos = gaps[head]
+        endpos = gaps[tail] + delta if tail < len(structs) else len(new)
+        middle = list()
+        with self.stats.phase('find_structs'):
+            for name, begin, end in self.find_structs(pos, endpos):
+                if end == -1 or end >= endpos:
+                    return self.init_structs()
+                middle.append((name, begin, end))
+            if tail < len(structs):
+                # первой после середины должна найтись первая структура конца
+                found = next(self.find_structs(middle[-1][2] + 1 if middle else pos), None)
+                if found is None or found[1] != structs[tail].span[0] + delta:
+                    return self.init_structs()
+                # ограничение поиска концом середины не должно было
+                #   оборвать литерал или комментарий между структурами
+                bounds = [pos] + [bound for name, begin, end in middle for bound in (begin, end + 1)] + \
+                    [found[1]]
+                if not all(self.is_closed_text(bounds[i], bounds[i + 1])
+                           for i in range(0, len(bounds), 2)):
+                    return self.init_structs()
+        for struct in structs[: head]:
+            struct.text = new
+        self.cpp_structs.extend(structs[: head])
+        for name, begin, end in middle:
+            with self.stats.phase('init_struct'):
+                self.cpp_structs.append(self.init_struct(name, begin, end))
+        for struct in structs[tail:]:
+            struct.text = new
+            struct.span = (struct.span[0] + delta, struct.span[1] + delta)
+        self.cpp_structs.extend(structs[tail:])
+
+    def is_closed_text(self, begin, end):
+        """
+        Все ли литералы и комментарии куска исходника закрыты в нём же.
+        Поиск структур в таком куске не заглядывает за его границы
+
+        :param begin: Начало куска
+        :param end: Конец куска
+        :return: True, если кусок можно просматривать отдельно
+        """
+        rest = _closed_text_regex.sub('', self.source[begin: end])
+        return not any(opening in rest for opening in ('"', "'", '/*', '//'))
+
+    def find_structs(self, pos=0, endpos=None):
+        """
+        Найти объявления структур с маркером. Позиции заголовков берутся
+        из совпадений регулярного выражения, парная закрывающая скобка -
+        из потока лексем от открывающей, так что весь файл просматривается
+        один раз, а исходник не копируется.
+        Объявление имеет вид:
+            struct MARKER name { ... };
+
+        :param pos: Позиция начала поиска заголовков, вне комментариев
+            и литералов
+        :param endpos: Позиция окончания поиска заголовков, None - конец
+            исходника. Тело структуры может выходить за неё
+        :return: Генератор кортежей (имя, начало тела, конец тела),
+            начало и конец тела равны -1 если парная скобка не найдена
+        """
+        # комментарии и литералы перебираются тем же выражением,
+        #   чтобы не принять закомментированный заголовок за настоящий
+        pattern = r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^\\"\n])*"|\'(?:\\.|[^\\\'\n])*\'' \
+                  r'|(?P<head>' + self.regex_struct_st + ')'
+        if not isinstance(self.source, str):
+            pattern = pattern.encode()
+        regex = re.compile(pattern, re.DOTALL)
+        if endpos is None:
+            endpos = len(self.source)
+        while True:
+            match = regex.search(self.source, pos, endpos)
+            if match is None:
+                break
+            pos = match.end()
+            if match.lastgroup != 'head':
+                # комментарий или литерал
                 continue
-            name = self.get_class_name(struct)
-            if not name:
-                missed.append(struct + ' ~~ cannot get name of this struct')
-            source = get_brace_content(self.source[struct_pos:], '{', '}')
-            if not source:
-                missed.append(struct + ' ~~ cannot get brace content of struct')
-            # всё(или не всё нашли, продолжим инициализацию данных)
-            if len(missed) > 0:
-                print('Warning: Some algorithm CppFile finished with errors')
-                print(missed)
-            self.cpp_structs.append(self.cpp_functions.init_cpp_structs(name, source))
+            head = match.group()
+            name = self.get_class_name(head if isinstance(head, str) else head.decode(self.encoding))
+            # регулярное выражение заканчивается на открывающую скобку
+            begin, end = get_brace_span(self.source, match.end() - 1, '{', '}')
+            yield name, begin, end
+            if end == -1:
+                break
+            # поиск продолжается за телом структуры: вложенные объявления
+            #   пропускаются, а литералы тела не захватывают текст за ним
+            pos = end
+
+    def init_struct(self, name, begin, end):
+        """
+        Инициализировать объект структуры по границам её тела
+
+        :param name: Имя структуры
+        :param begin: Начало тела структуры
+        :param end: Конец тела структуры
+        :return: Объект структуры, созданный `cpp_functions`
+        """
+        if isinstance(self.source, str):
+            # тело - срез общего текста, без копирования
+            return self.cpp_functions.init_cpp_structs(name, self.source, (begin, end))
+        return self.cpp_functions.init_cpp_structs(name, self.get_struct_source(begin, end))
+
+    def init_structs_parallel(self, spans, jobs):
+        """
+        Инициализировать структуры в пуле процессов. Для небольшого
+        числа структур разбор идёт в текущем процессе - запуск пула
+        обойдётся дороже
+
+        :param spans: Список кортежей (имя, начало тела, конец тела)
+        :param jobs: Число процессов
+        :return: Список объектов структур в порядке `spans`
+        """
+        sources = [(name, self.get_struct_source(begin, end)) for name, begin, end in spans]
+        if jobs < 2 or len(sources) < self.parallel_min_structs:
+            return _init_structs_batch(self.cpp_functions, sources)
+        # по несколько пачек на процесс, чтобы выровнять нагрузку
+        batch_size = -(-len(sources) // (jobs * 4))
+        batches = [sources[i: i + batch_size] for i in range(0, len(sources), batch_size)]
+        result = list()
+        with ProcessPoolExecutor(jobs) as pool:
+            # map сохраняет порядок пачек
+            for structs in pool.map(_init_structs_batch,
+                                    [self.cpp_functions] * len(batches), batches):
+                result.extend(structs)
+        return result
+
+    def get_struct_source(self, begin, end):
+        """
+        Получить тело структуры по его границам. Для bytes-like исходника
+        здесь же удаляются комментарии и текст декодируется
+
+        :param begin: Начало тела структуры
+        :param end: Конец тела структуры
+        :return: Тело структуры строкой, без комментариев
+        """
+        if isinstance(self.source, str):
+            return self.source[begin: end]
+        with self.stats.phase('cpp_comment_remover'):
+            return cpp_comment_remover(self.source[begin: end].decode(self.encoding))
 
     def get_class_name(self, head_str):
         """
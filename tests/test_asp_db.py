@@ -1,7 +1,10 @@
 import asp_db_table_generate as asp_db_tg
 import asp_db_cpp
 import unittest
+import json
 import os
+import tempfile
+from unittest import mock
 
 cpp_text = '#ifndef SOME_DEFINE\n' \
            '#define SOME_DEFINE\n' \
@@ -30,6 +33,14 @@ cpp_text = '#ifndef SOME_DEFINE\n' \
            '#endif\n'
 
 
+class FailingGenerator(asp_db_tg.AspDBTablesGenerator):
+    """
+    Генератор, прерывающийся посреди записи .cpp файла
+    """
+    def add_set_select_data(self, structs=None):
+        raise RuntimeError('interrupted')
+
+
 class TestAspDBTablesGenerator(unittest.TestCase):
     def test_cpp_text(self):
         """
@@ -100,6 +111,28 @@ class TestAspDBTablesGenerator(unittest.TestCase):
         self.assertEqual(td.flags_enum.fields[3], ['f_full', 0x07])
         print(td.enum_as_text())
 
+    def test_table_names(self):
+        aspf = asp_db_cpp.AspDBCppFile(cpp_text)
+        aspf.init_structs()
+        names = asp_db_tg.AspDBTableNames(aspf.cpp_structs[1])
+        self.assertEqual(names.values['enum'], 'table_test2')
+        self.assertEqual(names.values['references_arg'], 'test2_references')
+        self.assertTrue(names.has_id)
+        self.assertEqual([f.define for f in names.fields],
+                         ['TEST2_TABLE_ID', 'TEST2_TABLE_FID', 'TEST2_TABLE_FFID'])
+        self.assertEqual(names.fields[2].values['value'], '(TEST2_TABLE | 0x0003)')
+        self.assertEqual(names.fields[1].flag, 'f_test2_fid')
+        self.assertEqual(names.get_field_define('num'), 'TEST2_TABLE_NUM')
+        self.assertEqual(names.get_field_define('ffid'), 'TEST2_TABLE_FFID')
+        self.assertEqual(names.defines, {'id': 'TEST2_TABLE_ID', 'fid': 'TEST2_TABLE_FID',
+                                         'ffid': 'TEST2_TABLE_FFID'})
+        # имена считаются один раз на структуру
+        gen = asp_db_tg.AspDBTablesGenerator.__new__(asp_db_tg.AspDBTablesGenerator)
+        gen.table_names = dict()
+        gen.watch = False
+        self.assertIs(gen.get_table_names(aspf.cpp_structs[0]),
+                      gen.get_table_names(aspf.cpp_structs[0]))
+
     def test_cpp_gen(self):
         cpp_file = 'tmpfile_table_test.h'
         cpp_module = cpp_file[:-2]
@@ -115,3 +148,565 @@ class TestAspDBTablesGenerator(unittest.TestCase):
             gen.generate_files()
         else:
             self.assertTrue(False)
+
+    def test_mmap_source(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cpp_file = os.path.join(tmp, 'tables.h')
+            with open(cpp_file, 'w') as f:
+                f.write(cpp_text)
+            gen = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', use_mmap=True)
+            source_map = gen.source_map
+            gen.asp_tables.init_structs()
+            gen.close_source()
+            self.assertTrue(source_map.closed)
+            self.assertIsNone(gen.source_map)
+            self.assertEqual([s.name for s in gen.asp_tables.cpp_structs], ['test', 'test2'])
+            self.assertEqual(gen.asp_tables.cpp_structs[1].primary_key, ['id', 'fid'])
+            self.assertEqual(len(gen.asp_tables.cpp_structs[1].foreign_refs), 2)
+            # генерация закрывает отображение сразу после разбора
+            gen = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', use_mmap=True, output_dir=tmp)
+            source_map = gen.source_map
+            gen.generate_files()
+            self.assertTrue(source_map.closed)
+            self.assertTrue(os.path.exists(os.path.join(tmp, 'TestMacro_auto.cpp')))
+
+    def test_parse_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            aspf = asp_db_cpp.AspDBCppFile(cpp_text, cache_dir=tmp)
+            aspf.init_structs()
+            self.assertEqual(aspf.cache_hits, 0)
+            # вторая таблица изменена, первая должна загрузиться из кэша
+            changed = cpp_text.replace('ffid', 'ffkey')
+            aspc = asp_db_cpp.AspDBCppFile(changed, cache_dir=tmp)
+            aspc.init_structs()
+            self.assertEqual(aspc.cache_hits, 1)
+            self.assertEqual([s.name for s in aspc.cpp_structs], ['test', 'test2'])
+            self.assertEqual(aspc.cpp_structs[0].fields[1].to_str, 'n2s')
+            self.assertEqual(aspc.cpp_structs[1].foreign_refs[1].field.asp_name, 'ffkey')
+            self.assertEqual(aspc.cpp_structs[0].primary_key, ['id'])
+            # запись кэша - данные, а не исполняемый pickle
+            cached = aspc.cpp_structs[0]
+            with open(aspc.cache.get_path(aspc.cache.get_key(cached.source))) as f:
+                self.assertEqual(json.load(f)['struct'], aspf.cpp_structs[0].to_ir())
+            self.assertEqual(cached.to_ir(), aspf.cpp_structs[0].to_ir())
+            self.assertEqual([(c.name, c.pos, c.args_end) for c in cached.directives],
+                             [(c.name, c.pos, c.args_end) for c in aspf.cpp_structs[0].directives])
+            self.assertEqual(cached.source, aspf.cpp_structs[0].source)
+            # битая запись кэша - просто промах
+            key = aspc.cache.get_key(aspc.cpp_structs[0].source)
+            with open(aspc.cache.get_path(key), 'wb') as f:
+                f.write(b'garbage')
+            self.assertIsNone(aspc.cache.load(key))
+
+    def test_parallel_init_structs(self):
+        text = ''.join('struct ASP_TABLE t' + str(i) + ' {\n'
+                       '  field(integer, id, NOT_NULL);\n'
+                       '  field(text, name' + str(i) + ');\n'
+                       '  primary_key(id)\n'
+                       '};\n' for i in range(20))
+        serial = asp_db_cpp.AspDBCppFile(text)
+        serial.init_structs()
+        parallel = asp_db_cpp.AspDBCppFile(text)
+        parallel.parallel_min_structs = 4
+        parallel.init_structs(jobs=2)
+        self.assertEqual([s.name for s in parallel.cpp_structs],
+                         [s.name for s in serial.cpp_structs])
+        self.assertEqual([s.fields[1].asp_name for s in parallel.cpp_structs],
+                         ['name' + str(i) for i in range(20)])
+        # с кэшем в пул уходят только промахи
+        with tempfile.TemporaryDirectory() as tmp:
+            cached = asp_db_cpp.AspDBCppFile(text, cache_dir=tmp)
+            cached.parallel_min_structs = 4
+            cached.init_structs(jobs=2)
+            again = asp_db_cpp.AspDBCppFile(text, cache_dir=tmp)
+            again.init_structs(jobs=2)
+            self.assertEqual(again.cache_hits, 20)
+            self.assertEqual([s.name for s in again.cpp_structs],
+                             [s.name for s in serial.cpp_structs])
+
+    def test_cli(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cpp_file = os.path.join(tmp, 'tables.h')
+            with open(cpp_file, 'w') as f:
+                f.write(cpp_text)
+            manifest = os.path.join(tmp, 'headers.txt')
+            with open(manifest, 'w') as f:
+                f.write('# headers\n\ntables.h other\n')
+            self.assertEqual(asp_db_tg.read_manifest(manifest), [(cpp_file, 'other')])
+            self.assertEqual(asp_db_tg.parse_header_arg(cpp_file + '=mod'), (cpp_file, 'mod'))
+            self.assertEqual(asp_db_tg.parse_header_arg(cpp_file), (cpp_file, ''))
+            out_dir = os.path.join(tmp, 'out')
+            code = asp_db_tg.main([cpp_file + '=mod', os.path.join(tmp, 'missing.h'),
+                                   '-m', manifest, '-o', out_dir, '-j', '2'])
+            # отсутствующий хэдер - ненулевой код возврата
+            self.assertEqual(code, 1)
+            self.assertTrue(os.path.exists(os.path.join(out_dir, 'mod_auto.h')))
+            self.assertTrue(os.path.exists(os.path.join(out_dir, 'other_auto.h')))
+
+    def test_cli_paths(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            manifest = os.path.join(tmp, 'headers.txt')
+            with open(manifest, 'w') as f:
+                f.write('"my tables.h" spaced  # comment\n'
+                        "'odd=name.h'\n"
+                        'plain.h\n')
+            self.assertEqual(asp_db_tg.read_manifest(manifest),
+                             [(os.path.join(tmp, 'my tables.h'), 'spaced'),
+                              (os.path.join(tmp, 'odd=name.h'), ''),
+                              (os.path.join(tmp, 'plain.h'), '')])
+            with open(manifest, 'w') as f:
+                f.write('my tables.h spaced\n')
+            self.assertRaises(BaseException, asp_db_tg.read_manifest, manifest)
+            with open(manifest, 'w') as f:
+                f.write('"my tables.h\n')
+            self.assertRaises(BaseException, asp_db_tg.read_manifest, manifest)
+            # '=' внутри пути не отделяет имя модуля
+            self.assertEqual(asp_db_tg.parse_header_arg('a=b/tables.h'), ('a=b/tables.h', ''))
+            self.assertEqual(asp_db_tg.parse_header_arg('a=b/tables.h=mod'),
+                             ('a=b/tables.h', 'mod'))
+            self.assertEqual(asp_db_tg.parse_header_arg('=mod'), ('=mod', ''))
+            odd = os.path.join(tmp, 'tables=mod')
+            open(odd, 'w').close()
+            self.assertEqual(asp_db_tg.parse_header_arg(odd), (odd, ''))
+
+    def test_main_generate(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cpp_file = os.path.join(tmp, 'tables.h')
+            with open(cpp_file, 'w') as f:
+                f.write(cpp_text)
+            out_dir = os.path.join(tmp, 'out')
+            self.assertEqual(asp_db_tg.main([cpp_file + '=TestMacro', '-o', out_dir]), 0)
+            self.assertEqual(sorted(os.listdir(out_dir)), ['TestMacro_auto.cpp',
+                                                           'TestMacro_auto.h'])
+            with open(os.path.join(out_dir, 'TestMacro_auto.h')) as f:
+                self.assertTrue(f.read().endswith('#endif  // !TESTMACRO_GUARD_H\n'))
+            with open(os.path.join(out_dir, 'TestMacro_auto.cpp')) as f:
+                source = f.read()
+            self.assertIn('str2field_test2 is not generated', source)
+            self.assertIn('field2str_test2', source)
+            self.assertIn('TestmacroDBTables::GetCreateLevel', source)
+
+    def test_duplicate_names(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cpp_file = os.path.join(tmp, 'tables.h')
+            out_dir = os.path.join(tmp, 'out')
+            for fields, duplicate in (('  field(integer, id);\n  field(text, id);\n', 'id'),
+                                      ('  field(integer, id);\n  field(text, Id);\n', 'Id')):
+                with open(cpp_file, 'w') as f:
+                    f.write('struct ASP_TABLE t {\n' + fields + '};\n')
+                gen = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', output_dir=out_dir)
+                with self.assertRaises(ValueError) as error:
+                    gen.generate_files()
+                self.assertIn('Table t has duplicate field ' + duplicate, str(error.exception))
+                # ни хэдер, ни .cpp не записаны
+                self.assertEqual(gen.outputs, list())
+                self.assertEqual(asp_db_tg.main([cpp_file + '=TestMacro', '-o', out_dir]), 1)
+                self.assertEqual(os.listdir(out_dir), list())
+
+    def test_profile_report(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cpp_file = os.path.join(tmp, 'tables.h')
+            with open(cpp_file, 'w') as f:
+                f.write(cpp_text)
+            gen = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', output_dir=tmp,
+                                                 profile=True)
+            gen.generate_files()
+            phases = gen.get_report()['phases']
+            for phase in ('read', 'cpp_comment_remover', 'find_structs', 'init_structs',
+                          'init_data.directives', 'add_defines_h', 'add_table_fields', 'write'):
+                self.assertIn(phase, phases)
+            self.assertEqual(phases['init_data.directives']['calls'], 2)
+            self.assertEqual(phases['add_table_fields']['calls'], 2)
+            self.assertEqual(phases['write']['calls'], 2)
+            self.assertEqual(phases['write']['bytes'],
+                             os.path.getsize(gen.get_output_path('.h')) +
+                             os.path.getsize(gen.get_output_path('.cpp')))
+            # без профилирования статистика пуста
+            gen = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', output_dir=tmp)
+            self.assertEqual(gen.get_report()['phases'], dict())
+            # отчёт командной строки
+            report = os.path.join(tmp, 'report.json')
+            asp_db_tg.main([cpp_file, '-o', tmp, '--report', report])
+            with open(report) as f:
+                self.assertIn('add_defines_h', json.load(f)[cpp_file]['phases'])
+
+    def test_stream_output(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cpp_file = os.path.join(tmp, 'tables.h')
+            with open(cpp_file, 'w') as f:
+                f.write(cpp_text)
+            gen = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', output_dir=tmp)
+            gen.generate_files()
+            with open(gen.get_output_path('.h')) as f:
+                header = f.read()
+            with open(gen.get_output_path('.cpp')) as f:
+                source = f.read()
+            self.assertTrue(header.startswith('#ifndef TESTMACRO_GUARD_H\n'))
+            self.assertIn(''.join(gen.add_defines_h()), header)
+            self.assertTrue(header.endswith('#endif  // !TESTMACRO_GUARD_H\n'))
+            self.assertIn(''.join(gen.add_table_fields(gen.asp_tables.cpp_structs[1])), source)
+            self.assertIn(''.join(gen.add_set_select_data()), source)
+            self.assertTrue(source.endswith(''.join(gen.add_field_lookup())))
+
+    def test_write_if_changed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cpp_file = os.path.join(tmp, 'tables.h')
+            with open(cpp_file, 'w') as f:
+                f.write(cpp_text)
+            gen = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', output_dir=tmp)
+            gen.generate_files()
+            outputs = [gen.get_output_path('.h'), gen.get_output_path('.cpp')]
+            self.assertEqual(gen.get_report()['updated'], outputs)
+            # старое время модификации, чтобы перезапись была заметна
+            for path in outputs:
+                os.utime(path, (1, 1))
+            gen = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', output_dir=tmp)
+            gen.generate_files()
+            report = gen.get_report()
+            self.assertEqual(report['updated'], list())
+            self.assertEqual(report['unchanged'], outputs)
+            self.assertEqual([os.path.getmtime(path) for path in outputs], [1, 1])
+            self.assertEqual(sorted(os.listdir(tmp)), ['TestMacro_auto.cpp', 'TestMacro_auto.h',
+                                                       'tables.h'])
+            # изменилась одна таблица - перезаписываются оба файла
+            with open(cpp_file, 'w') as f:
+                f.write(cpp_text.replace('test2', 'test3'))
+            gen = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', output_dir=tmp)
+            gen.generate_files()
+            self.assertEqual(gen.get_report()['updated'], outputs)
+            # прерванная запись не портит прежний файл
+            with open(outputs[1]) as f:
+                source = f.read()
+            gen = FailingGenerator(cpp_file, 'TestMacro', output_dir=tmp)
+            self.assertRaises(RuntimeError, gen.generate_files)
+            with open(outputs[1]) as f:
+                self.assertEqual(f.read(), source)
+            self.assertEqual(gen.get_report()['unchanged'], outputs[:1])
+
+    def test_concurrent_writers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'out.cpp')
+            first = asp_db_tg.AspDBOutputWriter(path)
+            second = asp_db_tg.AspDBOutputWriter(path)
+            # чужой временный файл того же пути не затирается
+            second.tmp_path = path + '.0.tmp'
+            self.assertIn(str(os.getpid()), first.tmp_path)
+            with first:
+                first.write('first\n')
+                with second:
+                    second.write('second\n')
+                with open(path) as f:
+                    self.assertEqual(f.read(), 'second\n')
+            with open(path) as f:
+                self.assertEqual(f.read(), 'first\n')
+            self.assertEqual(os.listdir(tmp), ['out.cpp'])
+
+    def test_split_sources(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cpp_file = os.path.join(tmp, 'tables.h')
+            with open(cpp_file, 'w') as f:
+                f.write(cpp_text)
+            gen = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', output_dir=tmp)
+            gen.generate_files()
+            with open(gen.get_output_path('.cpp')) as f:
+                single = f.read()
+            gen = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', output_dir=tmp, split=True)
+            gen.generate_files()
+            tables = [gen.get_table_output_path(t) for t in ('test', 'test2')]
+            self.assertEqual(gen.get_report()['updated'],
+                             [gen.get_output_path('.h'), gen.get_output_path('.cpp')] + tables)
+            with open(gen.get_output_path('.h')) as f:
+                self.assertIn('extern const db_table_create_setup test2_create_setup;\n', f.read())
+            with open(gen.get_output_path('.cpp')) as f:
+                dispatch = f.read()
+            self.assertTrue(dispatch.startswith('#include "TestMacro_auto.h"\n\n#include "' +
+                                                cpp_file + '"\n'))
+            self.assertIn('GetTableName<test2>', dispatch)
+            self.assertNotIn('db_variable', dispatch)
+            with open(tables[1]) as f:
+                source = f.read()
+            # файл таблицы подключает общий хэдер модуля из своей директории
+            self.assertTrue(source.startswith('#include "TestMacro_auto.h"\n'))
+            self.assertIn('\nconst db_table_create_setup test2_create_setup(', source)
+            self.assertIn('setInsertValues<table_test2>', source)
+            self.assertNotIn('table_test,', source)
+            self.assertIn(''.join(gen.add_set_select_data(gen.asp_tables.cpp_structs[1:])), single)
+            self.assertIn(''.join(gen.add_set_select_data(gen.asp_tables.cpp_structs[1:])), source)
+            self.assertTrue(source.endswith(
+                ''.join(gen.add_field_lookup(gen.asp_tables.cpp_structs[1:]))))
+            # изменение одной таблицы перезаписывает только её файл и хэдер
+            with open(cpp_file, 'w') as f:
+                f.write(cpp_text.replace('ffid', 'fxid'))
+            gen = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', output_dir=tmp, split=True)
+            gen.generate_files()
+            self.assertEqual(gen.get_report()['updated'], [gen.get_output_path('.h'), tables[1]])
+            # файл удалённой таблицы удаляется и без режима watch,
+            #   чужой файл с похожим именем остаётся
+            foreign = os.path.join(tmp, 'TestMacro_auto_manual.cpp')
+            with open(foreign, 'w') as f:
+                f.write('#include "other.h"\n')
+            with open(cpp_file, 'w') as f:
+                f.write(cpp_text[: cpp_text.find('struct ASP_TABLE test2')] + '#endif\n')
+            gen = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', output_dir=tmp, split=True)
+            gen.generate_files()
+            self.assertTrue(os.path.exists(tables[0]))
+            self.assertFalse(os.path.exists(tables[1]))
+            self.assertTrue(os.path.exists(foreign))
+
+    def test_create_levels(self):
+        aspf = asp_db_cpp.AspDBCppFile(cpp_text)
+        aspf.init_structs()
+        graph = asp_db_cpp.AspDBReferenceGraph(aspf.cpp_structs)
+        # ссылка на внешнюю таблицу ftest порядок не меняет
+        self.assertEqual(graph.references, {'test': [], 'test2': ['test']})
+        self.assertEqual(graph.levels, [['test'], ['test2']])
+        self.assertEqual(graph.cycles, [])
+        s = 'struct ASP_TABLE a {\n' \
+            '  field_fkey(integer, b_id);\n' \
+            '  reference(b_id, b(id), CASCADE, CASCADE)\n' \
+            '  field_fkey(integer, a_id);\n' \
+            '  reference(a_id, a(id), CASCADE, CASCADE)\n' \
+            '};\n' \
+            'struct ASP_TABLE b {\n' \
+            '  field_fkey(integer, a_id);\n' \
+            '  reference(a_id, a(id), CASCADE, CASCADE)\n' \
+            '};\n' \
+            'struct ASP_TABLE c {\n' \
+            '  field_fkey(integer, a_id);\n' \
+            '  reference(a_id, a(id), CASCADE, CASCADE)\n' \
+            '};\n' \
+            'struct ASP_TABLE d {\n' \
+            '  field(integer, id);\n' \
+            '};\n'
+        aspf = asp_db_cpp.AspDBCppFile(s)
+        aspf.init_structs()
+        graph = asp_db_cpp.AspDBReferenceGraph(aspf.cpp_structs)
+        # таблицы цикла создаются по одной, зависящие от цикла - после него
+        self.assertEqual(graph.cycles, [['a', 'b', 'a']])
+        self.assertEqual(graph.levels, [['a', 'd'], ['b'], ['c']])
+        gen = asp_db_tg.AspDBTablesGenerator.__new__(asp_db_tg.AspDBTablesGenerator)
+        gen.asp_tables = aspf
+        gen.db_tables_class = 'TestmacroDBTables'
+        source = ''.join(gen.add_create_levels())
+        self.assertIn('create_level_tables[4] = {\n  table_a, table_d,\n  table_b,\n', source)
+        self.assertIn('create_level_bounds[4] = {0, 2, 3, 4};', source)
+        self.assertIn('size_t TestmacroDBTables::GetCreateLevelsCount() const {\n  return 3;', source)
+        # зависящая от цикла таблица объявлена раньше него
+        c = s[s.find('struct ASP_TABLE c'): s.find('struct ASP_TABLE d')]
+        aspf = asp_db_cpp.AspDBCppFile(c + s.replace(c, ''))
+        aspf.init_structs()
+        graph = asp_db_cpp.AspDBReferenceGraph(aspf.cpp_structs)
+        self.assertEqual(graph.names, ['c', 'a', 'b', 'd'])
+        self.assertEqual(graph.cycles, [['a', 'b', 'a']])
+        self.assertEqual(graph.levels, [['a', 'd'], ['b'], ['c']])
+
+    def test_watch_regenerate(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cpp_file = os.path.join(tmp, 'tables.h')
+            with open(cpp_file, 'w') as f:
+                f.write(cpp_text)
+            gen = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', output_dir=tmp, split=True, watch=True)
+            gen.generate_files()
+            first, second = gen.asp_tables.cpp_structs
+            tables = [gen.get_table_output_path(t) for t in ('test', 'test2')]
+            # вне структур изменились только комментарии
+            with open(cpp_file, 'w') as f:
+                f.write('// header\n' + cpp_text)
+            self.assertEqual(gen.regenerate(), ([], []))
+            self.assertIs(gen.asp_tables.cpp_structs[0], first)
+            # изменилась вторая таблица: первая не разбирается и не генерируется
+            changed = cpp_text.replace('ffid', 'fxid')
+            with open(cpp_file, 'w') as f:
+                f.write(changed)
+            self.assertEqual(gen.regenerate(), (['test2'], []))
+            self.assertIs(gen.asp_tables.cpp_structs[0], first)
+            self.assertIsNot(gen.asp_tables.cpp_structs[1], second)
+            self.assertEqual(gen.asp_tables.cpp_structs[0].source, first.source)
+            self.assertEqual(gen.get_report()['updated'], [gen.get_output_path('.h'), tables[1]])
+            # результат совпадает с генерацией с нуля
+            fresh = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', output_dir=tmp, split=True)
+            fresh.generate_files()
+            self.assertEqual(fresh.get_report()['updated'], list())
+            # удалённая таблица удаляет свой файл
+            with open(cpp_file, 'w') as f:
+                f.write(changed[: changed.find('struct ASP_TABLE test2')] + '#endif\n')
+            self.assertEqual(gen.regenerate(), ([], ['test2']))
+            self.assertFalse(os.path.exists(tables[1]))
+            with open(gen.get_output_path('.h')) as f:
+                self.assertNotIn('test2', f.read())
+            # цикл наблюдения: между опросами хэдер меняется
+            task = (cpp_file, 'TestMacro', tmp, True, None, False, True, False, False)
+            edits = [cpp_text.replace('ffid', 'fyid')]
+
+            def edit(interval):
+                with open(cpp_file, 'w') as f:
+                    f.write(edits.pop(0))
+                stat = os.stat(cpp_file)
+                os.utime(cpp_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+            with mock.patch.object(asp_db_tg.time, 'sleep', edit):
+                self.assertEqual(asp_db_tg.watch_headers([task], interval=0, rounds=1), 0)
+            with open(tables[1]) as f:
+                self.assertIn('fyid', f.read())
+            # ошибка перегенерации - ненулевой код возврата
+            duplicate = cpp_text + cpp_text[cpp_text.find('struct ASP_TABLE test2'):]
+            edits = [duplicate]
+            with mock.patch.object(asp_db_tg.time, 'sleep', edit):
+                self.assertEqual(asp_db_tg.watch_headers([task], interval=0, rounds=1), 1)
+            # исправленный хэдер генерируется с нуля, ошибка снята
+            edits = [duplicate, cpp_text.replace('ffid', 'fzid')]
+            with mock.patch.object(asp_db_tg.time, 'sleep', edit):
+                self.assertEqual(asp_db_tg.watch_headers([task], interval=0, rounds=2), 0)
+            with open(tables[1]) as f:
+                self.assertIn('fzid', f.read())
+            self.assertEqual(asp_db_tg.watch_headers(
+                [(os.path.join(tmp, 'missing.h'),) + task[1:]], interval=0, rounds=0), 1)
+
+    def test_perfect_hash(self):
+        names = ['test', 'test2'] + ['t' + str(i) for i in range(300)]
+        perfect_hash = asp_db_tg.AspDBPerfectHash(names)
+        self.assertEqual(perfect_hash.size, len(names))
+        self.assertEqual(sorted(perfect_hash.slots), list(range(len(names))))
+        for i, name in enumerate(names):
+            self.assertEqual(perfect_hash.slots[perfect_hash.get_slot(name)], i)
+        # FNV-1a, эталонное значение для 'a' без свёртки 0xe40c292c
+        self.assertEqual(asp_db_tg.name_hash('a'), 0xe40c292c ^ 0xe40c)
+        self.assertRaises(BaseException, asp_db_tg.AspDBPerfectHash, ['a', 'a'])
+        with tempfile.TemporaryDirectory() as tmp:
+            cpp_file = os.path.join(tmp, 'tables.h')
+            with open(cpp_file, 'w') as f:
+                f.write(cpp_text)
+            gen = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', output_dir=tmp)
+            gen.generate_files()
+            with open(gen.get_output_path('.cpp')) as f:
+                source = f.read()
+            self.assertNotIn('for (const auto &x: str_tables)', source)
+            self.assertIn('static const char *const names[2] = {', source)
+            self.assertIn('int StrToFieldDefine_test2(const std::string &fname) {\n'
+                          '  static const int32_t seeds[3]', source)
+
+    def test_dispatch_arrays(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cpp_file = os.path.join(tmp, 'tables.h')
+            with open(cpp_file, 'w') as f:
+                f.write(cpp_text)
+            gen = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', output_dir=tmp)
+            gen.generate_files()
+            with open(gen.get_output_path('.cpp')) as f:
+                source = f.read()
+            self.assertNotIn('switch', source.split('std::string field2str_')[0])
+            self.assertNotIn('case default', source)
+            self.assertIn('static constexpr const char *table_names[3] = {\n'
+                          '  "",\n  "test",\n  "test2",\n};\n', source)
+            self.assertIn('    nullptr,\n    &test_create_setup,\n    &test2_create_setup,\n', source)
+            self.assertIn('    "",\n    TABLE_FIELD_NAME(TEST_TABLE_ID),\n', source)
+            self.assertIn('  return std::string(table_names[table_test2]);\n', source)
+
+    def test_select_data_columns(self):
+        aspf = asp_db_cpp.AspDBCppFile(cpp_text)
+        gen = asp_db_tg.AspDBTablesGenerator.__new__(asp_db_tg.AspDBTablesGenerator)
+        gen.asp_tables = aspf
+        gen.table_names = dict()
+        gen.watch = False
+        aspf.init_structs()
+        source = ''.join(gen.add_set_select_data(aspf.cpp_structs[1:]))
+        self.assertNotIn('else if', source)
+        self.assertIn('StrToFieldDefine_test2(', source)
+        self.assertIn('  out_vec->reserve(out_vec->size() + src->values.size());\n', source)
+        self.assertIn('        case 3:\n'
+                      '          select_macro(f_test2_ffid, TEST2_TABLE_FFID, '
+                      'str2field_test2(f_test2_ffid, col.second));\n', source)
+        # поиск столбцов - один раз на набор, вне цикла по строкам
+        self.assertLess(source.find('StrToFieldDefine_test2('),
+                        source.find('for (auto &row: src->values)'))
+
+    def test_insert_values_range(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cpp_file = os.path.join(tmp, 'tables.h')
+            with open(cpp_file, 'w') as f:
+                f.write(cpp_text)
+            gen = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', output_dir=tmp, split=True)
+            gen.generate_files()
+            with open(gen.get_output_path('.h')) as f:
+                header = f.read()
+            with open(gen.get_table_output_path('test2')) as f:
+                source = f.read()
+            self.assertIn('  using IDBTables::setInsertValues;\n', header)
+            self.assertIn('void TestmacroDBTables::setInsertValues<test2>(\n'
+                          '    db_query_insert_setup *src, const test2 *begin, const test2 *end) const;\n',
+                          header)
+            self.assertIn('  src->values_vec.reserve(src->values_vec.size() + (end - begin));\n', source)
+            self.assertIn('    insert_macro(f_test2_ffid, TEST2_TABLE_FFID, '
+                          'field2str_test2(f_test2_ffid, select_data));\n'
+                          '    src->values_vec.emplace_back(std::move(values));\n', source)
+
+    def test_visit_select_data(self):
+        aspf = asp_db_cpp.AspDBCppFile(cpp_text)
+        gen = asp_db_tg.AspDBTablesGenerator.__new__(asp_db_tg.AspDBTablesGenerator)
+        gen.asp_tables = aspf
+        gen.table_names = dict()
+        gen.watch = False
+        gen.db_tables_class = 'TestmacroDBTables'
+        aspf.init_structs()
+        source = ''.join(gen.add_visit_select_data(aspf.cpp_structs[:1]))
+        self.assertIn('void TestmacroDBTables::VisitSelectData<test>(db_query_select_result *src,\n'
+                      '    const std::function<void(const test &)> &visitor) const {\n', source)
+        self.assertNotIn('out_vec', source)
+        self.assertEqual(source.count('  test tmp;\n'), 1)
+        self.assertLess(source.find('  test tmp;\n'), source.find('for (auto &row: src->values)'))
+        self.assertIn('      visitor(tmp);\n', source)
+
+    def test_lazy_init(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cpp_file = os.path.join(tmp, 'tables.h')
+            with open(cpp_file, 'w') as f:
+                f.write(cpp_text)
+            gen = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', output_dir=tmp, split=True, lazy_init=True)
+            gen.generate_files()
+            with open(gen.get_output_path('.h')) as f:
+                header = f.read()
+            with open(gen.get_output_path('.cpp')) as f:
+                dispatch = f.read()
+            with open(gen.get_table_output_path('test2')) as f:
+                source = f.read()
+            self.assertIn('const db_table_create_setup &test2_create_setup();\n', header)
+            self.assertIn('static constexpr std::string_view table_names[3] = {\n', dispatch)
+            self.assertIn('  return create_setups[i]();\n', dispatch)
+            # объекты таблиц не создаются до main
+            self.assertNotIn('\nstatic const', source)
+            self.assertNotIn('\nconst db_fields_collection test2_fields', source)
+            self.assertIn('\nconst db_table_create_setup &test2_create_setup() {\n'
+                          '  static const db_table_create_setup::uniques_container uniques = {};\n'
+                          '  static const std::shared_ptr<db_ref_collection> references(\n', source)
+            self.assertIn('    table_test2, test2_fields(),\n    uniques, references);\n', source)
+
+    def test_schema_ir(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cpp_file = os.path.join(tmp, 'tables.h')
+            with open(cpp_file, 'w') as f:
+                f.write(cpp_text)
+            gen = asp_db_tg.AspDBTablesGenerator(cpp_file, 'TestMacro', output_dir=tmp, emit_ir=True)
+            gen.generate_files()
+            ir_file = gen.get_output_path(asp_db_cpp.SCHEMA_IR_EXT)
+            self.assertIn(ir_file, gen.get_report()['updated'])
+            # генерация по промежуточному представлению, без разбора хэдера
+            out_dir = os.path.join(tmp, 'ir')
+            os.mkdir(out_dir)
+            gen_ir = asp_db_tg.AspDBTablesGenerator(ir_file, output_dir=out_dir)
+            self.assertEqual(gen_ir.module_name, 'TestMacro')
+            gen_ir.generate_files()
+            for ext in ('.h', '.cpp'):
+                with open(gen.get_output_path(ext)) as f, open(gen_ir.get_output_path(ext)) as f_ir:
+                    self.assertEqual(f.read(), f_ir.read())
+            struct = gen_ir.asp_tables.cpp_structs[1]
+            self.assertEqual(struct.primary_key, ['id', 'fid'])
+            self.assertEqual(struct.get_field('fid').to_str, 'n2s')
+            self.assertEqual(struct.foreign_refs[0].ref.get_delete_act(),
+                             asp_db_cpp.AspDBRefAction.SET_NULL)
+            # другая версия формата не загружается
+            with open(ir_file) as f:
+                data = json.load(f)
+            data['version'] += 1
+            with open(ir_file, 'w') as f:
+                json.dump(data, f)
+            self.assertRaises(BaseException, asp_db_cpp.AspDBSchemaFile, ir_file)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""
+Тестирования модуля asp_db_benchmark
+"""
+import asp_db_benchmark
+import asp_db_cpp
+import unittest
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_synthetic_header(self):
+        text = asp_db_benchmark.make_synthetic_header(tables=5, fields=6, fk_density=0.34,
+                                                      comment_noise=0.5, nesting=2)
+        aspf = asp_db_cpp.AspDBCppFile(text)
+        aspf.init_structs()
+        self.assertEqual([s.name for s in aspf.cpp_structs],
+                         ['table' + str(i) for i in range(5)])
+        self.assertEqual(len(aspf.cpp_structs[0].fields), 6)
+        self.assertEqual(len(aspf.cpp_structs[1].fields), 4)
+        self.assertEqual(len(aspf.cpp_structs[1].foreign_refs), 2)
+
+    def test_run_and_compare(self):
+        results = asp_db_benchmark.run_benchmark(tables=3, fields=3, repeat=1)
+        self.assertIn('init_structs', results['phases'])
+        for stage in asp_db_benchmark.GENERATOR_STAGES:
+            self.assertIn(stage, results['phases'])
+        baseline = dict(params=results['params'],
+                        phases={k: v / 10.0 for k, v in results['phases'].items() if v})
+        ratios, regressions = asp_db_benchmark.compare_results(results, baseline)
+        self.assertEqual(sorted(regressions), sorted(ratios))
+        self.assertGreater(results['memory']['structs'], 0)
+        # модель без __slots__ и интернирования заметно больше
+        plain = results['memory_plain']
+        self.assertGreater(plain['model'], results['memory']['model'])
+        self.assertEqual(plain['saved'], plain['model'] - results['memory']['model'])
+        self.assertGreater(plain['saved_ratio'], 0.2)
+        baseline['memory'] = dict(results['memory'])
+        ratios, regressions = asp_db_benchmark.compare_results(results, baseline)
+        self.assertEqual(ratios['memory.structs'], 1.0)
+        self.assertNotIn('memory.structs', regressions)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,7 @@
 """
 import cparser_lite
 import asp_db_cpp
+import pickle
 import unittest
 
 
@@ -70,6 +71,53 @@ class TestStringMethods(unittest.TestCase):
         self.assertEqual(cparser_lite.get_brace_content(
             'not (ool (as)e3', '(', ')'), '')
 
+    def test_brace_span(self):
+        """
+        Оттестировать поиск границ содержимого скобок от позиции
+        """
+        text = 'a(b) c(d(e)f) "(" g{ h }'
+        self.assertEqual(cparser_lite.get_brace_span(text, 0, '(', ')'), (2, 3))
+        self.assertEqual(cparser_lite.get_brace_span(text, 4, '(', ')'), (7, 12))
+        self.assertEqual(cparser_lite.get_brace_span(text, 13, '(', ')'), (-1, -1))
+        self.assertEqual(cparser_lite.get_brace_span(text, 0, '{', '}'), (20, 23))
+        self.assertEqual(cparser_lite.get_brace_span(text, 0, '(', ')', 3), (-1, -1))
+        self.assertEqual(cparser_lite.get_brace_span(
+            'x ${a${b}} ${c}', 3, '${', '}'), (7, 8))
+
+    def test_tokenize(self):
+        """
+        Оттестировать лексер: комментарии пропускаются, литералы
+        выделяются целиком, уровень вложенности отслеживается
+        """
+        text = 'f(a, "(}", \'}\') /* } */ { b[1]; } // )'
+        tokens = list(cparser_lite.tokenize(text))
+        self.assertEqual([t.value for t in tokens],
+                         ['f', '(', 'a', ',', '"(}"', ',', "'}'", ')',
+                          '{', 'b', '[', '1', ']', ';', '}'])
+        self.assertEqual([t.depth for t in tokens],
+                         [0, 0, 1, 1, 1, 1, 1, 0, 0, 1, 1, 2, 1, 1, 0])
+        self.assertEqual(tokens[4].kind, cparser_lite.CppToken.STRING)
+        self.assertEqual(text[tokens[9].begin: tokens[9].end], 'b')
+
+    def test_iter_calls(self):
+        text = ' field(int, a) /* unique(x) */ g(h(1), 2) { k(3) }'
+        calls = list(cparser_lite.iter_calls(text))
+        self.assertEqual([c.name for c in calls], ['field', 'g'])
+        self.assertEqual(text[calls[0].args_begin: calls[0].args_end], 'int, a')
+        self.assertEqual(text[calls[1].args_begin: calls[1].args_end], 'h(1), 2')
+        self.assertEqual(calls[1].pos, text.find('g('))
+
+    def test_cpp_template(self):
+        """
+        Оттестировать шаблоны cpp кода: скобки C++ не являются подстановками
+        """
+        t = cparser_lite.CppTemplate('void ${name}() {\n  return ${value};\n}\n')
+        self.assertEqual(t.fields, ('name', 'value'))
+        self.assertEqual(t.fill(name='f', value='{1}'), 'void f() {\n  return {1};\n}\n')
+        self.assertEqual(t.fill({'name': 'g'}, value='0'), 'void g() {\n  return 0;\n}\n')
+        self.assertEqual(t.fill({'name': 'g', 'value': '0'}, value='1'), 'void g() {\n  return 1;\n}\n')
+        self.assertRaises(KeyError, t.fill, name='f')
+
 
 cpp_text = '#define SOME_DEFINE' \
            '' \
@@ -154,6 +202,182 @@ class TestAspDBCppFile(unittest.TestCase):
         self.assertEqual(aspf.cpp_structs[0].foreign_refs[0].ref.on_delete,
                          asp_db_cpp.AspDBRefAction.RESTRICT)
 
+    def test_init_structs_same_head(self):
+        s = 'struct ASP_TABLE test {\n' \
+            '  field(integer, a);\n' \
+            '};\n' \
+            'struct ASP_TABLE test {\n' \
+            '  field(integer, b);\n' \
+            '};\n'
+        aspf = asp_db_cpp.AspDBCppFile(s)
+        aspf.init_structs()
+        self.assertEqual(len(aspf.cpp_structs), 2)
+        self.assertEqual(aspf.cpp_structs[0].fields[0].asp_name, 'a')
+        self.assertEqual(aspf.cpp_structs[1].fields[0].asp_name, 'b')
+
+    def test_init_structs_bytes(self):
+        s = '/* struct ASP_TABLE old {\n' \
+            '  field(integer, x);\n' \
+            '}; */\n' \
+            'struct ASP_TABLE test {\n' \
+            '  field(integer, a); // поле }\n' \
+            '  /* field(text, b); */\n' \
+            '};\n'
+        aspf = asp_db_cpp.AspDBCppFile(s.encode())
+        aspf.init_structs()
+        self.assertEqual(len(aspf.cpp_structs), 1)
+        self.assertEqual(aspf.cpp_structs[0].name, 'test')
+        self.assertEqual(len(aspf.cpp_structs[0].fields), 1)
+        self.assertEqual(aspf.cpp_structs[0].fields[0].asp_name, 'a')
+        self.assertNotIn('/*', aspf.cpp_structs[0].source)
+
+    def test_directives(self):
+        s = 'struct ASP_TABLE test {\n' \
+            '  field(integer, unique_id);\n' \
+            '  field(text, primary_key_name);\n' \
+            '  field(text, b);\n' \
+            '  unique(unique_id, b)\n' \
+            '  unique(primary_key_name)\n' \
+            '  primary_key(unique_id)\n' \
+            '};\n'
+        aspf = asp_db_cpp.AspDBCppFile(s)
+        aspf.init_structs()
+        struct = aspf.cpp_structs[0]
+        self.assertEqual(struct.primary_key, ['unique_id'])
+        self.assertEqual(struct.unique, [['unique_id', 'b'], ['primary_key_name']])
+        self.assertEqual([d.name for d in struct.directives],
+                         ['field', 'field', 'field', 'unique', 'unique', 'primary_key'])
+        self.assertEqual(struct.directives[3].pos, struct.source.find('unique('))
+
+    def test_fields_index(self):
+        s = 'struct ASP_TABLE test {\n' \
+            '  field(integer, id);\n' \
+            '  field(text, id);\n' \
+            '  field_fkey(integer, fk);\n' \
+            '  reference(fk, ex(id), CASCADE, CASCADE)\n' \
+            '  str_functions(fk, to_s, from_s)\n' \
+            '  primary_key(id, fk)\n' \
+            '};\n'
+        aspf = asp_db_cpp.AspDBCppFile(s)
+        aspf.init_structs()
+        struct = aspf.cpp_structs[0]
+        self.assertEqual(sorted(struct.fields_index), ['fk', 'id'])
+        # первое объявление
+        self.assertIs(struct.get_field('id'), struct.fields[0])
+        self.assertIs(struct.get_field('fk'), struct.foreign_refs[0].field)
+        self.assertIsNone(struct.get_field('missing'))
+        self.assertTrue(struct.get_field('fk').is_primary_key)
+        self.assertEqual(struct.get_field('fk').to_str, 'to_s')
+
+    def test_struct_span(self):
+        s = 'struct ASP_TABLE a {\n' \
+            '  field(integer, id);\n' \
+            '};\n' \
+            'struct ASP_TABLE b {\n' \
+            '  field(integer, id);\n' \
+            '  primary_key(id)\n' \
+            '};\n'
+        aspf = asp_db_cpp.AspDBCppFile(s)
+        aspf.init_structs()
+        struct = aspf.cpp_structs[1]
+        # тело структуры не копируется из исходника
+        self.assertIs(struct.text, aspf.source)
+        self.assertEqual(struct.source.strip(), 'field(integer, id);\n  primary_key(id)')
+        self.assertFalse(hasattr(struct, '__dict__'))
+        self.assertFalse(hasattr(struct.fields[0], '__dict__'))
+        self.assertIs(struct.fields[0].asp_name, aspf.cpp_structs[0].fields[0].asp_name)
+        # при сериализации сохраняется только тело
+        loaded = pickle.loads(pickle.dumps(struct))
+        self.assertIsNone(loaded.span)
+        self.assertEqual(loaded.text, struct.source)
+        self.assertEqual(loaded.primary_key, ['id'])
+        self.assertEqual(loaded.fields[0].asp_name, 'id')
+
+    def test_lazy_structs(self):
+        s = 'struct ASP_TABLE a {\n' \
+            '  field(integer, id);\n' \
+            '  primary_key(id)\n' \
+            '};\n' \
+            'struct ASP_TABLE b {\n' \
+            '  field(integer, id);\n' \
+            '  field_fkey(integer, a_id);\n' \
+            '  reference(a_id, a(id), CASCADE, CASCADE)\n' \
+            '  unique(a_id)\n' \
+            '};\n'
+        aspf = asp_db_cpp.AspDBCppFile(s)
+        aspf.init_structs()
+        self.assertEqual([struct.name for struct in aspf.cpp_structs], ['a', 'b'])
+        self.assertFalse(any(struct.is_parsed() for struct in aspf.cpp_structs))
+        # первое обращение к данным разбирает тело
+        struct = aspf.cpp_structs[1]
+        self.assertEqual(struct.unique, [['a_id']])
+        self.assertTrue(struct.is_parsed())
+        self.assertFalse(aspf.cpp_structs[0].is_parsed())
+        self.assertEqual(struct.foreign_refs[0].ref.ftable, 'a')
+        self.assertIs(struct.get_field('a_id'), struct.foreign_refs[0].field)
+        self.assertRaises(AttributeError, getattr, struct, 'missing')
+        # результат совпадает с немедленным разбором
+        eager = asp_db_cpp.AspDBCppFile(s, lazy=False)
+        eager.init_structs()
+        self.assertTrue(eager.cpp_structs[0].is_parsed())
+        self.assertEqual([st.to_ir() for st in eager.cpp_structs],
+                         [st.to_ir() for st in aspf.cpp_structs])
+        # статистика разбора собирается и при ленивом разборе
+        stats = cparser_lite.PhaseStats()
+        counted = asp_db_cpp.AspDBCppFile(s, stats=stats)
+        counted.init_structs()
+        self.assertNotIn('init_data.directives', stats.as_dict())
+        for st in counted.cpp_structs:
+            st.fields
+        phases = stats.as_dict()
+        self.assertEqual(phases['init_data.directives']['calls'], 2)
+        self.assertEqual(phases['init_data.link']['calls'], 2)
+        self.assertGreater(phases['init_data.directives']['time'], 0)
+        # ленивая структура сериализуется разобранной
+        lazy = asp_db_cpp.AspDBCppFile(s)
+        lazy.init_structs()
+        loaded = pickle.loads(pickle.dumps(lazy.cpp_structs[0]))
+        self.assertTrue(loaded.is_parsed())
+        self.assertEqual(loaded.primary_key, ['id'])
+
+    def test_init_structs_from(self):
+        s = '#include "db_types.h"\n' \
+            'struct ASP_TABLE a {\n' \
+            '  field(integer, id);\n' \
+            '};\n' \
+            'struct ASP_TABLE b {\n' \
+            '  field(integer, id);\n' \
+            '};\n' \
+            'struct ASP_TABLE c {\n' \
+            '  field(integer, id);\n' \
+            '};\n'
+        self.assertEqual(cparser_lite.common_prefix_length(s, s.replace('b {', 'x {')),
+                         s.find('b {'))
+        self.assertEqual(cparser_lite.common_suffix_length(s, 'x' + s, len(s)), len(s))
+        prev = asp_db_cpp.AspDBCppFile(s)
+        prev.init_structs()
+        a, b, c = prev.cpp_structs
+        changed = s.replace('struct ASP_TABLE b {\n', 'struct ASP_TABLE b {\n  field(text, name);\n')
+        aspf = asp_db_cpp.AspDBCppFile(changed)
+        aspf.init_structs_from(prev)
+        # структуры до и после изменения перенесены, изменившаяся найдена заново
+        self.assertIs(aspf.cpp_structs[0], a)
+        self.assertIsNot(aspf.cpp_structs[1], b)
+        self.assertIs(aspf.cpp_structs[2], c)
+        self.assertTrue(all(struct.text is aspf.source for struct in aspf.cpp_structs))
+        self.assertEqual(c.source, '\n  field(integer, id);\n')
+        self.assertEqual([field.asp_name for field in aspf.cpp_structs[1].fields], ['name', 'id'])
+        # незакрытая скобка меняет границы структур: просмотр целиком
+        unclosed = changed.replace('id);\n};\nstruct ASP_TABLE c', 'id);\nstruct ASP_TABLE c')
+        broken = asp_db_cpp.AspDBCppFile(unclosed)
+        broken.init_structs_from(aspf)
+        full = asp_db_cpp.AspDBCppFile(unclosed)
+        full.init_structs()
+        self.assertEqual(len(full.cpp_structs), 1)
+        self.assertEqual([(st.name, st.span) for st in broken.cpp_structs],
+                         [(st.name, st.span) for st in full.cpp_structs])
+        self.assertIsNot(broken.cpp_structs[-1], c)
+
 
 class TestAspDBForeignField(unittest.TestCase):
     def test_init_ff(self):